@@ -0,0 +1,4 @@
+from .fakes import FakeMinio
+from .generator import CatalogSize, SIZES, Catalog, generate_catalog
+from .scenarios import Context, SCENARIOS, scenario
+from .runner import measure, run, save, compare
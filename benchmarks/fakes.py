@@ -0,0 +1,89 @@
+from typing import Any, BinaryIO, Iterable, Iterator
+from dataclasses import dataclass
+from io import BytesIO
+from threading import Lock
+
+
+@dataclass
+class FakeObject:
+    data: bytes
+    content_type: str
+    metadata: dict[str, str]
+
+
+class FakeResponse:
+    def __init__(self, obj: FakeObject) -> None:
+        self.stream = BytesIO(obj.data)
+        self.headers = {'Content-Type': obj.content_type, 'Content-Length': str(len(obj.data)), **obj.metadata}
+
+    def read(self, amt: int | None = None) -> bytes:
+        return self.stream.read(amt)
+
+    def stream_chunks(self, amt: int = 64 * 1024) -> Iterator[bytes]:
+        while chunk := self.stream.read(amt):
+            yield chunk
+
+    def close(self) -> None:
+        self.stream.close()
+
+    def release_conn(self) -> None:
+        pass
+
+
+@dataclass
+class FakeStat:
+    bucket_name: str
+    object_name: str
+    size: int
+    content_type: str
+    metadata: dict[str, str]
+
+
+class FakeNoSuchKey(Exception):
+    code = 'NoSuchKey'
+
+
+class FakeMinio:
+    """In-memory stand-in for 'minio.Minio' implementing the subset of its API used by models."""
+
+    def __init__(self) -> None:
+        self.buckets: dict[str, dict[str, FakeObject]] = {}
+        self.lock = Lock()
+
+    def make_bucket(self, bucket_name: str) -> None:
+        self.buckets.setdefault(bucket_name, {})
+
+    def bucket_exists(self, bucket_name: str) -> bool:
+        return bucket_name in self.buckets
+
+    def put_object(self, bucket_name: str, object_name: str, data: BinaryIO, length: int,
+                   content_type: str = 'application/octet-stream', metadata: dict[str, str] | None = None,
+                   **_kwargs: Any) -> None:
+        content = data.read() if length is None or length < 0 else data.read(length)
+        with self.lock:
+            self.buckets.setdefault(bucket_name, {})[object_name] = \
+                FakeObject(content, content_type, dict(metadata or {}))
+
+    def get(self, bucket_name: str, object_name: str) -> FakeObject:
+        obj = self.buckets.get(bucket_name, {}).get(object_name)
+        if obj is None:
+            raise FakeNoSuchKey(f'{bucket_name}/{object_name}')
+        return obj
+
+    def get_object(self, bucket_name: str, object_name: str, **_kwargs: Any) -> FakeResponse:
+        return FakeResponse(self.get(bucket_name, object_name))
+
+    def stat_object(self, bucket_name: str, object_name: str, **_kwargs: Any) -> FakeStat:
+        obj = self.get(bucket_name, object_name)
+        return FakeStat(bucket_name, object_name, len(obj.data), obj.content_type, obj.metadata)
+
+    def remove_object(self, bucket_name: str, object_name: str, **_kwargs: Any) -> None:
+        with self.lock:
+            self.buckets.get(bucket_name, {}).pop(object_name, None)
+
+    def remove_objects(self, bucket_name: str, delete_object_list: Iterable[Any], **_kwargs: Any) -> Iterator[Any]:
+        for delete_object in delete_object_list:
+            # attribute was renamed in later versions of minio
+            name = getattr(delete_object, 'name', getattr(delete_object, '_name', delete_object))
+            self.remove_object(bucket_name, name)
+        return iter(())
@@ -0,0 +1,218 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, UTC
+from ipaddress import IPv4Address
+from io import BytesIO
+import random
+import struct
+import zlib
+
+from ..models.base import FileStream, Session
+from ..models.auxillary.address import Country, City
+from ..models.user import User, PersonalAPIKey, DeveloperAPIKey, UserAvatarFormat
+from ..models.opportunity.opportunity import (
+    Opportunity, OpportunityProvider, OpportunityTag, OpportunityGeotag, OpportunityCard, OpportunityResponse,
+    OpportunityDescriptionFormat,
+)
+from ..models.opportunity.form import OpportunityForm, RegexField, ChoiceField
+from .. import serializers as ser
+
+
+@dataclass
+class CatalogSize:
+    providers: int
+    tags: int
+    countries: int
+    geotags: int
+    opportunities: int
+    # Cards per opportunity are uniformly distributed in [0, max_cards]
+    max_cards: int
+    users: int
+    responses: int
+    # Fractions of opportunities having description and form
+    descriptions: float = 0.5
+    forms: float = 0.5
+
+
+SIZES: dict[str, CatalogSize] = {
+    'small': CatalogSize(providers=10, tags=50, countries=3, geotags=30, opportunities=500, max_cards=3,
+                         users=200, responses=2_000),
+    'medium': CatalogSize(providers=50, tags=300, countries=10, geotags=300, opportunities=10_000, max_cards=3,
+                          users=5_000, responses=50_000),
+    'large': CatalogSize(providers=200, tags=1_000, countries=30, geotags=2_000, opportunities=100_000, max_cards=3,
+                         users=50_000, responses=500_000),
+}
+
+
+@dataclass
+class Catalog:
+    """Identifiers of generated entities, scenarios pick their inputs from here."""
+
+    provider_ids: list[int] = field(default_factory=list)
+    tag_ids: list[int] = field(default_factory=list)
+    geotag_ids: list[int] = field(default_factory=list)
+    opportunity_ids: list[int] = field(default_factory=list)
+    form_ids: list[int] = field(default_factory=list)
+    user_ids: list[int] = field(default_factory=list)
+    credentials: list[tuple[str, str]] = field(default_factory=list)
+    api_keys: list[str] = field(default_factory=list)
+
+
+WORDS = [
+    'data', 'science', 'olympiad', 'summer', 'school', 'internship', 'machine', 'learning', 'math', 'physics',
+    'robotics', 'design', 'product', 'backend', 'frontend', 'research', 'grant', 'camp', 'hackathon', 'biology',
+    'chemistry', 'finance', 'marketing', 'analytics', 'security', 'cloud', 'mobile', 'game', 'art', 'music',
+]
+
+def phrase(rng: random.Random, words: int, max_length: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words))[:max_length].strip()
+
+def unique_name(rng: random.Random, i: int, max_length: int) -> str:
+    return f'{phrase(rng, 2, max_length - 8)} {i}'
+
+def markdown(rng: random.Random, paragraphs: int) -> bytes:
+    return '\n\n'.join(
+        f'## {phrase(rng, 3, 60)}\n\n' + ' '.join(phrase(rng, 12, 200) + '.' for _ in range(rng.randint(2, 6)))
+        for _ in range(paragraphs)
+    ).encode()
+
+
+def generate_form_fields(rng: random.Random) -> dict:
+    fields = {}
+    for i in range(rng.randint(2, 8)):
+        kind = rng.choice(['string', 'regex', 'choice'])
+        label = phrase(rng, 2, 40)
+        required = rng.random() < 0.6
+        if kind == 'string':
+            fields[f'field_{i}'] = ser.OpportunityForm.StringField(type='string', label=label, is_required=required,
+                                                                   max_length=rng.choice([None, 50, 200]))
+        elif kind == 'regex':
+            fields[f'field_{i}'] = ser.OpportunityForm.RegexField(type='regex', label=label, is_required=required,
+                                                                  max_length=100, regex=r'^[a-z]+\d*$')
+        else:
+            fields[f'field_{i}'] = ser.OpportunityForm.ChoiceField(type='choice', label=label, is_required=required,
+                                                                   choices=rng.sample(WORDS, 4))
+    return fields
+
+def generate_response_data(rng: random.Random, form: OpportunityForm, valid: bool = True) -> dict:
+    data = {}
+    for name, form_field in form.fields.items():
+        if not form_field.is_required and rng.random() < 0.3:
+            continue
+        match form_field:
+            case ChoiceField():
+                data[name] = rng.choice(form_field.choices)
+            case RegexField():
+                data[name] = rng.choice(WORDS) + str(rng.randint(0, 99))
+            case _:
+                data[name] = phrase(rng, 3, form_field.max_length or 200)
+    if not valid:
+        data['unexpected'] = 'value'
+    return data
+
+
+def generate_png(rng: random.Random, size: int = 256, block: int = 16) -> bytes:
+    """Valid RGB PNG image of random colored blocks, so that thumbnails can be generated from it."""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    blocks = [[bytes(rng.getrandbits(8) for _ in range(3)) * block for _ in range(size // block)]
+              for _ in range(size // block)]
+    rows = b''.join(b'\x00' + b''.join(row) for row in blocks for _ in range(block))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)) \
+        + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+def generate_catalog(session_factory, minio_client, size: CatalogSize, seed: int = 0,
+                     batch_size: int = 1000) -> Catalog:
+    """Fill empty databases with a synthetic catalog of given size. Entities are created through
+       model methods, so everything maintained on flush (search documents, feed, counters) is built too.
+       Same seed produces the same catalog."""
+
+    rng = random.Random(seed)
+    catalog = Catalog()
+    png = generate_png(rng)
+    for bucket in ('opportunity-description', 'opportunity-provider-logo', 'user-avatar', 'user-cv'):
+        minio_client.make_bucket(bucket)
+    minio_client.put_object('opportunity-description', 'default.md', BytesIO(b''), 0)
+    minio_client.put_object('opportunity-provider-logo', 'default.png', BytesIO(png), len(png))
+    minio_client.put_object('user-avatar', 'default.png', BytesIO(png), len(png))
+
+    with session_factory.begin() as session:
+        session: Session
+        providers = [OpportunityProvider.create(session, ser.OpportunityProvider.Create(name=unique_name(rng, i, 50)))
+                     for i in range(size.providers)]
+        tags = [OpportunityTag.create(session, ser.OpportunityTag.Create(name=unique_name(rng, i, 50)))
+                for i in range(size.tags)]
+        countries = [Country.create(session, ser.Country(name=f'Country {i}', phone_code=i + 1, flag='F'))
+                     for i in range(size.countries)]
+        geotags = []
+        for i in range(size.geotags):
+            city = City.create(session, rng.choice(countries), ser.City(
+                name=f'City {i}', latitude=rng.uniform(41, 70), longitude=rng.uniform(20, 180),
+            ))
+            geotags.append(OpportunityGeotag.create(session, city))
+        session.flush()
+        catalog.provider_ids = [provider.id for provider in providers]
+        catalog.tag_ids = [tag.id for tag in tags]
+        catalog.geotag_ids = [geotag.id for geotag in geotags]
+
+    for start in range(0, size.opportunities, batch_size):
+        with session_factory.begin() as session:
+            providers = session.query(OpportunityProvider).all()
+            tags = session.query(OpportunityTag).all()
+            geotags = session.query(OpportunityGeotag).all()
+            opportunities = []
+            for i in range(start, min(start + batch_size, size.opportunities)):
+                opportunity = Opportunity.create(session, rng.choice(providers), ser.Opportunity.Create(
+                    name=phrase(rng, 4, 100), link=f'https://example.com/opportunity/{i}', provider_id=1,
+                ))
+                opportunity.add_tags(rng.sample(tags, rng.randint(0, min(5, len(tags)))))
+                opportunity.add_geotags(rng.sample(geotags, rng.randint(0, min(3, len(geotags)))))
+                for _ in range(rng.randint(0, size.max_cards)):
+                    OpportunityCard.create(session, opportunity, ser.OpportunityCard.Create(
+                        title=phrase(rng, 4, 100), subtitle=phrase(rng, 2, 50),
+                    ))
+                opportunities.append(opportunity)
+            session.flush()
+            for opportunity in opportunities:
+                catalog.opportunity_ids.append(opportunity.id)
+                if rng.random() < size.descriptions:
+                    description = markdown(rng, rng.randint(1, 8))
+                    opportunity.update_description(minio_client, FileStream(
+                        stream=BytesIO(description), format=OpportunityDescriptionFormat.MARKDOWN,
+                        size=len(description),
+                    ))
+                if rng.random() < size.forms:
+                    OpportunityForm.create(opportunity=opportunity, fields=generate_form_fields(rng))
+                    opportunity.has_form = True
+                    catalog.form_ids.append(opportunity.id)
+
+    for start in range(0, size.users, batch_size):
+        with session_factory.begin() as session:
+            users = []
+            for i in range(start, min(start + batch_size, size.users)):
+                credentials = ser.User.Credentials(email=f'user{i}@example.com', password=f'Password-{i}')
+                users.append(User.create(session, credentials))
+                catalog.credentials.append((credentials.email, credentials.password))
+            session.flush()
+            for user in users:
+                catalog.user_ids.append(user.id)
+                api_key = PersonalAPIKey.generate(session, user, IPv4Address(rng.getrandbits(32)),
+                                                  datetime.now(UTC) + timedelta(days=30))
+                catalog.api_keys.append(str(api_key))
+                if rng.random() < 0.3:
+                    user.user_info.update_avatar(minio_client, FileStream(stream=BytesIO(png),
+                                                                          format=UserAvatarFormat.PNG, size=len(png)))
+        with session_factory.begin() as session:
+            catalog.api_keys.append(str(DeveloperAPIKey.generate(session)))
+
+    if len(catalog.form_ids) > 0:
+        forms = {form.id: form for form in OpportunityForm.objects(id__in=catalog.form_ids)}
+        for start in range(0, size.responses, batch_size):
+            with session_factory.begin() as session:
+                for _ in range(start, min(start + batch_size, size.responses)):
+                    form = forms[rng.choice(catalog.form_ids)]
+                    OpportunityResponse.create(session, session.get(User, rng.choice(catalog.user_ids)),
+                                               session.get(Opportunity, form.id), form,
+                                               generate_response_data(rng, form))
+    return catalog
@@ -0,0 +1,63 @@
+from typing import Any, Iterable
+from statistics import mean, median, quantiles
+import json
+import platform
+import random
+import time
+
+from .scenarios import SCENARIOS, Context
+
+
+def measure(context: Context, name: str, iterations: int, warmup: int) -> dict[str, float]:
+    """Run scenario and return statistics of its durations in milliseconds."""
+
+    function = SCENARIOS[name]
+    for _ in range(warmup):
+        function(context)
+    durations: list[float] = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        function(context)
+        durations.append((time.perf_counter_ns() - start) / 1e6)
+    percentiles = quantiles(durations, n=100) if len(durations) > 1 else durations * 99
+    return {
+        'iterations': iterations,
+        'mean': mean(durations),
+        'min': min(durations),
+        'median': median(durations),
+        'p95': percentiles[94],
+        'p99': percentiles[98],
+    }
+
+
+def run(context: Context, names: Iterable[str], iterations: int, warmup: int, meta: dict[str, Any]) -> dict[str, Any]:
+    results: dict[str, Any] = {}
+    for name in names:
+        # every scenario gets its own stream of inputs, so that results don't depend on what else was run
+        context.rng = random.Random(f'{meta["seed"]}/{name}')
+        results[name] = measure(context, name, iterations, warmup)
+    return {
+        'meta': {**meta, 'python': platform.python_version(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')},
+        'results': results,
+    }
+
+
+def save(report: dict[str, Any], path: str) -> None:
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
+
+
+def compare(report: dict[str, Any], baseline_path: str) -> str:
+    """Render table with medians and p95 of given report relative to baseline report."""
+
+    with open(baseline_path) as file:
+        baseline = json.load(file)['results']
+    lines = [f'{"scenario":<24}{"median, ms":>12}{"change":>10}{"p95, ms":>12}{"change":>10}']
+    for name, result in report['results'].items():
+        old = baseline.get(name)
+        line = f'{name:<24}'
+        for metric in ('median', 'p95'):
+            change = f'{(result[metric] / old[metric] - 1) * 100:+.1f}%' if old else '-'
+            line += f'{result[metric]:>12.3f}{change:>10}'
+        lines.append(line)
+    return '\n'.join(lines)
@@ -0,0 +1,100 @@
+from typing import Callable
+from dataclasses import dataclass
+import random
+
+from sqlalchemy.orm import sessionmaker
+
+from ..models.user import User, UserInfo, APIKey
+from ..models.opportunity.opportunity import Opportunity, OpportunityProvider, OpportunityTag, OpportunityGeotag
+from ..models.opportunity.feed import PublicCardFeed
+from ..models.opportunity.form import OpportunityForm, ResponseData
+from .. import serializers as ser
+
+from .generator import Catalog, generate_response_data
+
+
+@dataclass
+class Context:
+    session_factory: sessionmaker
+    minio_client: object
+    catalog: Catalog
+    rng: random.Random
+
+
+type Scenario = Callable[[Context], None]
+
+SCENARIOS: dict[str, Scenario] = {}
+
+def scenario(function: Scenario) -> Scenario:
+    SCENARIOS[function.__name__] = function
+    return function
+
+
+def random_filter(context: Context, session) -> dict:
+    catalog, rng = context.catalog, context.rng
+    return {
+        'providers': [session.get(OpportunityProvider, id) for id in rng.sample(catalog.provider_ids, rng.randint(0, 2))],
+        'tags': [session.get(OpportunityTag, id) for id in rng.sample(catalog.tag_ids, rng.randint(0, 2))],
+        'geotags': [session.get(OpportunityGeotag, id) for id in rng.sample(catalog.geotag_ids, rng.randint(0, 1))],
+    }
+
+
+@scenario
+def filter_count(context: Context) -> None:
+    with context.session_factory() as session:
+        filters = random_filter(context, session)
+        pages = Opportunity.filter_pages(session, **filters)
+        Opportunity.filter(session, page=context.rng.randint(1, max(pages, 1)), **filters)
+
+@scenario
+def facet_counts(context: Context) -> None:
+    with context.session_factory() as session:
+        Opportunity.facets(session, **random_filter(context, session))
+
+@scenario
+def listing_serialization(context: Context) -> None:
+    with context.session_factory() as session:
+        opportunities = Opportunity.filter(session, providers=[], tags=[], geotags=[],
+                                           page=context.rng.randint(1, 10))
+        for opportunity in opportunities:
+            opportunity.get_dict()
+            for card in opportunity.cards:
+                card.get_dict()
+
+@scenario
+def feed_listing(context: Context) -> None:
+    with context.session_factory() as session:
+        [card.get_dict() for card in PublicCardFeed.page(session, context.rng.randint(1, 10))]
+
+@scenario
+def login(context: Context) -> None:
+    email, password = context.rng.choice(context.catalog.credentials)
+    with context.session_factory() as session:
+        User.login(session, ser.User.Credentials(email=email, password=password))
+
+@scenario
+def api_key_lookup(context: Context) -> None:
+    with context.session_factory() as session:
+        APIKey.get(session, context.rng.choice(context.catalog.api_keys))
+
+@scenario
+def form_validation(context: Context) -> None:
+    form = OpportunityForm.objects(id=context.rng.choice(context.catalog.form_ids)).first()
+    data = generate_response_data(context.rng, form, valid=context.rng.random() < 0.8)
+    list(ResponseData.process_data(form, data, {}))
+
+@scenario
+def description_read(context: Context) -> None:
+    with context.session_factory() as session:
+        session.get(Opportunity, context.rng.choice(context.catalog.opportunity_ids)) \
+            .get_description(context.minio_client)
+
+@scenario
+def avatar_read(context: Context) -> None:
+    with context.session_factory() as session:
+        session.get(UserInfo, context.rng.choice(context.catalog.user_ids)).get_avatar(context.minio_client)
+
+@scenario
+def avatar_thumbnail_read(context: Context) -> None:
+    with context.session_factory() as session:
+        session.get(UserInfo, context.rng.choice(context.catalog.user_ids)).get_avatar(context.minio_client, size=40)
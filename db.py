@@ -14,7 +14,21 @@ from .models.opportunity.opportunity import (
     OpportunityToTag, OpportunityToGeotag, OpportunityCard, OpportunityResponse,
 )
 from .models.opportunity.form import OpportunityForm
+from .models.opportunity.search import OpportunitySearchDocument
+from .models.opportunity.feed import PublicCardFeed
+from .models.opportunity.stats import ResponseStats
+from .models.opportunity.delivery import DeliveryQueue
+from .models.opportunity.partitions import ResponsePartitions
+from .models.autocomplete import Autocomplete
+from .models.changes import EntityChange
+from .models.snapshot import CatalogSnapshot
+from .models.notifications import ChangeNotifications
+from .models.blobs import Blob
+from .models.purge import Purge
+from .models.ratelimit import RateLimiter
+from .models.coalesce import SingleFlight
 
+from .observability import instrument, tracer, trace_postgres, trace_mongo, TracedMinio, serve_metrics
 from . import config as cfg
 
 def get_pg_engine(user: str, password: str, host: str, port: int, db_name: str):
@@ -35,6 +49,17 @@ pg_engine = get_pg_engine(
     port=cfg.PG_PORT,
     db_name=cfg.PG_DB_NAME,
 )
+# query instrumentation is opt-in, see 'observability/queries.py'
+if getattr(cfg, 'PG_INSTRUMENTATION', False):
+    instrument(pg_engine, slow_query_threshold=getattr(cfg, 'PG_SLOW_QUERY_THRESHOLD', 0.2))
+# latency tracing of all stores is opt-in as well, see 'observability/tracing.py'
+if getattr(cfg, 'TRACING', False):
+    tracer.sample_rate = getattr(cfg, 'TRACING_SAMPLE_RATE', tracer.sample_rate)
+    trace_postgres(pg_engine)
+    trace_mongo()
+    tracer.add_collector(SingleFlight.render_prometheus)
+    if (metrics_port := getattr(cfg, 'METRICS_PORT', None)) is not None:
+        serve_metrics(metrics_port)
 connect_mongo_db(
     user=cfg.MONGO_USERNAME,
     password=cfg.MONGO_PASSWORD,
@@ -49,5 +74,37 @@ minio_client = get_minio_client(
     host=cfg.MINIO_HOST,
     port=cfg.MINIO_PORT,
 )
+if getattr(cfg, 'TRACING', False):
+    minio_client = TracedMinio(minio_client)
+# client is set even if blobs are disabled, so that blobs stored earlier are still removed when released
+Blob.configure(minio_client, enabled=getattr(cfg, 'CONTENT_ADDRESSED_BLOBS', False))
 
 Session = sessionmaker(bind=pg_engine)
+
+# concurrent identical listings and object reads wait at most this long for the call they are coalesced with
+SingleFlight.TIMEOUT = getattr(cfg, 'SINGLE_FLIGHT_TIMEOUT', SingleFlight.TIMEOUT)
+
+# form changes are published even if this process doesn't listen for changes itself
+ChangeNotifications.configure(pg_engine)
+if getattr(cfg, 'CHANGE_NOTIFICATIONS', False):
+    ChangeNotifications.POLL_INTERVAL = getattr(cfg, 'CHANGE_POLL_INTERVAL', ChangeNotifications.POLL_INTERVAL)
+    ChangeNotifications.start()
+
+# responses are forwarded to form submit methods only by processes with delivery workers
+DeliveryQueue.configure(pg_engine)
+if (delivery_workers := getattr(cfg, 'DELIVERY_WORKERS', 0)) > 0:
+    DeliveryQueue.WORKERS = delivery_workers
+    DeliveryQueue.PER_DESTINATION = getattr(cfg, 'DELIVERY_PER_DESTINATION', DeliveryQueue.PER_DESTINATION)
+    DeliveryQueue.start()
+
+# limits are enforced by callers of 'RateLimiter.acquire', usage is written in batches by a flusher thread
+if getattr(cfg, 'RATE_LIMITING', False):
+    RateLimiter.configure(pg_engine, shared=getattr(cfg, 'RATE_LIMITING_SHARED', False))
+    RateLimiter.start()
+
+# partitions of responses are created ahead by one maintenance thread per process, serialized in the database
+if getattr(cfg, 'RESPONSE_PARTITION_MAINTENANCE', True):
+    ResponsePartitions.RETENTION = getattr(cfg, 'RESPONSE_RETENTION_MONTHS', ResponsePartitions.RETENTION)
+    ResponsePartitions.ARCHIVE_TABLESPACE = getattr(cfg, 'RESPONSE_ARCHIVE_TABLESPACE',
+                                                    ResponsePartitions.ARCHIVE_TABLESPACE)
+    ResponsePartitions.start(pg_engine)
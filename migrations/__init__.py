@@ -0,0 +1,9 @@
+from .migration import (
+    SchemaMigration, Operations, Migration, Migrator,
+    MissingForeignKeyIndex, missing_fk_indexes,
+)
+from .versions import MIGRATIONS
+
+
+def migrate(engine) -> list[Migration]:
+    return Migrator(engine, MIGRATIONS).migrate()
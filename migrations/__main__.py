@@ -0,0 +1,13 @@
+import logging
+
+from . import migrate, missing_fk_indexes
+from ..db import pg_engine
+
+logging.basicConfig(level=logging.INFO)
+
+for migration in migrate(pg_engine):
+    print(f'Applied {migration}')
+if len(report := missing_fk_indexes(pg_engine)) > 0:
+    print('Foreign keys without index:')
+    for missing in report:
+        print(f'  {missing}')
@@ -0,0 +1,188 @@
+from typing import Callable, Iterable
+from dataclasses import dataclass, field
+from datetime import datetime, UTC
+import re
+import time
+
+from sqlalchemy import (
+    Engine, Connection, Column, Index, Table, MetaData, PrimaryKeyConstraint, UniqueConstraint,
+    select, text, inspect,
+)
+from sqlalchemy.dialects.postgresql import TIMESTAMP
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+from ..models.base import *
+
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migration'
+
+    version: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(100))
+    applied_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True))
+
+
+class Operations:
+    """Schema operations available to migrations. All of them are idempotent, so a migration
+       interrupted in the middle can be safely applied again."""
+
+    def __init__(self, connection: Connection) -> None:
+        self.connection = connection
+
+    def execute(self, statement: str) -> None:
+        self.connection.execute(text(statement))
+
+    def create_extension(self, name: str) -> None:
+        self.execute(f'CREATE EXTENSION IF NOT EXISTS {name}')
+
+    def create_tables(self, tables: Iterable[Table]) -> None:
+        Base.metadata.create_all(self.connection, tables=list(tables), checkfirst=True)
+
+    def add_column(self, column: Column) -> None:
+        """Add column of a model table. Column must be nullable or have a constant server default,
+           otherwise the whole table is rewritten under an exclusive lock."""
+
+        spec = CreateColumn(column).compile(dialect=self.connection.dialect)
+        self.execute(f'ALTER TABLE {column.table.name} ADD COLUMN IF NOT EXISTS {spec}')
+
+    def create_index(self, index: Index, concurrently: bool = True) -> None:
+        """Create index of a model table. Concurrent builds don't block writes, but they can't be run inside
+           of a transaction, so migrations using them must be declared as non-transactional. Partitioned
+           tables don't support concurrent builds, their indexes are always built in place."""
+
+        # failed concurrent build leaves invalid index behind, 'IF NOT EXISTS' would silently skip it
+        if self.is_invalid_index(index.name):
+            self.execute(f'DROP INDEX {"CONCURRENTLY " if concurrently else ""}IF EXISTS {index.name}')
+        elif self.exists(index.name):
+            return
+        ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=self.connection.dialect))
+        if concurrently and self.relkind(index.table.name) != 'p':
+            ddl = re.sub(r'^CREATE (UNIQUE )?INDEX', r'CREATE \1INDEX CONCURRENTLY', ddl)
+        self.execute(ddl)
+
+    def exists(self, name: str) -> bool:
+        return self.connection.execute(text('SELECT to_regclass(:name) IS NOT NULL'), {'name': name}).scalar()
+
+    def relkind(self, name: str) -> str | None:
+        statement = text('SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)')
+        return self.connection.execute(statement, {'name': name}).scalar()
+
+    def is_invalid_index(self, name: str) -> bool:
+        statement = text('SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)')
+        return bool(self.connection.execute(statement, {'name': name}).scalar())
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    upgrade: Callable[[Operations], None]
+    # Non-transactional migrations run in autocommit mode, they are required for concurrent index builds
+    transactional: bool = True
+
+    def __str__(self) -> str:
+        return f'{self.version:04}_{self.name}'
+
+
+@dataclass
+class MissingForeignKeyIndex:
+    table: str
+    columns: tuple[str, ...]
+    referred_table: str
+
+    def __str__(self) -> str:
+        return f'{self.table}({", ".join(self.columns)}) -> {self.referred_table}'
+
+
+def missing_fk_indexes(source: Engine | MetaData) -> list[MissingForeignKeyIndex]:
+    """Find foreign keys, which columns aren't leading columns of any index, primary key or unique constraint.
+       Given an engine, the live database is inspected, given metadata - declared models are."""
+
+    report: list[MissingForeignKeyIndex] = []
+    if isinstance(source, MetaData):
+        for table in source.sorted_tables:
+            indexed: list[tuple[str, ...]] = [tuple(column.name for column in index.columns) for index in table.indexes]
+            indexed += [tuple(column.name for column in constraint.columns) for constraint in table.constraints
+                        if isinstance(constraint, (PrimaryKeyConstraint, UniqueConstraint))]
+            for fk in table.foreign_key_constraints:
+                columns = tuple(column.name for column in fk.columns)
+                if not any(index[:len(columns)] == columns for index in indexed):
+                    report.append(MissingForeignKeyIndex(table.name, columns, fk.referred_table.name))
+        return report
+    inspector = inspect(source)
+    for table in inspector.get_table_names():
+        indexed = [tuple(index['column_names']) for index in inspector.get_indexes(table)]
+        indexed += [tuple(constraint['column_names']) for constraint in inspector.get_unique_constraints(table)]
+        indexed.append(tuple(inspector.get_pk_constraint(table)['constrained_columns']))
+        for fk in inspector.get_foreign_keys(table):
+            columns = tuple(fk['constrained_columns'])
+            if not any(index[:len(columns)] == columns for index in indexed):
+                report.append(MissingForeignKeyIndex(table, columns, fk['referred_table']))
+    return report
+
+
+@dataclass
+class Migrator:
+    """Applies pending migrations in order of their versions. Concurrent runs are serialized
+       with an advisory lock, so it's safe to run migrator on startup of every instance."""
+
+    engine: Engine
+    migrations: list[Migration] = field(default_factory=list)
+
+    # Arbitrary key of advisory lock held while migrations are applied
+    ADVISORY_LOCK_KEY: int = 0x6f66666572
+    # DDL waiting for a lock longer than this is cancelled and retried, so that it doesn't block
+    # queries queued behind it
+    LOCK_TIMEOUT: str = '5s'
+    LOCK_RETRIES: int = 10
+
+    def applied_versions(self, connection: Connection) -> set[int]:
+        return set(connection.execute(select(SchemaMigration.version)).scalars())
+
+    def pending(self) -> list[Migration]:
+        with self.engine.connect() as connection:
+            SchemaMigration.__table__.create(connection, checkfirst=True)
+            connection.commit()
+            applied = self.applied_versions(connection)
+        return [migration for migration in sorted(self.migrations, key=lambda m: m.version)
+                if migration.version not in applied]
+
+    def apply(self, migration: Migration) -> None:
+        for attempt in range(1, self.LOCK_RETRIES + 1):
+            try:
+                if migration.transactional:
+                    with self.engine.begin() as connection:
+                        connection.execute(text(f"SET LOCAL lock_timeout = '{self.LOCK_TIMEOUT}'"))
+                        migration.upgrade(Operations(connection))
+                        self.record(connection, migration)
+                else:
+                    with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                        connection.execute(text(f"SET lock_timeout = '{self.LOCK_TIMEOUT}'"))
+                        migration.upgrade(Operations(connection))
+                        self.record(connection, migration)
+                return
+            except OperationalError as error:
+                if 'lock timeout' not in str(error) or attempt == self.LOCK_RETRIES:
+                    raise
+                logger.warning('Migration %s hit lock timeout, retrying (attempt=%i)', migration, attempt)
+                time.sleep(attempt)
+
+    def record(self, connection: Connection, migration: Migration) -> None:
+        connection.execute(SchemaMigration.__table__.insert().values(
+            version=migration.version, name=migration.name, applied_at=datetime.now(UTC)
+        ))
+
+    def migrate(self) -> list[Migration]:
+        """Apply all pending migrations and return them."""
+
+        with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as lock_connection:
+            lock_connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': self.ADVISORY_LOCK_KEY})
+            try:
+                pending = self.pending()
+                for migration in pending:
+                    logger.info('Applying migration %s', migration)
+                    self.apply(migration)
+            finally:
+                lock_connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': self.ADVISORY_LOCK_KEY})
+        return pending
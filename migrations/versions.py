@@ -0,0 +1,199 @@
+from sqlalchemy import Column, Index, text
+
+from .migration import Migration, Operations
+
+from ..models.base import Base
+from ..models.auxillary.address import City
+from ..models.user import CV, UserInfo
+from ..models.blobs import Blob
+from ..models.purge import PurgeJob
+from ..models.ratelimit import APIKeyLimit, APIKeyUsage, APIKeyBucket
+from ..models.opportunity.opportunity import (
+    Opportunity, OpportunityProvider, OpportunityCard, OpportunityResponse, OpportunityToTag, OpportunityToGeotag,
+)
+from ..models.changes import EntityChange
+from ..models.opportunity.feed import PublicCardFeed
+from ..models.opportunity.delivery import ResponseDelivery
+from ..models.opportunity.partitions import ResponsePartitions
+from ..models.opportunity.archive import ArchivedOpportunity, ArchivedOpportunityCard
+from ..models.opportunity.similar import SimilarOpportunity, SimilarityRefresh
+from ..models.opportunity.stats import (
+    OpportunityResponseCounter, ProviderResponseCounter, OpportunityResponseDaily, ProviderResponseDaily,
+    ResponseStats,
+)
+
+
+def get_index(table_or_column, name: str | None = None) -> Index:
+    """Return index of a model table by name, or index created for a column declared with 'index=True'."""
+
+    if isinstance(table_or_column, Column):
+        return next(index for index in table_or_column.table.indexes if list(index.columns) == [table_or_column])
+    return next(index for index in table_or_column.indexes if index.name == name)
+
+
+# Every migration must be idempotent: 'initial' creates missing tables according to current models,
+# so on a fresh database all following migrations find their changes already applied.
+
+def initial(ops: Operations) -> None:
+    ops.create_extension('cube')
+    ops.create_extension('earthdistance')
+    ops.create_tables(Base.metadata.sorted_tables)
+
+def city_location(ops: Operations) -> None:
+    ops.add_column(City.__table__.c.latitude)
+    ops.add_column(City.__table__.c.longitude)
+    ops.create_index(get_index(City.__table__, 'ix_city_location'))
+
+def foreign_key_indexes(ops: Operations) -> None:
+    for column in (
+        City.__table__.c.country_id,
+        CV.__table__.c.user_info_id,
+        Opportunity.__table__.c.provider_id,
+        OpportunityCard.__table__.c.opportunity_id,
+        OpportunityResponse.__table__.c.user_id,
+        OpportunityResponse.__table__.c.opportunity_id,
+        OpportunityToTag.__table__.c.tag_id,
+        OpportunityToGeotag.__table__.c.geotag_id,
+    ):
+        ops.create_index(get_index(column))
+
+def public_card_feed(ops: Operations) -> None:
+    ops.create_tables([PublicCardFeed.__table__])
+    PublicCardFeed.rebuild(ops.connection)
+
+def response_stats(ops: Operations) -> None:
+    # creation time of existing responses isn't known anywhere (response documents got submit times later),
+    # so they are left undated instead of being dated to the day of migration
+    ops.execute('ALTER TABLE opportunity_response ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE')
+    ops.execute('ALTER TABLE opportunity_response ALTER COLUMN created_at SET DEFAULT now()')
+    ops.create_tables(model.__table__ for model in (
+        OpportunityResponseCounter, ProviderResponseCounter, OpportunityResponseDaily, ProviderResponseDaily,
+    ))
+    ResponseStats.rebuild(ops.connection)
+
+def entity_change(ops: Operations) -> None:
+    ops.create_tables([EntityChange.__table__])
+
+def description_encoding(ops: Operations) -> None:
+    # existing descriptions stay uncompressed until 'Opportunity.compress_description' is called
+    ops.add_column(Opportunity.__table__.c.description_encoding)
+
+def image_thumbnails(ops: Operations) -> None:
+    # existing images are served at original size until uploaded again
+    ops.add_column(UserInfo.__table__.c.has_avatar_thumbnails)
+    ops.add_column(OpportunityProvider.__table__.c.has_logo_thumbnails)
+
+def blobs(ops: Operations) -> None:
+    ops.create_tables([Blob.__table__])
+    ops.add_column(CV.__table__.c.blob_digest)
+    ops.add_column(UserInfo.__table__.c.avatar_digest)
+
+def purge_job(ops: Operations) -> None:
+    ops.create_tables([PurgeJob.__table__])
+
+def response_delivery(ops: Operations) -> None:
+    ops.create_tables([ResponseDelivery.__table__])
+
+def api_key_limits(ops: Operations) -> None:
+    ops.create_tables([APIKeyLimit.__table__, APIKeyUsage.__table__, APIKeyBucket.__table__])
+
+def partition_responses(ops: Operations) -> None:
+    # partitioned table has no unique constraint on id alone, that could be referenced
+    ops.execute('ALTER TABLE response_delivery DROP CONSTRAINT IF EXISTS response_delivery_response_id_fkey')
+    table = OpportunityResponse.__table__
+    if ResponsePartitions.is_partitioned(ops.connection):
+        ResponsePartitions.ensure(ops.connection)
+        return
+    # the whole table is copied under an exclusive lock, responses can't be created meanwhile
+    old = f'{table.name}_unpartitioned'
+    ops.execute(f'ALTER TABLE {table.name} RENAME TO {old}')
+    ops.execute(f'ALTER SEQUENCE {table.name}_id_seq RENAME TO {old}_id_seq')
+    for name in [f'{table.name}_pkey', *(index.name for index in table.indexes)]:
+        ops.execute(f'ALTER INDEX IF EXISTS {name} RENAME TO {name.replace(table.name, old, 1)}')
+    ops.create_tables([table])
+    # partition key can't be null, undated responses get a partition of their own
+    undated = ops.connection.execute(text(
+        f'UPDATE {old} SET created_at = :undated WHERE created_at IS NULL'
+    ), {'undated': OpportunityResponse.UNDATED}).rowcount
+    if undated > 0:
+        ResponsePartitions.create(ops.connection, OpportunityResponse.UNDATED.date())
+    since = ops.connection.execute(text(
+        f'SELECT min(created_at) FROM {old} WHERE created_at > :undated'
+    ), {'undated': OpportunityResponse.UNDATED}).scalar()
+    ResponsePartitions.ensure(ops.connection, since.date() if since is not None else None)
+    columns = ', '.join(column.name for column in table.columns)
+    ops.execute(f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old}')
+    ops.execute(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f'coalesce((SELECT max(id) FROM {table.name}), 0) + 1, false)')
+    ops.execute(f'DROP TABLE {old}')
+
+def opportunity_archive(ops: Operations) -> None:
+    # responses keep referring to opportunities moved to archive
+    ops.execute('ALTER TABLE opportunity_response DROP CONSTRAINT IF EXISTS opportunity_response_opportunity_id_fkey')
+    table = Opportunity.__table__
+    table.c.status.type.create(ops.connection, checkfirst=True)
+    for column in (table.c.status, table.c.deadline, table.c.closed_at):
+        ops.add_column(column)
+    ops.create_index(get_index(table, 'ix_opportunity_active_provider_id'))
+    ops.create_tables([ArchivedOpportunity.__table__, ArchivedOpportunityCard.__table__])
+
+def unique_city_names(ops: Operations) -> None:
+    if ops.connection.execute(text(
+        "SELECT 1 FROM pg_constraint WHERE conname = 'uq_city_country_id_name'"
+    )).scalar() is not None:
+        return
+    # of cities with the same name in a country the one with a geotag is kept, then the oldest one
+    ops.execute(
+        'CREATE TEMPORARY TABLE city_duplicate ON COMMIT DROP AS'
+        ' SELECT id, first_value(id) OVER (PARTITION BY country_id, name ORDER BY'
+        ' EXISTS (SELECT FROM opportunity_geotag WHERE opportunity_geotag.city_id = city.id) DESC, id) AS keeper_id'
+        ' FROM city'
+    )
+    ops.execute('DELETE FROM city_duplicate WHERE id = keeper_id')
+    retagged = ops.connection.execute(text(
+        'SELECT DISTINCT link.opportunity_id FROM opportunity_to_geotag link'
+        ' JOIN opportunity_geotag geotag ON geotag.id = link.geotag_id'
+        ' JOIN city_duplicate ON city_duplicate.id = geotag.city_id'
+    )).scalars().all()
+    # opportunities tagged with geotags of removed cities are tagged with the geotag of the kept one
+    ops.execute(
+        'INSERT INTO opportunity_to_geotag (opportunity_id, geotag_id)'
+        ' SELECT link.opportunity_id, keeper.id FROM opportunity_to_geotag link'
+        ' JOIN opportunity_geotag geotag ON geotag.id = link.geotag_id'
+        ' JOIN city_duplicate ON city_duplicate.id = geotag.city_id'
+        ' JOIN opportunity_geotag keeper ON keeper.city_id = city_duplicate.keeper_id'
+        ' ON CONFLICT DO NOTHING'
+    )
+    ops.execute(
+        'DELETE FROM opportunity_to_geotag USING opportunity_geotag, city_duplicate'
+        ' WHERE opportunity_geotag.id = opportunity_to_geotag.geotag_id'
+        ' AND city_duplicate.id = opportunity_geotag.city_id'
+    )
+    ops.execute('DELETE FROM opportunity_geotag USING city_duplicate'
+                ' WHERE city_duplicate.id = opportunity_geotag.city_id')
+    ops.execute('DELETE FROM city USING city_duplicate WHERE city_duplicate.id = city.id')
+    PublicCardFeed.refresh(ops.connection, retagged)
+    ops.execute('ALTER TABLE city ADD CONSTRAINT uq_city_country_id_name UNIQUE (country_id, name)')
+
+def similar_opportunities(ops: Operations) -> None:
+    ops.create_tables([SimilarOpportunity.__table__, SimilarityRefresh.__table__])
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, 'initial', initial),
+    Migration(2, 'city_location', city_location, transactional=False),
+    Migration(3, 'foreign_key_indexes', foreign_key_indexes, transactional=False),
+    Migration(4, 'public_card_feed', public_card_feed),
+    Migration(5, 'response_stats', response_stats),
+    Migration(6, 'entity_change', entity_change),
+    Migration(7, 'description_encoding', description_encoding),
+    Migration(8, 'image_thumbnails', image_thumbnails),
+    Migration(9, 'blobs', blobs),
+    Migration(10, 'purge_job', purge_job),
+    Migration(11, 'response_delivery', response_delivery),
+    Migration(12, 'api_key_limits', api_key_limits),
+    Migration(13, 'partition_responses', partition_responses),
+    Migration(14, 'opportunity_archive', opportunity_archive, transactional=False),
+    Migration(15, 'unique_city_names', unique_city_names),
+    Migration(16, 'similar_opportunities', similar_opportunities),
+]
@@ -5,3 +5,18 @@ from .user import (
 )
 from .opportunity import *
 from .auxillary import *
+from .autocomplete import AutocompleteIndex, Autocomplete
+from .payloads import (
+    OpportunityPayload, CardPayload, UserInfoPayload, FragmentCache, Payloads,
+)
+from .changes import EntityChange
+from .snapshot import (
+    ProviderRecord, TagRecord, GeotagRecord, OpportunityRecord, write_snapshot, CatalogSnapshot,
+)
+from .notifications import ChangeNotifications
+from .blobs import Blob
+from .purge import PurgeKind, PurgeStage, PurgeJob, Purge
+from .ratelimit import (
+    RateLimit, APIKeyLimit, APIKeyUsage, APIKeyBucket, RateLimitErrorCode, key_identity, RateLimiter,
+)
+from .coalesce import SingleFlight
@@ -0,0 +1,219 @@
+from typing import Iterable
+from bisect import bisect_left, insort
+from collections import defaultdict
+from heapq import nsmallest
+from threading import Lock
+import re
+
+from sqlalchemy import event
+
+from .base import *
+from .auxillary.address import City
+from .opportunity.opportunity import OpportunityProvider, OpportunityTag
+
+
+def normalize(text: str) -> str:
+    return ' '.join(re.findall(r'\w+', text.casefold()))
+
+def trigrams(word: str) -> set[str]:
+    """Trigrams of a word padded only at the beginning, so that query trigrams are also trigrams
+       of any word the query is a prefix of."""
+
+    padded = f'  {word}'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def prefix_distance(query: str, word: str, max_distance: int) -> int:
+    """Minimal edit distance between query and any prefix of given word, or max_distance + 1
+       if it's bigger than max_distance."""
+
+    previous = list(range(len(word) + 1))
+    for i, query_char in enumerate(query, start=1):
+        current = [i]
+        for j, word_char in enumerate(word, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (query_char != word_char)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous)
+
+
+class AutocompleteIndex:
+    """In-memory index of names, that ranks prefix matches first and typo-tolerant matches after them.
+       Prefix lookup is a binary search over sorted distinct words, typo-tolerant lookup narrows
+       candidate words down with trigram index and then checks them with bounded edit distance.
+       Results are cached until the next change of the index."""
+
+    # Queries shorter than this are matched by prefix only
+    MIN_FUZZY_LENGTH: int = 3
+    # The maximum amount of cached query results
+    CACHE_SIZE: int = 4096
+
+    def __init__(self) -> None:
+        self.labels: dict[str, str] = {}
+        self.names: dict[str, str] = {}
+        self.word_ids: defaultdict[str, set[str]] = defaultdict(set)
+        self.sorted_words: list[str] = []
+        self.trigrams: defaultdict[str, set[str]] = defaultdict(set)
+        self.cache: dict[tuple[str, int], list[tuple[str, str]]] = {}
+        self.lock = Lock()
+
+    def build(self, items: Iterable[tuple[str, str, str | None]]) -> None:
+        """Replace index contents with given (id, name, label) triples."""
+
+        with self.lock:
+            self.labels, self.names, self.word_ids, self.trigrams = {}, {}, defaultdict(set), defaultdict(set)
+            for id, name, label in items:
+                self._add(id, name, label)
+            self.sorted_words = sorted(self.word_ids)
+            self.cache = {}
+
+    def add(self, id: str, name: str, label: str | None = None) -> None:
+        with self.lock:
+            if id in self.names:
+                self._remove(id)
+            for word in self._add(id, name, label):
+                if len(self.word_ids[word]) == 1:
+                    insort(self.sorted_words, word)
+            self.cache = {}
+
+    def remove(self, id: str) -> None:
+        with self.lock:
+            if id in self.names:
+                self._remove(id)
+            self.cache = {}
+
+    def _add(self, id: str, name: str, label: str | None) -> set[str]:
+        name = normalize(name)
+        self.names[id] = name
+        self.labels[id] = label if label is not None else name
+        words = set(name.split())
+        for word in words:
+            if len(self.word_ids[word]) == 0:
+                for trigram in trigrams(word):
+                    self.trigrams[trigram].add(word)
+            self.word_ids[word].add(id)
+        return words
+
+    def _remove(self, id: str) -> None:
+        name = self.names.pop(id)
+        del self.labels[id]
+        for word in set(name.split()):
+            self.word_ids[word].discard(id)
+            if len(self.word_ids[word]) > 0:
+                continue
+            del self.word_ids[word]
+            self.sorted_words.pop(bisect_left(self.sorted_words, word))
+            for trigram in trigrams(word):
+                self.trigrams[trigram].discard(word)
+
+    def prefix_matches(self, prefix: str) -> set[str]:
+        matches: set[str] = set()
+        i = bisect_left(self.sorted_words, prefix)
+        while i < len(self.sorted_words) and self.sorted_words[i].startswith(prefix):
+            matches |= self.word_ids[self.sorted_words[i]]
+            i += 1
+        return matches
+
+    def fuzzy_matches(self, prefix: str) -> dict[str, int]:
+        max_distance = 1 if len(prefix) < 6 else 2
+        query_trigrams = trigrams(prefix)
+        hits: defaultdict[str, int] = defaultdict(int)
+        for trigram in query_trigrams:
+            for word in self.trigrams.get(trigram, ()):
+                hits[word] += 1
+        # every edit destroys at most 3 trigrams of the query
+        threshold = max(1, len(query_trigrams) - 3 * max_distance)
+        matches: dict[str, int] = {}
+        for word, count in hits.items():
+            if count < threshold or (distance := prefix_distance(prefix, word, max_distance)) > max_distance:
+                continue
+            for id in self.word_ids[word]:
+                matches[id] = min(distance, matches.get(id, distance))
+        return matches
+
+    def complete(self, query: str, k: int = 10) -> list[tuple[str, str]]:
+        """Return top k (id, label) pairs matching given query. Every word of the query must match
+           some word of the name: all but the last one completely, the last one by prefix."""
+
+        words = normalize(query).split()
+        if len(words) == 0:
+            return []
+        with self.lock:
+            if (cached := self.cache.get((' '.join(words), k))) is not None:
+                return cached
+            *complete_words, last_word = words
+            candidates: set[str] | None = None
+            for word in complete_words:
+                ids = self.word_ids.get(word, set())
+                candidates = ids if candidates is None else candidates & ids
+            # (is fuzzy, edit distance, name doesn't start with query, name length, name)
+            ranked: dict[str, tuple[bool, int, bool, int, str]] = {}
+            for id in self.prefix_matches(last_word):
+                if candidates is None or id in candidates:
+                    name = self.names[id]
+                    ranked[id] = (False, 0, not name.startswith(' '.join(words)), len(name), name)
+            if len(ranked) < k and len(last_word) >= self.MIN_FUZZY_LENGTH:
+                for id, distance in self.fuzzy_matches(last_word).items():
+                    if id not in ranked and (candidates is None or id in candidates):
+                        name = self.names[id]
+                        ranked[id] = (True, distance, True, len(name), name)
+            result = [(id, self.labels[id]) for id in nsmallest(k, ranked, key=ranked.__getitem__)]
+            if len(self.cache) >= self.CACHE_SIZE:
+                self.cache.clear()
+            self.cache[(' '.join(words), k)] = result
+            return result
+
+
+class Autocomplete:
+    """Process-wide autocomplete over tags, providers and cities. Indexes are loaded with 'load'
+       and kept up to date with objects created by committed sessions of this process."""
+
+    tags = AutocompleteIndex()
+    providers = AutocompleteIndex()
+    cities = AutocompleteIndex()
+
+    @classmethod
+    def index_entry(cls, instance: Base) -> tuple[AutocompleteIndex, tuple[str, str, str]] | None:
+        match instance:
+            case OpportunityTag():
+                return cls.tags, (str(instance.id), instance.name, instance.name)
+            case OpportunityProvider():
+                return cls.providers, (str(instance.id), instance.name, instance.name)
+            case City():
+                return cls.cities, (str(instance.id), instance.name, instance.full)
+        return None
+
+    @classmethod
+    def load(cls, session: Session) -> None:
+        cls.tags.build(cls.index_entry(tag)[1] for tag in session.query(OpportunityTag).all())
+        cls.providers.build(cls.index_entry(provider)[1] for provider in session.query(OpportunityProvider).all())
+        cls.cities.build(cls.index_entry(city)[1] for city in session.query(City).all())
+
+    @classmethod
+    def complete_tags(cls, query: str, k: int = 10) -> list[tuple[str, str]]:
+        return cls.tags.complete(query, k)
+
+    @classmethod
+    def complete_providers(cls, query: str, k: int = 10) -> list[tuple[str, str]]:
+        return cls.providers.complete(query, k)
+
+    @classmethod
+    def complete_cities(cls, query: str, k: int = 10) -> list[tuple[str, str]]:
+        return cls.cities.complete(query, k)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_autocomplete_entries(session: Session, _flush_context) -> None:
+    pending = session.info.setdefault('autocomplete_entries', [])
+    for instance in session.new | session.dirty:
+        if (entry := Autocomplete.index_entry(instance)) is not None:
+            pending.append(entry)
+
+@event.listens_for(Session, 'after_commit')
+def _apply_autocomplete_entries(session: Session) -> None:
+    for index, (id, name, label) in session.info.pop('autocomplete_entries', []):
+        index.add(id, name, label)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_autocomplete_entries(session: Session, _previous_transaction) -> None:
+    session.info.pop('autocomplete_entries', None)
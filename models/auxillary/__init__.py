@@ -1,3 +1,7 @@
 from .address import (
-    CreateCountryErrorCode, Country, City,
+    CreateCountryErrorCode, Country, CreateCityErrorCode, City,
+    ProximityErrorCode, Proximity,
+)
+from .gazetteer import (
+    GazetteerCountry, GazetteerCity, parse_countries, parse_cities, GazetteerLoader, CityEntry, Gazetteer,
 )
@@ -1,5 +1,7 @@
 from typing import Self
 
+from sqlalchemy import Index, UniqueConstraint, DDL, ColumnElement, event, func
+
 from ...utils import *
 from ...models.base import *
 from ... import serializers as ser
@@ -32,21 +34,87 @@ class Country(Base):
         return country
 
 
+class CreateCityErrorCode(IntEnum):
+    NON_UNIQUE_NAME = 0
+
 class City(Base):
     __tablename__ = 'city'
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    country_id: Mapped[int] = mapped_column(ForeignKey('country.id'))
+    country_id: Mapped[int] = mapped_column(ForeignKey('country.id'), index=True)
     name: Mapped[str] = mapped_column(String(50))
+    latitude: Mapped[float | None] = mapped_column(nullable=True, default=None)
+    longitude: Mapped[float | None] = mapped_column(nullable=True, default=None)
 
     country: Mapped['Country'] = relationship(back_populates='cities')
 
+    __table_args__ = (
+        Index('ix_city_location', func.ll_to_earth(latitude, longitude), postgresql_using='gist'),
+        UniqueConstraint('country_id', 'name', name='uq_city_country_id_name'),
+    )
+
     @classmethod
-    def create(cls, session: Session, country: Country, fields: ser.City) -> Self:
-        city = City(country=country, name=fields.name)
+    def create(cls, session: Session, country: Country, fields: ser.City) -> Self | GenericError[CreateCityErrorCode]:
+        city = session.query(City).filter(City.country == country, City.name == fields.name).first()
+        if city is not None:
+            logger.debug('\'City.create\' exited with \'NON_UNIQUE_NAME\' error (country_id=%i, name=\'%s\')',
+                         country.id, fields.name)
+            return GenericError(
+                error_code=CreateCityErrorCode.NON_UNIQUE_NAME,
+                error_message='City with given name already exists in given country'
+            )
+        city = City(country=country, name=fields.name, latitude=fields.latitude, longitude=fields.longitude)
         session.add(city)
         return city
 
     @property
     def full(self) -> str:
+        from .gazetteer import Gazetteer
+
+        if (full := Gazetteer.full(self.id)) is not None:
+            return full
         return f'{self.country.name}, {self.name}'
+
+    @property
+    def has_location(self) -> bool:
+        return self.latitude is not None and self.longitude is not None
+
+
+# 'ix_city_location' and distance computations rely on 'earthdistance' extension
+event.listen(Base.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS cube; CREATE EXTENSION IF NOT EXISTS earthdistance')
+                .execute_if(dialect='postgresql'))
+
+
+class ProximityErrorCode(IntEnum):
+    NO_CITY_LOCATION = 0
+
+@dataclass
+class Proximity:
+    """Area within given radius (in kilometers) around given point."""
+
+    latitude: float
+    longitude: float
+    radius: float
+
+    @classmethod
+    def around_city(cls, city: City, radius: float) -> Self | GenericError[ProximityErrorCode]:
+        if not city.has_location:
+            logger.debug('\'Proximity.around_city\' exited with \'NO_CITY_LOCATION\' error (city_id=%i)', city.id)
+            return GenericError(
+                error_code=ProximityErrorCode.NO_CITY_LOCATION,
+                error_message='Given city has no coordinates',
+            )
+        return Proximity(latitude=city.latitude, longitude=city.longitude, radius=radius)
+
+    def distance_to_city(self) -> ColumnElement[float]:
+        """Great-circle distance in meters between center of the area and a city."""
+
+        return func.earth_distance(func.ll_to_earth(self.latitude, self.longitude),
+                                   func.ll_to_earth(City.latitude, City.longitude))
+
+    def contains_city(self) -> ColumnElement[bool]:
+        center = func.ll_to_earth(self.latitude, self.longitude)
+        # 'earth_box' is a bounding cube of the area, it is checked first because it can use 'ix_city_location'
+        return func.earth_box(center, self.radius * 1000).bool_op('@>')(func.ll_to_earth(City.latitude, City.longitude)) \
+            & (self.distance_to_city() <= self.radius * 1000)
@@ -0,0 +1,229 @@
+from typing import Iterable, Iterator, NamedTuple, TextIO
+from threading import Lock
+
+from sqlalchemy import Connection, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from ...models.base import *
+from .address import Country, City
+
+
+# Column positions in GeoNames dumps, see https://download.geonames.org/export/dump/readme.txt
+_COUNTRY_ISO, _COUNTRY_NAME, _COUNTRY_PHONE = 0, 4, 12
+_CITY_NAME, _CITY_LATITUDE, _CITY_LONGITUDE, _CITY_CLASS, _CITY_COUNTRY, _CITY_POPULATION = 1, 4, 5, 6, 8, 14
+# Feature class of populated places, 'allCountries.txt' lists mountains, rivers, etc. as well
+_POPULATED_PLACE = 'P'
+
+
+class GazetteerCountry(NamedTuple):
+    iso: str
+    name: str
+    phone_code: str
+    flag: str
+
+class GazetteerCity(NamedTuple):
+    country_iso: str
+    name: str
+    latitude: float
+    longitude: float
+    population: int
+
+
+def flag(iso: str) -> str:
+    """Flag emoji of a country, made of regional indicator symbols of its ISO 3166 code."""
+
+    return ''.join(chr(0x1F1E6 + ord(letter) - ord('A')) for letter in iso.upper())
+
+def _rows(lines: Iterable[str]) -> Iterator[list[str]]:
+    for line in lines:
+        if line.startswith('#') or not line.strip():
+            continue
+        yield line.rstrip('\r\n').split('\t')
+
+def parse_countries(lines: Iterable[str]) -> Iterator[GazetteerCountry]:
+    """Countries of GeoNames 'countryInfo.txt'."""
+
+    for row in _rows(lines):
+        # phone codes like '+1-809' are shortened to the country calling code
+        phone_code = row[_COUNTRY_PHONE].lstrip('+').split('-')[0].split(' ')[0][:3]
+        yield GazetteerCountry(row[_COUNTRY_ISO], row[_COUNTRY_NAME][:50], phone_code, flag(row[_COUNTRY_ISO]))
+
+def parse_cities(lines: Iterable[str], min_population: int = 0) -> Iterator[GazetteerCity]:
+    """Cities of GeoNames 'cities*.txt' and 'allCountries.txt' dumps (populated places only)."""
+
+    for row in _rows(lines):
+        if row[_CITY_CLASS] != _POPULATED_PLACE:
+            continue
+        population = int(row[_CITY_POPULATION] or 0)
+        if population < min_population:
+            continue
+        yield GazetteerCity(row[_CITY_COUNTRY], row[_CITY_NAME][:50], float(row[_CITY_LATITUDE]),
+                            float(row[_CITY_LONGITUDE]), population)
+
+
+class GazetteerLoader:
+    """Bulk import of countries and cities. Cities are streamed to a temporary table with COPY
+       and inserted with one statement, skipping ones, that already exist, so import can be repeated.
+       Imported rows aren't logged as changes, process-wide indexes must be reloaded afterwards."""
+
+    @staticmethod
+    def load_countries(connection: Connection, countries: Iterable[GazetteerCountry]) -> dict[str, int]:
+        """Insert missing countries and return ids of all given ones by their ISO codes."""
+
+        countries = list(countries)
+        if len(countries) > 0:
+            connection.execute(insert(Country).values([
+                {'name': country.name, 'phone_code': country.phone_code, 'flag': country.flag}
+                for country in countries
+            ]).on_conflict_do_nothing(index_elements=[Country.name]))
+        ids = dict(connection.execute(
+            select(Country.name, Country.id).where(Country.name.in_([country.name for country in countries]))
+        ).all())
+        return {country.iso: ids[country.name] for country in countries}
+
+    @staticmethod
+    def load_cities(connection: Connection, cities: Iterable[GazetteerCity], country_ids: dict[str, int]) -> int:
+        """Insert cities of known countries, that don't exist yet. Duplicate names within a country are
+           skipped, the first one is kept (GeoNames lists bigger places first). Returns amount of inserted cities."""
+
+        connection.execute(text(
+            'CREATE TEMPORARY TABLE city_import'
+            ' (country_id integer, name varchar(50), latitude double precision, longitude double precision)'
+            ' ON COMMIT DROP'
+        ))
+        seen: set[tuple[int, str]] = set()
+        with connection.connection.cursor() as cursor:
+            with cursor.copy('COPY city_import (country_id, name, latitude, longitude) FROM STDIN') as copy:
+                for city in cities:
+                    if (country_id := country_ids.get(city.country_iso)) is None:
+                        continue
+                    if (key := (country_id, city.name)) in seen:
+                        continue
+                    seen.add(key)
+                    copy.write_row((country_id, city.name, city.latitude, city.longitude))
+        return connection.execute(text(
+            'INSERT INTO city (country_id, name, latitude, longitude)'
+            ' SELECT country_id, name, latitude, longitude FROM city_import'
+            ' ON CONFLICT (country_id, name) DO NOTHING'
+        )).rowcount
+
+    @classmethod
+    def load(cls, connection: Connection, countries: TextIO, cities: TextIO, min_population: int = 0) -> int:
+        """Import GeoNames dumps given as open text files. Returns amount of inserted cities."""
+
+        country_ids = cls.load_countries(connection, parse_countries(countries))
+        return cls.load_cities(connection, parse_cities(cities, min_population), country_ids)
+
+
+class CityEntry(NamedTuple):
+    id: int
+    country_id: int
+    name: str
+    latitude: float | None
+    longitude: float | None
+
+class Gazetteer:
+    """Process-wide in-memory index of countries, cities and geotags, so that names are resolved without
+       queries on the request path. Loaded by 'load', kept up to date by change notifications, so it isn't loaded
+       unless they are started. Until it's loaded, models fall back to relationships."""
+
+    loaded: bool = False
+    countries: dict[int, str] = {}
+    cities: dict[int, CityEntry] = {}
+    # (country id, casefolded name) -> city id
+    city_ids: dict[tuple[int, str], int] = {}
+    # casefolded name -> country id
+    country_ids: dict[str, int] = {}
+    # geotag id -> city id
+    geotags: dict[int, int] = {}
+    lock = Lock()
+
+    @classmethod
+    def load(cls, session: Session) -> bool:
+        """Read the whole index. Returns whether it was loaded."""
+
+        from ..notifications import ChangeNotifications
+        from ..opportunity.opportunity import OpportunityGeotag
+
+        if ChangeNotifications.thread is None:
+            # nothing would update the index, new and renamed geotags would never show up
+            logger.warning('Change notifications aren\'t started, gazetteer isn\'t loaded')
+            return False
+        countries = dict(session.execute(select(Country.id, Country.name)).all())
+        cities = {row.id: CityEntry(*row) for row in session.execute(
+            select(City.id, City.country_id, City.name, City.latitude, City.longitude))}
+        geotags = dict(session.execute(select(OpportunityGeotag.id, OpportunityGeotag.city_id)).all())
+        with cls.lock:
+            cls.countries, cls.cities, cls.geotags = countries, cities, geotags
+            cls.country_ids = {name.casefold(): id for id, name in countries.items()}
+            cls.city_ids = {(city.country_id, city.name.casefold()): city.id for city in cities.values()}
+            cls.loaded = True
+        return True
+
+    @classmethod
+    def reload(cls, session: Session, country_ids: Iterable[int] = (), city_ids: Iterable[int] = (),
+               geotag_ids: Iterable[int] = ()) -> None:
+        """Re-read given entities, removing deleted ones."""
+
+        from ..opportunity.opportunity import OpportunityGeotag
+
+        country_ids, city_ids, geotag_ids = set(country_ids), set(city_ids), set(geotag_ids)
+        countries = dict(session.execute(select(Country.id, Country.name).where(Country.id.in_(country_ids))).all())
+        cities = {row.id: CityEntry(*row) for row in session.execute(
+            select(City.id, City.country_id, City.name, City.latitude, City.longitude).where(City.id.in_(city_ids)))}
+        geotags = dict(session.execute(
+            select(OpportunityGeotag.id, OpportunityGeotag.city_id).where(OpportunityGeotag.id.in_(geotag_ids))
+        ).all())
+        with cls.lock:
+            for id in country_ids:
+                if (name := cls.countries.pop(id, None)) is not None:
+                    cls.country_ids.pop(name.casefold(), None)
+                if id in countries:
+                    cls.countries[id] = countries[id]
+                    cls.country_ids[countries[id].casefold()] = id
+            for id in city_ids:
+                if (city := cls.cities.pop(id, None)) is not None:
+                    cls.city_ids.pop((city.country_id, city.name.casefold()), None)
+                if (city := cities.get(id)) is not None:
+                    cls.cities[id] = city
+                    cls.city_ids[(city.country_id, city.name.casefold())] = id
+            for id in geotag_ids:
+                cls.geotags.pop(id, None)
+                if id in geotags:
+                    cls.geotags[id] = geotags[id]
+
+    @classmethod
+    def city(cls, city_id: int) -> CityEntry | None:
+        return cls.cities.get(city_id)
+
+    @classmethod
+    def find_city(cls, country: int | str, name: str) -> CityEntry | None:
+        """City by name in a country given by id or name, case-insensitive."""
+
+        country_id = country if isinstance(country, int) else cls.country_ids.get(country.casefold())
+        city_id = cls.city_ids.get((country_id, name.casefold()))
+        return cls.cities.get(city_id) if city_id is not None else None
+
+    @classmethod
+    def full(cls, city_id: int) -> str | None:
+        if (city := cls.cities.get(city_id)) is None or (country := cls.countries.get(city.country_id)) is None:
+            return None
+        return f'{country}, {city.name}'
+
+    @classmethod
+    def city_name(cls, geotag: 'OpportunityGeotag') -> str:
+        """Name of the city of an 'OpportunityGeotag', loaded from the database if it isn't indexed."""
+
+        if (city := cls.cities.get(geotag.city_id)) is not None:
+            return city.name
+        return geotag.city.name
+
+    @classmethod
+    def get_geotags(cls) -> dict[str, tuple[str, str]]:
+        """Same as 'OpportunityGeotag.get_all'."""
+
+        with cls.lock:
+            geotags = list(cls.geotags.items())
+        return {str(geotag_id): (country, city.name) for geotag_id, city_id in geotags
+                if (city := cls.cities.get(city_id)) is not None
+                and (country := cls.countries.get(city.country_id)) is not None}
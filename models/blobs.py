@@ -0,0 +1,147 @@
+from typing import BinaryIO, Callable, ClassVar, Iterable
+from datetime import datetime
+from hashlib import sha256
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+
+from minio import Minio
+from sqlalchemy import BigInteger, select, func, delete, update, tuple_, event
+from sqlalchemy.dialects.postgresql import JSONB, TIMESTAMP, insert
+
+from .base import *
+from .images import read_object
+
+
+# Called with content of a new blob, returns (name suffix, content, content type) of objects derived from it
+Derive = Callable[[bytes], Iterable[tuple[str, bytes, str]]]
+
+class Blob(Base):
+    """Content-addressed object in MinIO, shared by all references to the same content. Objects are named
+       by SHA-256 of their content and never change, so they can be cached forever downstream. Object is
+       uploaded only by the reference, that brings reference count to 1, and removed after the last
+       reference is released."""
+
+    __tablename__ = 'blob'
+
+    bucket: Mapped[str] = mapped_column(String(63), primary_key=True)
+    digest: Mapped[str] = mapped_column(String(64), primary_key=True)
+    size: Mapped[int] = mapped_column(BigInteger)
+    content_type: Mapped[str] = mapped_column(String(100))
+    ref_count: Mapped[int]
+    # name suffixes of derived objects (e.g. thumbnails) stored next to the blob
+    suffixes: Mapped[list[str]] = mapped_column(JSONB, default=list)
+    updated_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now(),
+                                                 onupdate=func.now())
+
+    # Whether new files are stored as blobs and client used to remove released ones, see 'configure'
+    enabled: ClassVar[bool] = False
+    minio_client: ClassVar[Minio | None] = None
+    CHUNK_SIZE: ClassVar[int] = 1024 * 1024
+    # Files up to this size are hashed in memory, bigger ones are spooled to disk
+    SPOOL_SIZE: ClassVar[int] = 8 * 1024 * 1024
+    CACHE_CONTROL: ClassVar[str] = 'public, max-age=31536000, immutable'
+
+    @classmethod
+    def configure(cls, minio_client: Minio, enabled: bool = True) -> None:
+        cls.minio_client = minio_client
+        cls.enabled = enabled
+
+    @staticmethod
+    def object_name(digest: str) -> str:
+        return f'sha256/{digest[:2]}/{digest}'
+
+    @classmethod
+    def store(cls, session: Session, minio_client: Minio, bucket: str, stream: BinaryIO,
+              content_type: str, derive: Derive | None = None) -> str:
+        """Add a reference to blob with content of given stream and return its digest. Content is hashed
+           while it's read, and uploaded only if there is no live blob with the same digest."""
+
+        hash = sha256()
+        size = 0
+        with SpooledTemporaryFile(max_size=cls.SPOOL_SIZE) as spool:
+            while chunk := stream.read(cls.CHUNK_SIZE):
+                hash.update(chunk)
+                spool.write(chunk)
+                size += len(chunk)
+            digest = hash.hexdigest()
+            statement = insert(cls).values(bucket=bucket, digest=digest, size=size, content_type=content_type,
+                                           ref_count=1, suffixes=[])
+            statement = statement.on_conflict_do_update(
+                index_elements=[cls.bucket, cls.digest],
+                set_={'ref_count': cls.ref_count + 1, 'updated_at': func.now()},
+            ).returning(cls.ref_count)
+            # row stays locked until commit, so concurrent uploads of the same content wait for this one
+            if session.execute(statement).scalar_one() > 1:
+                return digest
+            spool.seek(0)
+            minio_client.put_object(bucket, cls.object_name(digest), spool, size, content_type=content_type,
+                                    metadata={'Cache-Control': cls.CACHE_CONTROL})
+            if derive is not None:
+                spool.seek(0)
+                suffixes = []
+                for suffix, content, derived_content_type in derive(spool.read()):
+                    minio_client.put_object(bucket, f'{cls.object_name(digest)}{suffix}', BytesIO(content),
+                                            len(content), content_type=derived_content_type,
+                                            metadata={'Cache-Control': cls.CACHE_CONTROL})
+                    suffixes.append(suffix)
+                session.execute(update(cls).where(cls.bucket == bucket, cls.digest == digest)
+                                .values(suffixes=suffixes))
+        return digest
+
+    @classmethod
+    def release(cls, session: Session, bucket: str, digest: str) -> None:
+        """Remove a reference to blob. Object itself is removed after the transaction commits, if it was
+           the last reference."""
+
+        ref_count = session.execute(
+            update(cls).where(cls.bucket == bucket, cls.digest == digest)
+                .values(ref_count=cls.ref_count - 1)
+                .returning(cls.ref_count)
+        ).scalar_one_or_none()
+        if ref_count == 0:
+            session.info.setdefault('released_blobs', set()).add((bucket, digest))
+
+    @classmethod
+    def has_suffix(cls, session: Session, bucket: str, digest: str, suffix: str) -> bool:
+        suffixes = session.execute(select(cls.suffixes).where(cls.bucket == bucket, cls.digest == digest)) \
+            .scalar_one_or_none()
+        return suffixes is not None and suffix in suffixes
+
+    @classmethod
+    def collect_garbage(cls, session: Session, minio_client: Minio,
+                        blobs: Iterable[tuple[str, str]] | None = None, limit: int = 1000) -> int:
+        """Remove unreferenced blobs (only given ones, if passed) and return their amount. Objects are removed
+           while rows are locked, so a concurrent upload of the same content waits and uploads it again."""
+
+        statement = select(cls.bucket, cls.digest, cls.suffixes).where(cls.ref_count <= 0)
+        if blobs is not None:
+            if len(blobs := list(blobs)) == 0:
+                return 0
+            statement = statement.where(tuple_(cls.bucket, cls.digest).in_(blobs))
+        rows = session.execute(statement.limit(limit).with_for_update(skip_locked=True)).all()
+        for bucket, digest, suffixes in rows:
+            for suffix in ['', *suffixes]:
+                minio_client.remove_object(bucket, f'{cls.object_name(digest)}{suffix}')
+            session.execute(delete(cls).where(cls.bucket == bucket, cls.digest == digest))
+        return len(rows)
+
+    @classmethod
+    def read(cls, minio_client: Minio, bucket: str, digest: str, suffix: str = '') -> bytes:
+        return read_object(minio_client, bucket, f'{cls.object_name(digest)}{suffix}')
+
+
+@event.listens_for(Session, 'after_commit')
+def _collect_released_blobs(session: Session) -> None:
+    released = session.info.pop('released_blobs', None)
+    if not released or Blob.minio_client is None:
+        # left for periodic 'Blob.collect_garbage'
+        return
+    try:
+        with Session(session.bind) as gc_session, gc_session.begin():
+            Blob.collect_garbage(gc_session, Blob.minio_client, released)
+    except Exception:
+        logger.exception('Failed to remove released blobs, they are left for garbage collection')
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_released_blobs(session: Session, _previous_transaction) -> None:
+    session.info.pop('released_blobs', None)
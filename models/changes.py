@@ -0,0 +1,81 @@
+from typing import Any, Callable, Self
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Connection, select, func, event
+from sqlalchemy.dialects.postgresql import TIMESTAMP
+
+from .base import *
+
+
+class EntityChange(Base):
+    """Append-only log of changes of tracked entities, written in the same flush as the changes themselves.
+       Sequence numbers are assigned at flush, not at commit, so readers should re-read a window of
+       recent changes ('LOOKBACK') to catch transactions, that committed out of order."""
+
+    __tablename__ = 'entity_change'
+
+    seq: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    entity: Mapped[str] = mapped_column(String(50))
+    entity_id: Mapped[str] = mapped_column(String(100))
+    changed_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now(), index=True)
+
+    LOOKBACK: int = 1000
+    # Channel notified on commit of every transaction, that logged changes
+    CHANNEL: str = 'entity_change'
+
+    # Tracked models mapped to (entity name, function returning entity id)
+    tracked: dict[type, tuple[str, Callable[[Any], Any]]] = {}
+
+    @classmethod
+    def track(cls, model: type, entity: str | None = None,
+              get_id: Callable[[Any], Any] = lambda instance: instance.id) -> None:
+        cls.tracked[model] = (entity or model.__name__, get_id)
+
+    @classmethod
+    def log(cls, connection: Connection, changes: set[tuple[str, str]]) -> None:
+        if len(changes) == 0:
+            return
+        connection.execute(cls.__table__.insert(), [{'entity': entity, 'entity_id': entity_id}
+                                                    for entity, entity_id in sorted(changes)])
+        # delivered only if the transaction commits, identical notifications of a transaction are merged
+        connection.execute(select(func.pg_notify(cls.CHANNEL, '')))
+
+    @classmethod
+    def last_seq(cls, session: Session) -> int:
+        return session.execute(select(func.coalesce(func.max(cls.seq), 0))).scalar_one()
+
+    @classmethod
+    def since(cls, session: Session, seq: int, limit: int = 10_000) -> list[Self]:
+        statement = select(cls).where(cls.seq > seq).order_by(cls.seq).limit(limit)
+        return session.execute(statement).scalars().all()
+
+    @classmethod
+    def prune(cls, session: Session, before: datetime) -> None:
+        session.execute(cls.__table__.delete().where(cls.changed_at < before))
+
+
+@event.listens_for(Session, 'after_flush')
+def _log_entity_changes(session: Session, _flush_context) -> None:
+    changes: set[tuple[str, str]] = set()
+    for instance in session.new | session.dirty | session.deleted:
+        if (tracking := EntityChange.tracked.get(type(instance))) is None:
+            continue
+        if instance in session.dirty and not session.is_modified(instance):
+            continue
+        entity, get_id = tracking
+        changes.add((entity, str(get_id(instance))))
+    EntityChange.log(session.connection(), changes)
+
+
+from .auxillary.address import Country, City
+from .user import PersonalAPIKey, DeveloperAPIKey, UserInfo
+from .opportunity.opportunity import (
+    Opportunity, OpportunityProvider, OpportunityTag, OpportunityGeotag, OpportunityCard,
+)
+
+for _model in (Country, City, Opportunity, OpportunityProvider, OpportunityTag, OpportunityGeotag, OpportunityCard,
+               DeveloperAPIKey):
+    EntityChange.track(_model)
+# personal keys have composite primary key, but are looked up by key
+EntityChange.track(PersonalAPIKey, get_id=lambda api_key: api_key.key)
+EntityChange.track(UserInfo, get_id=lambda user_info: user_info.user_id)
@@ -0,0 +1,109 @@
+from typing import Awaitable, Callable, Hashable
+from asyncio import AbstractEventLoop, Future, get_running_loop, shield, wait_for
+from threading import Event, Lock
+
+
+class Flight:
+    __slots__ = ('done', 'result', 'failed')
+
+    def __init__(self) -> None:
+        self.done = Event()
+        self.result = None
+        self.failed = False
+
+# result of an asynchronous flight, which leader failed
+_FAILED = object()
+
+
+class SingleFlight:
+    """Coalescing of concurrent identical calls within a process. The first caller with a key runs the call,
+       callers with the same key arriving before it finishes wait up to TIMEOUT seconds for its result
+       instead of repeating it. Waiters, whose leader fails or doesn't finish in time, make the call themselves,
+       so an error of one caller is never shared and waiting is bounded. Results are shared between threads
+       (or tasks), so they must be immutable or safe to share, e.g. ids or bytes, but not ORM instances."""
+
+    TIMEOUT: float = 5
+    instances: list['SingleFlight'] = []
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.flights: dict[Hashable, Flight] = {}
+        # futures are bound to event loops, so asynchronous calls are coalesced per loop
+        self.futures: dict[tuple[AbstractEventLoop, Hashable], Future] = {}
+        self.lock = Lock()
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.failures = 0
+        SingleFlight.instances.append(self)
+
+    def do[T](self, key: Hashable, call: Callable[[], T]) -> T:
+        with self.lock:
+            self.calls += 1
+            if leader := (flight := self.flights.get(key)) is None:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            if not flight.done.wait(self.TIMEOUT):
+                self.count('timeouts')
+                return call()
+            if flight.failed:
+                self.count('failures')
+                return call()
+            self.count('coalesced')
+            return flight.result
+        try:
+            flight.result = call()
+        except BaseException:
+            flight.failed = True
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+    async def do_async[T](self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        loop = get_running_loop()
+        with self.lock:
+            self.calls += 1
+            if leader := (future := self.futures.get((loop, key))) is None:
+                future = self.futures[(loop, key)] = loop.create_future()
+        if not leader:
+            try:
+                # shielded, so that a waiter timing out doesn't cancel the call of its leader
+                result = await wait_for(shield(future), self.TIMEOUT)
+            except TimeoutError:
+                self.count('timeouts')
+                return await call()
+            if result is _FAILED:
+                self.count('failures')
+                return await call()
+            self.count('coalesced')
+            return result
+        result = _FAILED
+        try:
+            result = await call()
+        finally:
+            with self.lock:
+                del self.futures[(loop, key)]
+            future.set_result(result)
+        return result
+
+    def count(self, counter: str) -> None:
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @classmethod
+    def render_prometheus(cls) -> str:
+        """Render counters of all instances in Prometheus text exposition format."""
+
+        lines = []
+        for counter, description in (('calls', 'Calls made through single-flight groups.'),
+                                     ('coalesced', 'Calls, that received the result of a concurrent identical call.'),
+                                     ('timeouts', 'Calls, that stopped waiting for a concurrent identical call.'),
+                                     ('failures', 'Calls, that were repeated after a concurrent identical call failed.')):
+            lines += [f'# HELP offer_single_flight_{counter}_total {description}',
+                      f'# TYPE offer_single_flight_{counter}_total counter']
+            lines += [f'offer_single_flight_{counter}_total{{group="{instance.name}"}} {getattr(instance, counter)}'
+                      for instance in cls.instances]
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,91 @@
+from io import BytesIO
+
+from minio import Minio
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from .base import *
+from .coalesce import SingleFlight
+
+
+class ThumbnailFormat(Enum):
+    PNG = ('png', 'image/png')
+    WEBP = ('webp', 'image/webp')
+
+# Sizes (in pixels, of the longer side) of thumbnails generated on upload, ascending
+THUMBNAIL_SIZES: tuple[int, ...] = (64, 128, 512)
+WEBP_QUALITY: int = 80
+# Images with more pixels aren't decoded, so that an upload can't exhaust memory
+MAX_IMAGE_PIXELS: int = 40_000_000
+
+
+def thumbnail_size(size: int | None) -> int | None:
+    """Smallest thumbnail size fitting requested size, or None if original image should be used."""
+
+    if size is None:
+        return None
+    return next((thumbnail_size for thumbnail_size in THUMBNAIL_SIZES if thumbnail_size >= size), None)
+
+def thumbnail_filename(stem: str, size: int, format: ThumbnailFormat) -> str:
+    return f'{stem}.{size}.{format.value[0]}'
+
+def make_thumbnails(image_data: bytes) -> list[tuple[int, ThumbnailFormat, bytes]]:
+    """Downscaled and recompressed copies of an image of every thumbnail size and format.
+       Returns no thumbnails if Pillow isn't installed, image can't be decoded or is too large."""
+
+    if Image is None:
+        logger.warning('Pillow isn\'t installed, thumbnails are not generated')
+        return []
+    thumbnails = []
+    try:
+        with Image.open(BytesIO(image_data)) as image:
+            # only the header is read by now, dimensions are checked before pixels are decoded
+            if image.width * image.height > MAX_IMAGE_PIXELS:
+                logger.warning('Image is too large for thumbnails (width=%d, height=%d)', image.width, image.height)
+                return []
+            image.load()
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            for size in THUMBNAIL_SIZES:
+                thumbnail = image.copy()
+                thumbnail.thumbnail((size, size), Image.Resampling.LANCZOS)
+                for format in ThumbnailFormat:
+                    output = BytesIO()
+                    if format == ThumbnailFormat.WEBP:
+                        thumbnail.save(output, format='WEBP', quality=WEBP_QUALITY, method=6)
+                    else:
+                        thumbnail.save(output, format='PNG', optimize=True)
+                    thumbnails.append((size, format, output.getvalue()))
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        logger.warning('Can\'t generate thumbnails (error=\'%s\')', error)
+        return []
+    return thumbnails
+
+def put_thumbnails(minio_client: Minio, bucket_name: str, stem: str, image_data: bytes) -> bool:
+    """Upload thumbnails of an image next to the original. Returns whether thumbnails were uploaded."""
+
+    thumbnails = make_thumbnails(image_data)
+    for size, format, data in thumbnails:
+        minio_client.put_object(bucket_name, thumbnail_filename(stem, size, format), BytesIO(data), len(data),
+                                content_type=format.value[1])
+    return len(thumbnails) > 0
+
+# concurrent reads of the same object (e.g. a popular logo) are made once
+object_reads = SingleFlight('object_read')
+
+def read_object(minio_client: Minio, bucket_name: str, filename: str) -> bytes:
+    return object_reads.do((bucket_name, filename), lambda: _read_object(minio_client, bucket_name, filename))
+
+def _read_object(minio_client: Minio, bucket_name: str, filename: str) -> bytes:
+    response = None
+    try:
+        response = minio_client.get_object(bucket_name, filename)
+        data = response.read()
+    finally:
+        if response is not None:
+            response.close()
+            response.release_conn()
+    return data
@@ -0,0 +1,206 @@
+from typing import Callable, Hashable, Iterable
+from collections import defaultdict
+from threading import Event, Lock, Thread
+
+from sqlalchemy import Engine, Connection
+
+from .base import *
+from .changes import EntityChange
+from .autocomplete import AutocompleteIndex, Autocomplete
+from .payloads import Payloads
+from .ratelimit import RateLimiter
+from .auxillary.address import City
+from .auxillary.gazetteer import Gazetteer
+from .opportunity.opportunity import OpportunityProvider, OpportunityTag
+from .opportunity.form import OpportunityForm
+from .opportunity.facets import FacetCache
+
+
+# Called with a session, entity name and ids of changed entities
+Subscriber = Callable[[Session, str, set[str]], None]
+
+class ChangeNotifications:
+    """Process-wide delivery of entity changes made by any worker. Changes are read from 'entity_change' log,
+       a listener thread re-reads it whenever a commit is announced through Postgres LISTEN/NOTIFY and
+       at least every POLL_INTERVAL seconds, so that a missed notification delays delivery, but never loses it.
+       Every delivered change increments version counters of its entity type and of the entity itself."""
+
+    POLL_INTERVAL: float = 5
+    # Subscribers of this entity name receive changes of all entities
+    ALL: str = '*'
+
+    engine: Engine | None = None
+    subscribers: defaultdict[str, list[Subscriber]] = defaultdict(list)
+    versions: defaultdict[Hashable, int] = defaultdict(int)
+    last_seq: int | None = None
+    # Sequence numbers delivered within the lookback window, changes may commit out of sequence order
+    delivered: set[int] = set()
+    lock = Lock()
+    thread: Thread | None = None
+    stopped = Event()
+
+    @classmethod
+    def configure(cls, engine: Engine) -> None:
+        cls.engine = engine
+
+    @classmethod
+    def subscribe(cls, entity: str, subscriber: Subscriber) -> None:
+        cls.subscribers[entity].append(subscriber)
+
+    @classmethod
+    def unsubscribe(cls, entity: str, subscriber: Subscriber) -> None:
+        cls.subscribers[entity].remove(subscriber)
+
+    @classmethod
+    def version(cls, entity: str, entity_id: str | None = None) -> int:
+        """Amount of delivered changes of given entity type, or of given entity if id is passed.
+           Caches can store it alongside a value and compare it on read."""
+
+        return cls.versions[entity if entity_id is None else (entity, str(entity_id))]
+
+    @classmethod
+    def publish(cls, entity: str, entity_ids: Iterable[str]) -> None:
+        """Log changes made outside of Postgres transactions (e.g. to MongoDB documents)."""
+
+        if cls.engine is None:
+            return
+        with cls.engine.begin() as connection:
+            EntityChange.log(connection, {(entity, str(entity_id)) for entity_id in entity_ids})
+
+    @classmethod
+    def poll(cls) -> int:
+        """Deliver changes logged since the last poll. Returns amount of delivered changes."""
+
+        with cls.lock, Session(cls.engine) as session:
+            if cls.last_seq is None:
+                # nothing to invalidate on start, caches are empty
+                cls.last_seq = EntityChange.last_seq(session)
+                return 0
+            changes = [change for change in EntityChange.since(session, max(0, cls.last_seq - EntityChange.LOOKBACK))
+                       if change.seq not in cls.delivered]
+            if len(changes) == 0:
+                return 0
+            changed: defaultdict[str, set[str]] = defaultdict(set)
+            for change in changes:
+                changed[change.entity].add(change.entity_id)
+                cls.delivered.add(change.seq)
+                cls.versions[change.entity] += 1
+                cls.versions[(change.entity, change.entity_id)] += 1
+            cls.last_seq = max(cls.last_seq, changes[-1].seq)
+            cls.delivered = {seq for seq in cls.delivered if seq > cls.last_seq - EntityChange.LOOKBACK}
+            for entity, entity_ids in changed.items():
+                for subscriber in cls.subscribers[entity] + cls.subscribers[cls.ALL]:
+                    try:
+                        subscriber(session, entity, entity_ids)
+                    except Exception:
+                        logger.exception('Change subscriber failed (entity=\'%s\')', entity)
+            return len(changes)
+
+    @classmethod
+    def listen(cls, connection: Connection) -> Callable[[], None]:
+        """Subscribe given connection to change channel and return function waiting for a notification.
+           Falls back to plain sleeping for drivers without notification support."""
+
+        driver_connection = connection.connection.driver_connection
+        if not hasattr(driver_connection, 'notifies'):
+            logger.warning('Database driver doesn\'t support LISTEN, falling back to polling')
+            return lambda: cls.stopped.wait(cls.POLL_INTERVAL)
+        connection.exec_driver_sql(f'LISTEN {EntityChange.CHANNEL}')
+
+        def wait() -> None:
+            for _ in driver_connection.notifies(timeout=cls.POLL_INTERVAL, stop_after=1):
+                pass
+        return wait
+
+    @classmethod
+    def run(cls) -> None:
+        while not cls.stopped.is_set():
+            try:
+                with cls.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                    wait = cls.listen(connection)
+                    while not cls.stopped.is_set():
+                        cls.poll()
+                        wait()
+            except Exception:
+                logger.exception('Change listener failed, reconnecting in %s seconds', cls.POLL_INTERVAL)
+                cls.stopped.wait(cls.POLL_INTERVAL)
+
+    @classmethod
+    def start(cls, engine: Engine | None = None) -> None:
+        if engine is not None:
+            cls.configure(engine)
+        if cls.thread is not None:
+            return
+        cls.stopped.clear()
+        cls.thread = Thread(target=cls.run, name='change-notifications', daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def stop(cls) -> None:
+        if cls.thread is None:
+            return
+        cls.stopped.set()
+        cls.thread.join()
+        cls.thread = None
+
+
+# Process-wide caches kept up to date with changes of other workers
+
+def _invalidate_facets(_session: Session, _entity: str, _entity_ids: set[str]) -> None:
+    FacetCache.invalidate()
+
+for _entity in ('Opportunity', 'OpportunityCard', 'OpportunityProvider', 'OpportunityTag', 'OpportunityGeotag',
+                'City', 'Country'):
+    ChangeNotifications.subscribe(_entity, _invalidate_facets)
+
+_PAYLOAD_KINDS = {
+    'Opportunity': 'opportunity',
+    'OpportunityCard': 'card',
+    'OpportunityProvider': 'provider',
+    'OpportunityTag': 'tag',
+    'OpportunityGeotag': 'geotag',
+    'City': 'city',
+    'UserInfo': 'user_info',
+    'OpportunityForm': 'form',
+}
+
+def _invalidate_payloads(_session: Session, entity: str, entity_ids: set[str]) -> None:
+    Payloads.cache.invalidate((_PAYLOAD_KINDS[entity], int(entity_id)) for entity_id in entity_ids)
+
+for _entity in _PAYLOAD_KINDS:
+    ChangeNotifications.subscribe(_entity, _invalidate_payloads)
+
+# reloaded before autocomplete, which indexes full names of cities
+_GAZETTEER_ENTITIES = {'Country': 'country_ids', 'City': 'city_ids', 'OpportunityGeotag': 'geotag_ids'}
+
+def _reload_gazetteer(session: Session, entity: str, entity_ids: set[str]) -> None:
+    if Gazetteer.loaded:
+        Gazetteer.reload(session, **{_GAZETTEER_ENTITIES[entity]: map(int, entity_ids)})
+
+for _entity in _GAZETTEER_ENTITIES:
+    ChangeNotifications.subscribe(_entity, _reload_gazetteer)
+
+_AUTOCOMPLETE_INDEXES: dict[str, tuple[type, AutocompleteIndex]] = {
+    'OpportunityTag': (OpportunityTag, Autocomplete.tags),
+    'OpportunityProvider': (OpportunityProvider, Autocomplete.providers),
+    'City': (City, Autocomplete.cities),
+}
+
+def _reload_autocomplete(session: Session, entity: str, entity_ids: set[str]) -> None:
+    model, index = _AUTOCOMPLETE_INDEXES[entity]
+    for entity_id in entity_ids:
+        if (instance := session.get(model, int(entity_id))) is None:
+            index.remove(entity_id)
+        else:
+            index.add(*Autocomplete.index_entry(instance)[1])
+
+for _entity in _AUTOCOMPLETE_INDEXES:
+    ChangeNotifications.subscribe(_entity, _reload_autocomplete)
+
+def _invalidate_rate_limits(_session: Session, _entity: str, entity_ids: set[str]) -> None:
+    RateLimiter.invalidate(tuple(map(int, entity_id.split('-'))) for entity_id in entity_ids)
+
+ChangeNotifications.subscribe('APIKeyLimit', _invalidate_rate_limits)
+
+# forms are stored in MongoDB, so their changes are logged separately
+OpportunityForm.change_listeners.append(lambda form_id: ChangeNotifications.publish('OpportunityForm', [form_id]))
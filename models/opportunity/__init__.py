@@ -3,10 +3,39 @@ from .opportunity import (
     CreateOpportunityTagErrorCode, OpportunityTag,
     CreateOpportunityGeotagErrorCode, OpportunityGeotag,
     OpportunityToTag, OpportunityToGeotag,
-    OpportunityCard, OpportunityResponse,
+    OpportunityCard, OpportunityResponse, OpportunityStatus,
 )
 from .form import (
     SubmitMethod, NoopSubmitMethod, YandexFormsSubmitMethod,
     FormField, StringField, RegexField, ChoiceField,
     OpportunityForm, ResponseData,
 )
+from .search import (
+    OpportunitySearchDocument,
+)
+from .feed import (
+    PublicCardFeed,
+)
+from .facets import (
+    Facets, FacetCache, count_facets,
+)
+from .stats import (
+    OpportunityResponseCounter, ProviderResponseCounter,
+    OpportunityResponseDaily, ProviderResponseDaily,
+    ResponseStats,
+)
+from .export import (
+    export_columns, iter_response_batches, write_csv, write_parquet,
+)
+from .archive import (
+    ArchivedOpportunity, ArchivedOpportunityCard, OpportunityArchive,
+)
+from .partitions import (
+    ResponsePartitions,
+)
+from .delivery import (
+    DeliveryStatus, ResponseDelivery, DeliveryQueue,
+)
+from .similar import (
+    SimilarOpportunity, SimilarityRefresh, OpportunityFeatures, SimilarOpportunities,
+)
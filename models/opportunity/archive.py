@@ -0,0 +1,168 @@
+from typing import Any, Self
+from datetime import datetime, timedelta, UTC
+
+from sqlalchemy import select, update, delete, func, cast, literal
+from sqlalchemy.dialects.postgresql import JSONB, TIMESTAMP
+
+from ..base import *
+
+from ..changes import EntityChange
+from ..auxillary.address import City
+from .opportunity import (
+    Opportunity, OpportunityStatus, OpportunityProvider, OpportunityTag, OpportunityGeotag,
+    OpportunityToTag, OpportunityToGeotag, OpportunityCard,
+)
+from .stats import OpportunityResponseCounter
+from .feed import PublicCardFeed
+from .similar import SimilarityRefresh
+
+
+class ArchivedOpportunity(Base):
+    """Closed opportunity moved out of 'opportunity' table with names of its provider, tags and geotags resolved,
+       so that it's shown in response history without joins. Ids are preserved, descriptions and forms
+       are left in place."""
+
+    __tablename__ = 'archived_opportunity'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    name: Mapped[str] = mapped_column(String(100))
+    link: Mapped[str | None] = mapped_column(String(120), nullable=True)
+    provider_id: Mapped[int] = mapped_column(index=True)
+    provider_name: Mapped[str] = mapped_column(String(50))
+    has_description: Mapped[bool]
+    description_encoding: Mapped[str | None] = mapped_column(String(10), nullable=True)
+    has_form: Mapped[bool]
+    tags: Mapped[dict[str, str]] = mapped_column(JSONB)
+    geotags: Mapped[dict[str, str]] = mapped_column(JSONB)
+    response_count: Mapped[int]
+    deadline: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
+    closed_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
+    archived_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
+
+    def get_dict(self) -> dict[str, Any]:
+        return {
+            'id': self.id,
+            'name': self.name,
+            'link': self.link,
+            'provider_id': self.provider_id,
+            'provider_logo_url': OpportunityProvider.get_logo_url(self.provider_id),
+            'provider_name': self.provider_name,
+            'tags': self.tags,
+            'geotags': self.geotags,
+            'archived': True,
+        }
+
+
+class ArchivedOpportunityCard(Base):
+    __tablename__ = 'archived_opportunity_card'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    opportunity_id: Mapped[int] = mapped_column(index=True)
+    title: Mapped[str] = mapped_column(String(100))
+    subtitle: Mapped[str | None] = mapped_column(String(50), nullable=True)
+
+    @classmethod
+    def get_all(cls, session: Session, opportunity_id: int) -> list[Self]:
+        return list(session.scalars(select(cls).where(cls.opportunity_id == opportunity_id).order_by(cls.id)))
+
+
+class OpportunityArchive:
+    """Lifecycle of opportunities: active ones are closed after their deadline, closed ones are moved
+       to archive tables after GRACE, so that listings only scan live rows."""
+
+    GRACE: timedelta = timedelta(days=30)
+    BATCH_SIZE: int = 500
+
+    @classmethod
+    def close_expired(cls, session: Session) -> list[int]:
+        """Close active opportunities past their deadline. Returns ids of closed opportunities."""
+
+        ids = session.execute(
+            update(Opportunity)
+                .where(Opportunity.status == OpportunityStatus.ACTIVE, Opportunity.deadline < func.now())
+                .values(status=OpportunityStatus.CLOSED, closed_at=func.now())
+                .returning(Opportunity.id)
+        ).scalars().all()
+        if len(ids) > 0:
+            # bulk update isn't seen by flush listeners
+            PublicCardFeed.refresh(session.connection(), ids)
+            SimilarityRefresh.queue(session.connection(), ids)
+            EntityChange.log(session.connection(), {('Opportunity', str(id)) for id in ids})
+        return ids
+
+    @classmethod
+    def archive(cls, session: Session, closed_before: datetime | None = None, limit: int | None = None) -> list[int]:
+        """Move opportunities closed before given time (GRACE ago by default) with their cards to archive.
+           Returns ids of archived opportunities."""
+
+        closed_before = closed_before or datetime.now(UTC) - cls.GRACE
+        ids = session.execute(
+            select(Opportunity.id)
+                .where(Opportunity.status == OpportunityStatus.CLOSED, Opportunity.closed_at < closed_before)
+                .order_by(Opportunity.id)
+                .limit(limit or cls.BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+        ).scalars().all()
+        if len(ids) == 0:
+            return []
+        empty = cast(literal('{}'), JSONB)
+        tags = (
+            select(func.coalesce(func.jsonb_object_agg(OpportunityTag.id, OpportunityTag.name), empty))
+                .select_from(OpportunityToTag)
+                .join(OpportunityTag, OpportunityTag.id == OpportunityToTag.tag_id)
+                .where(OpportunityToTag.opportunity_id == Opportunity.id)
+                .scalar_subquery()
+        )
+        geotags = (
+            select(func.coalesce(func.jsonb_object_agg(OpportunityGeotag.id, City.name), empty))
+                .select_from(OpportunityToGeotag)
+                .join(OpportunityGeotag, OpportunityGeotag.id == OpportunityToGeotag.geotag_id)
+                .join(City, City.id == OpportunityGeotag.city_id)
+                .where(OpportunityToGeotag.opportunity_id == Opportunity.id)
+                .scalar_subquery()
+        )
+        session.execute(ArchivedOpportunity.__table__.insert().from_select(
+            ['id', 'name', 'link', 'provider_id', 'provider_name', 'has_description', 'description_encoding',
+             'has_form', 'tags', 'geotags', 'response_count', 'deadline', 'closed_at'],
+            select(Opportunity.id, Opportunity.name, Opportunity.link, Opportunity.provider_id,
+                   OpportunityProvider.name, Opportunity.has_description, Opportunity.description_encoding,
+                   Opportunity.has_form, tags, geotags, func.coalesce(OpportunityResponseCounter.count, 0),
+                   Opportunity.deadline, Opportunity.closed_at)
+                .join(OpportunityProvider, OpportunityProvider.id == Opportunity.provider_id)
+                .outerjoin(OpportunityResponseCounter, OpportunityResponseCounter.opportunity_id == Opportunity.id)
+                .where(Opportunity.id.in_(ids)),
+        ))
+        session.execute(ArchivedOpportunityCard.__table__.insert().from_select(
+            ['id', 'opportunity_id', 'title', 'subtitle'],
+            select(OpportunityCard.id, OpportunityCard.opportunity_id, OpportunityCard.title, OpportunityCard.subtitle)
+                .where(OpportunityCard.opportunity_id.in_(ids)),
+        ))
+        # search documents, feed rows and counters are removed by cascades
+        session.execute(delete(OpportunityToTag).where(OpportunityToTag.opportunity_id.in_(ids)))
+        session.execute(delete(OpportunityToGeotag).where(OpportunityToGeotag.opportunity_id.in_(ids)))
+        card_ids = session.execute(
+            delete(OpportunityCard).where(OpportunityCard.opportunity_id.in_(ids)).returning(OpportunityCard.id)
+        ).scalars().all()
+        session.execute(delete(Opportunity).where(Opportunity.id.in_(ids)))
+        EntityChange.log(session.connection(), {('Opportunity', str(id)) for id in ids}
+                         | {('OpportunityCard', str(id)) for id in card_ids})
+        return ids
+
+    @classmethod
+    def run(cls, session_factory) -> int:
+        """Close expired opportunities and archive all due ones in batches. Returns amount of archived ones."""
+
+        with session_factory.begin() as session:
+            cls.close_expired(session)
+        count = 0
+        while True:
+            with session_factory.begin() as session:
+                if len(ids := cls.archive(session)) == 0:
+                    return count
+            count += len(ids)
+
+    @classmethod
+    def get(cls, session: Session, opportunity_id: int) -> Opportunity | ArchivedOpportunity | None:
+        """Opportunity by id, whether it's live or archived."""
+
+        return session.get(Opportunity, opportunity_id) or session.get(ArchivedOpportunity, opportunity_id)
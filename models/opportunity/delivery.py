@@ -0,0 +1,295 @@
+from typing import Any, Callable, ClassVar, Self
+from datetime import datetime, timedelta, UTC
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Event, RLock, Thread
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlsplit
+from urllib.request import Request, urlopen
+from random import uniform
+
+from sqlalchemy import Engine, Text, Index, select, update, delete, func
+from sqlalchemy.dialects.postgresql import JSONB, TIMESTAMP
+
+from ...utils import *
+from ..base import *
+
+from .opportunity import OpportunityResponse
+
+
+# Called with URL, body, headers and timeout, returns HTTP status code or raises on network errors
+Sender = Callable[[str, bytes, dict[str, str], float], int]
+
+def http_post(url: str, body: bytes, headers: dict[str, str], timeout: float) -> int:
+    try:
+        with urlopen(Request(url, data=body, headers=headers, method='POST'), timeout=timeout) as response:
+            return response.status
+    except HTTPError as error:
+        return error.code
+
+def is_retryable(status: int) -> bool:
+    return status in (408, 425, 429) or status >= 500
+
+
+class DeliveryStatus(IntEnum):
+    PENDING = 0
+    DELIVERED = 1
+    # rejected by destination or out of attempts, kept until requeued
+    DEAD = 2
+
+class ResponseDelivery(Base):
+    """Response forwarded to the submit method of its form. Rows are inserted in the transaction, that creates
+       the response, so only committed responses are forwarded, and at least once."""
+
+    __tablename__ = 'response_delivery'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    # not a foreign key, partitioned 'opportunity_response' has no unique constraint on id alone
+    response_id: Mapped[int] = mapped_column(index=True)
+    url: Mapped[str] = mapped_column(Text)
+    # host of the URL, concurrency is limited per destination
+    destination: Mapped[str] = mapped_column(String(255))
+    payload: Mapped[dict[str, Any]] = mapped_column(JSONB)
+    status: Mapped[DeliveryStatus] = mapped_column(default=DeliveryStatus.PENDING)
+    attempts: Mapped[int] = mapped_column(default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
+    last_error: Mapped[str | None] = mapped_column(Text, nullable=True, default=None)
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
+    delivered_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True), nullable=True, default=None)
+
+    @classmethod
+    def enqueue(cls, session: Session, response: OpportunityResponse, url: str, payload: dict[str, Any]) -> Self:
+        self = ResponseDelivery(response_id=response.id, url=url, destination=urlsplit(url).netloc.lower(),
+                                payload=payload)
+        session.add(self)
+        return self
+
+    @classmethod
+    def dead_letters(cls, session: Session, limit: int = 100) -> list[Self]:
+        return list(session.scalars(
+            select(cls).where(cls.status == DeliveryStatus.DEAD).order_by(cls.id).limit(limit)
+        ))
+
+    @classmethod
+    def requeue(cls, session: Session, ids: list[int] | None = None) -> int:
+        """Retry dead deliveries (only given ones, if passed) from scratch. Returns amount of requeued ones."""
+
+        statement = update(cls).where(cls.status == DeliveryStatus.DEAD)
+        if ids is not None:
+            statement = statement.where(cls.id.in_(ids))
+        return session.execute(
+            statement.values(status=DeliveryStatus.PENDING, attempts=0, next_attempt_at=func.now())
+        ).rowcount
+
+    @classmethod
+    def prune(cls, session: Session, older_than: timedelta) -> int:
+        return session.execute(
+            delete(cls).where(cls.status == DeliveryStatus.DELIVERED,
+                              cls.delivered_at < datetime.now(UTC) - older_than)
+        ).rowcount
+
+# due deliveries are looked up among pending ones only
+Index('ix_response_delivery_pending', ResponseDelivery.next_attempt_at,
+      postgresql_where=ResponseDelivery.status == DeliveryStatus.PENDING)
+
+
+class DeliveryQueue:
+    """Process-wide pool forwarding pending deliveries. A dispatcher thread claims due deliveries in batches,
+       at most PER_DESTINATION of them in flight per destination, and records results of finished ones
+       in one transaction per batch. Failed deliveries are retried with exponential backoff, after
+       MAX_ATTEMPTS attempts or a non-retryable response they are marked dead."""
+
+    WORKERS: ClassVar[int] = 8
+    PER_DESTINATION: ClassVar[int] = 2
+    BATCH_SIZE: ClassVar[int] = 50
+    POLL_INTERVAL: ClassVar[float] = 1
+    TIMEOUT: ClassVar[float] = 10
+    MAX_ATTEMPTS: ClassVar[int] = 8
+    # delay before the first retry, doubled for every next one
+    BACKOFF: ClassVar[float] = 5
+    MAX_BACKOFF: ClassVar[float] = 3600
+    # claimed deliveries are retried after this time, if the worker claiming them dies before recording results
+    LEASE: ClassVar[float] = 300
+
+    engine: ClassVar[Engine | None] = None
+    sender: ClassVar[Sender] = staticmethod(http_post)
+    executor: ClassVar[ThreadPoolExecutor | None] = None
+    in_flight: ClassVar[Counter[str]] = Counter()
+    # guards 'in_flight', which is changed by the dispatcher thread and callers of 'dispatch' or 'flush'
+    lock: ClassVar[RLock] = RLock()
+    # (delivery id, destination, attempts, error or None if delivered, whether error is retryable)
+    results: ClassVar[Queue[tuple[int, str, int, str | None, bool]]] = Queue()
+    thread: ClassVar[Thread | None] = None
+    stopped: ClassVar[Event] = Event()
+
+    @classmethod
+    def configure(cls, engine: Engine, sender: Sender | None = None) -> None:
+        cls.engine = engine
+        if sender is not None:
+            cls.sender = sender
+
+    @classmethod
+    def backoff(cls, attempts: int) -> timedelta:
+        return timedelta(seconds=min(cls.MAX_BACKOFF, cls.BACKOFF * 2 ** (attempts - 1)) * uniform(0.5, 1))
+
+    @classmethod
+    def claim(cls, session: Session, limit: int) -> list[tuple[int, str, str, dict[str, Any], int]]:
+        """Lease up to given amount of due deliveries, respecting per destination limit. Deliveries of responses,
+           that were deleted meanwhile, are marked dead instead. Returns (id, url, destination, payload, attempts)
+           of leased deliveries."""
+
+        saturated = [destination for destination, count in cls.in_flight.items() if count >= cls.PER_DESTINATION]
+        response_exists = select(OpportunityResponse.id).where(
+            OpportunityResponse.id == ResponseDelivery.response_id).exists()
+        candidates = session.execute(
+            select(ResponseDelivery.id, ResponseDelivery.url, ResponseDelivery.destination,
+                   ResponseDelivery.payload, ResponseDelivery.attempts, response_exists)
+                .where(ResponseDelivery.status == DeliveryStatus.PENDING,
+                       ResponseDelivery.next_attempt_at <= func.now(),
+                       ResponseDelivery.destination.not_in(saturated))
+                .order_by(ResponseDelivery.next_attempt_at)
+                .limit(cls.BATCH_SIZE)
+                .with_for_update(of=ResponseDelivery, skip_locked=True)
+        ).all()
+        # there is no foreign key on responses, so deleting them doesn't remove their deliveries
+        if orphaned := [id for id, *_, exists in candidates if not exists]:
+            session.execute(
+                update(ResponseDelivery)
+                    .where(ResponseDelivery.id.in_(orphaned))
+                    .values(status=DeliveryStatus.DEAD, last_error='Response was deleted')
+            )
+        claimed, slots = [], Counter(cls.in_flight)
+        for id, url, destination, payload, attempts, exists in candidates:
+            if not exists:
+                continue
+            if len(claimed) == limit:
+                break
+            if slots[destination] >= cls.PER_DESTINATION:
+                # left unclaimed, its lock is released on commit
+                continue
+            slots[destination] += 1
+            claimed.append((id, url, destination, payload, attempts + 1))
+        if len(claimed) > 0:
+            session.execute(
+                update(ResponseDelivery)
+                    .where(ResponseDelivery.id.in_([id for id, *_ in claimed]))
+                    .values(attempts=ResponseDelivery.attempts + 1,
+                            next_attempt_at=func.now() + timedelta(seconds=cls.LEASE))
+            )
+        return claimed
+
+    @classmethod
+    def send(cls, id: int, url: str, destination: str, payload: dict[str, Any], attempts: int) -> None:
+        error, retryable = None, True
+        try:
+            status = cls.sender(url, urlencode(payload, doseq=True).encode(),
+                                {'Content-Type': 'application/x-www-form-urlencoded'}, cls.TIMEOUT)
+            if not 200 <= status < 300:
+                error, retryable = f'HTTP {status}', is_retryable(status)
+        except Exception as exception:
+            error = f'{type(exception).__name__}: {exception}'
+        cls.results.put((id, destination, attempts, error, retryable))
+
+    @classmethod
+    def record(cls, session: Session, results: list[tuple[int, str, int, str | None, bool]]) -> None:
+        now = datetime.now(UTC)
+        values = []
+        with cls.lock:
+            for _, destination, *_ in results:
+                cls.in_flight[destination] -= 1
+                if cls.in_flight[destination] <= 0:
+                    del cls.in_flight[destination]
+        for id, destination, attempts, error, retryable in results:
+            if error is None:
+                values.append({'id': id, 'status': DeliveryStatus.DELIVERED, 'delivered_at': now,
+                               'last_error': None})
+            elif retryable and attempts < cls.MAX_ATTEMPTS:
+                values.append({'id': id, 'next_attempt_at': now + cls.backoff(attempts), 'last_error': error})
+            else:
+                logger.warning('Response delivery failed (id=%s, destination=\'%s\', error=\'%s\')',
+                               id, destination, error)
+                values.append({'id': id, 'status': DeliveryStatus.DEAD, 'last_error': error})
+        if len(values) > 0:
+            session.execute(update(ResponseDelivery), values)
+
+    @classmethod
+    def drain_results(cls, timeout: float) -> list[tuple[int, str, int, str | None, bool]]:
+        results = []
+        try:
+            results.append(cls.results.get(timeout=timeout))
+            while True:
+                results.append(cls.results.get_nowait())
+        except Empty:
+            return results
+
+    @classmethod
+    def dispatch(cls, timeout: float = 0) -> int:
+        """Record finished deliveries and start due ones. Waits up to given time for a delivery to finish
+           if there is nothing to start. Returns amount of started deliveries."""
+
+        # claiming and counting claimed deliveries in flight is atomic, so that concurrent dispatches
+        # don't exceed limits
+        with cls.lock:
+            if cls.executor is None:
+                cls.executor = ThreadPoolExecutor(max_workers=cls.WORKERS, thread_name_prefix='response-delivery')
+            with Session(cls.engine) as session, session.begin():
+                cls.record(session, cls.drain_results(timeout=0))
+                capacity = cls.WORKERS - cls.in_flight.total()
+                claimed = cls.claim(session, capacity) if capacity > 0 else []
+            for delivery in claimed:
+                cls.in_flight[delivery[2]] += 1
+                cls.executor.submit(cls.send, *delivery)
+        if len(claimed) == 0 and (results := cls.drain_results(timeout=timeout)):
+            with Session(cls.engine) as session, session.begin():
+                cls.record(session, results)
+        return len(claimed)
+
+    @classmethod
+    def pending(cls) -> int:
+        """Amount of deliveries in flight."""
+
+        with cls.lock:
+            return cls.in_flight.total()
+
+    @classmethod
+    def flush(cls) -> None:
+        """Forward all due deliveries and wait until their results are recorded."""
+
+        while cls.dispatch() > 0 or cls.pending() > 0:
+            if cls.pending() > 0 and (results := cls.drain_results(timeout=cls.TIMEOUT)):
+                with Session(cls.engine) as session, session.begin():
+                    cls.record(session, results)
+
+    @classmethod
+    def run(cls) -> None:
+        while not cls.stopped.is_set():
+            try:
+                cls.dispatch(timeout=cls.POLL_INTERVAL)
+            except Exception:
+                logger.exception('Response delivery failed, retrying in %s seconds', cls.POLL_INTERVAL)
+                cls.stopped.wait(cls.POLL_INTERVAL)
+
+    @classmethod
+    def start(cls, engine: Engine | None = None) -> None:
+        if engine is not None:
+            cls.configure(engine)
+        if cls.thread is not None:
+            return
+        cls.stopped.clear()
+        cls.thread = Thread(target=cls.run, name='response-delivery', daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def stop(cls) -> None:
+        if cls.thread is None:
+            return
+        cls.stopped.set()
+        cls.thread.join()
+        cls.thread = None
+        if cls.executor is not None:
+            cls.executor.shutdown(wait=True)
+            cls.executor = None
+        # results of deliveries finished meanwhile, the rest are retried after their lease expires
+        with Session(cls.engine) as session, session.begin():
+            cls.record(session, cls.drain_results(timeout=0))
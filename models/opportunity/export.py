@@ -0,0 +1,96 @@
+from typing import Any, BinaryIO, Iterator, TextIO
+from datetime import datetime
+import csv
+
+from sqlalchemy import select
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from ..base import *
+
+from .opportunity import OpportunityResponse
+from .form import OpportunityForm, ResponseData
+
+
+# Columns preceding form fields in every export
+RESPONSE_COLUMNS: tuple[str, ...] = ('response_id', 'user_id', 'submitted_at')
+BATCH_SIZE: int = 1000
+
+def export_columns(form: OpportunityForm | None) -> list[str]:
+    return [*RESPONSE_COLUMNS, *(form.fields.keys() if form is not None else ())]
+
+def export_value(value: Any) -> str | None:
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return '; '.join(str(item) for item in value)
+    return str(value)
+
+def iter_response_batches(
+    session: Session, opportunity_id: int, form: OpportunityForm | None, batch_size: int = BATCH_SIZE,
+) -> Iterator[list[tuple[int, int, datetime | None, list[str | None]]]]:
+    """Batches of (response id, user id, submit time, form field values) of all responses of an opportunity,
+       in order of response id, undated responses have no submit time. Responses are read from a server-side
+       cursor, their documents are fetched with one query per batch, so memory usage doesn't depend on amount
+       of responses."""
+
+    field_names = list(form.fields.keys()) if form is not None else []
+    rows = session.execute(
+        select(OpportunityResponse.id, OpportunityResponse.user_id, OpportunityResponse.created_at)
+            .where(OpportunityResponse.opportunity_id == opportunity_id)
+            .order_by(OpportunityResponse.id)
+            .execution_options(yield_per=batch_size)
+    )
+    for partition in rows.partitions():
+        documents = {
+            document['_id']: document.get('data', {})
+            for document in ResponseData.objects(id__in=[row.id for row in partition]).only('data').as_pymongo()
+        }
+        yield [
+            (id, user_id, OpportunityResponse.submit_time(created_at),
+             [export_value(documents.get(id, {}).get(name)) for name in field_names])
+            for id, user_id, created_at in partition
+        ]
+
+def write_csv(session: Session, opportunity_id: int, output: TextIO, batch_size: int = BATCH_SIZE) -> int:
+    """Write responses of an opportunity to a text stream as CSV. Returns amount of written responses."""
+
+    form = OpportunityForm.objects(id=opportunity_id).first()
+    writer = csv.writer(output)
+    writer.writerow(export_columns(form))
+    count = 0
+    for batch in iter_response_batches(session, opportunity_id, form, batch_size):
+        writer.writerows((id, user_id, created_at.isoformat() if created_at is not None else None, *values)
+                         for id, user_id, created_at, values in batch)
+        count += len(batch)
+    return count
+
+def write_parquet(session: Session, opportunity_id: int, output: str | BinaryIO,
+                  batch_size: int = BATCH_SIZE) -> int:
+    """Write responses of an opportunity to a file as Parquet, one row group per batch.
+       Returns amount of written responses. Requires pyarrow."""
+
+    if pyarrow is None:
+        raise RuntimeError('pyarrow is required for Parquet export')
+    form = OpportunityForm.objects(id=opportunity_id).first()
+    columns = export_columns(form)
+    schema = pyarrow.schema([
+        ('response_id', pyarrow.int64()),
+        ('user_id', pyarrow.int64()),
+        ('submitted_at', pyarrow.timestamp('us', tz='UTC')),
+        *((name, pyarrow.string()) for name in columns[len(RESPONSE_COLUMNS):]),
+    ])
+    count = 0
+    with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+        for batch in iter_response_batches(session, opportunity_id, form, batch_size):
+            ids, user_ids, submit_times, values = zip(*batch)
+            field_columns = list(zip(*values)) if len(columns) > len(RESPONSE_COLUMNS) else []
+            writer.write_table(pyarrow.table([ids, user_ids, submit_times, *field_columns], schema=schema))
+            count += len(batch)
+        if count == 0:
+            writer.write_table(schema.empty_table())
+    return count
@@ -0,0 +1,167 @@
+from typing import Iterable, Optional, Hashable
+from threading import Lock
+import time
+
+from sqlalchemy import select, func, event
+
+from ..base import *
+
+from .. import user as _user
+from ..auxillary.address import City, Proximity
+from .opportunity import (
+    Opportunity, OpportunityProvider, OpportunityTag, OpportunityGeotag, OpportunityToTag, OpportunityToGeotag,
+    OpportunityCard, OpportunityResponse,
+)
+
+
+@dataclass
+class Facets:
+    total: int
+    providers: dict[str, int]
+    tags: dict[str, int]
+    geotags: dict[str, int]
+
+    def get_dict(self) -> dict[str, int | dict[str, int]]:
+        return {'total': self.total, 'providers': self.providers, 'tags': self.tags, 'geotags': self.geotags}
+
+
+class FacetCache:
+    """Process-wide cache of facet counts keyed by filter signature. Entries expire after TTL seconds,
+       'invalidate' drops all of them at once."""
+
+    TTL: float = 60
+    MAX_SIZE: int = 1024
+
+    entries: dict[Hashable, tuple[float, Facets]] = {}
+    lock = Lock()
+
+    @classmethod
+    def get(cls, key: Hashable) -> Facets | None:
+        with cls.lock:
+            entry = cls.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    @classmethod
+    def put(cls, key: Hashable, facets: Facets) -> None:
+        with cls.lock:
+            if len(cls.entries) >= cls.MAX_SIZE:
+                now = time.monotonic()
+                cls.entries = {key: entry for key, entry in cls.entries.items() if entry[0] >= now}
+                if len(cls.entries) >= cls.MAX_SIZE:
+                    cls.entries.clear()
+            cls.entries[key] = (time.monotonic() + cls.TTL, facets)
+
+    @classmethod
+    def invalidate(cls) -> None:
+        with cls.lock:
+            cls.entries.clear()
+
+    @classmethod
+    def invalidate_users(cls, user_ids: Iterable[int]) -> None:
+        """Drop entries filtered by responses of given users."""
+
+        user_ids = set(user_ids)
+        with cls.lock:
+            cls.entries = {key: entry for key, entry in cls.entries.items() if key[3] not in user_ids}
+
+
+def filter_signature(
+    *, providers: Iterable['OpportunityProvider'],
+    tags: Iterable['OpportunityTag'],
+    geotags: Iterable['OpportunityGeotag'],
+    user: Optional['_user.User'] = None,
+    public: bool = True,
+    near: Optional['Proximity'] = None,
+    active: bool = True,
+) -> Hashable:
+    return (
+        tuple(sorted(provider.id for provider in providers)),
+        tuple(sorted(tag.id for tag in tags)),
+        tuple(sorted(geotag.id for geotag in geotags)),
+        user.id if user is not None else None,
+        public,
+        (near.latitude, near.longitude, near.radius) if near is not None else None,
+        active,
+    )
+
+
+def count_facets(
+    session: Session,
+    *, providers: Iterable['OpportunityProvider'],
+    tags: Iterable['OpportunityTag'],
+    geotags: Iterable['OpportunityGeotag'],
+    user: Optional['_user.User'] = None,
+    public: bool = True,
+    near: Optional['Proximity'] = None,
+    active: bool = True,
+    use_cache: bool = True,
+) -> Facets:
+    """Count opportunities matching given filters (same as in 'Opportunity.filter') grouped by provider,
+       tag and geotag. Providers and geotags are alternatives, so their counts ignore filter of their own
+       kind: they show how many results the filter would give with this value selected. Tags are combined,
+       so tag counts show how many results the filter would give with this tag added."""
+
+    key = filter_signature(providers=providers, tags=tags, geotags=geotags, user=user, public=public, near=near,
+                           active=active)
+    if use_cache and (facets := FacetCache.get(key)) is not None:
+        return facets
+
+    def matching(*, providers=providers, geotags=geotags):
+        return Opportunity.apply_filters_to_statement(select(Opportunity.id), providers=providers, tags=tags,
+                                                      geotags=geotags, user=user, public=public, near=near,
+                                                      active=active)
+
+    total: int = session.execute(
+        select(func.count()).select_from(matching().subquery())
+    ).scalar_one()
+    provider_counts = session.execute(
+        select(Opportunity.provider_id, func.count())
+            .where(Opportunity.id.in_(matching(providers=[])))
+            .group_by(Opportunity.provider_id)
+    ).all()
+    tag_counts = session.execute(
+        select(OpportunityToTag.tag_id, func.count())
+            .where(OpportunityToTag.opportunity_id.in_(matching()))
+            .group_by(OpportunityToTag.tag_id)
+    ).all()
+    geotag_counts = session.execute(
+        select(OpportunityToGeotag.geotag_id, func.count())
+            .where(OpportunityToGeotag.opportunity_id.in_(matching(geotags=[])))
+            .group_by(OpportunityToGeotag.geotag_id)
+    ).all()
+    facets = Facets(
+        total=total,
+        providers={str(id): count for id, count in provider_counts},
+        tags={str(id): count for id, count in tag_counts},
+        geotags={str(id): count for id, count in geotag_counts},
+    )
+    if use_cache:
+        FacetCache.put(key, facets)
+    return facets
+
+
+# changes of other workers are delivered by change notifications, see 'notifications.py'
+_FACET_MODELS = (Opportunity, OpportunityCard, OpportunityProvider, OpportunityTag, OpportunityGeotag, City)
+
+@event.listens_for(Session, 'after_flush')
+def _collect_facet_changes(session: Session, _flush_context) -> None:
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, _FACET_MODELS):
+            session.info['facets_changed'] = True
+        elif isinstance(instance, OpportunityResponse):
+            # responses only change counts filtered by their user
+            session.info.setdefault('facets_changed_users', set()).add(instance.user_id)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_facets(session: Session) -> None:
+    if session.info.pop('facets_changed', False):
+        FacetCache.invalidate()
+    if user_ids := session.info.pop('facets_changed_users', None):
+        FacetCache.invalidate_users(user_ids)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_facet_changes(session: Session, _previous_transaction) -> None:
+    session.info.pop('facets_changed', None)
+    session.info.pop('facets_changed_users', None)
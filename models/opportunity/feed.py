@@ -0,0 +1,144 @@
+from typing import Any, Iterable, Self
+
+from sqlalchemy import Connection, select, delete, func, cast, literal, event, inspect
+from sqlalchemy.dialects.postgresql import JSONB
+
+from ..base import *
+
+from ..auxillary.address import City
+from .opportunity import (
+    Opportunity, OpportunityProvider, OpportunityTag, OpportunityGeotag,
+    OpportunityToTag, OpportunityToGeotag, OpportunityCard, OpportunityStatus,
+)
+
+
+class PublicCardFeed(Base):
+    """Denormalized copy of public opportunity cards with everything needed by 'OpportunityCard.get_dict'
+       already resolved. Rows are rebuilt on every flush, that touches cards, opportunities, providers,
+       tags or geotags they are built from."""
+
+    __tablename__ = 'public_card_feed'
+
+    card_id: Mapped[int] = mapped_column(ForeignKey('opportunity_card.id', ondelete='CASCADE'), primary_key=True)
+    opportunity_id: Mapped[int] = mapped_column(index=True)
+    provider_id: Mapped[int]
+    provider_name: Mapped[str] = mapped_column(String(50))
+    card_title: Mapped[str] = mapped_column(String(100))
+    card_subtitle: Mapped[str | None] = mapped_column(String(50), nullable=True)
+    tags: Mapped[dict[str, str]] = mapped_column(JSONB)
+    geotags: Mapped[dict[str, str]] = mapped_column(JSONB)
+
+    # The maximum amount of cards returned from database in one query
+    PAGE_SIZE: int = 12
+
+    @classmethod
+    def refresh(cls, connection: Connection, opportunity_ids: Iterable[int]) -> None:
+        opportunity_ids = list(opportunity_ids)
+        if len(opportunity_ids) == 0:
+            return
+        empty = cast(literal('{}'), JSONB)
+        tags = (
+            select(func.coalesce(func.jsonb_object_agg(OpportunityTag.id, OpportunityTag.name), empty))
+                .select_from(OpportunityToTag)
+                .join(OpportunityTag, OpportunityTag.id == OpportunityToTag.tag_id)
+                .where(OpportunityToTag.opportunity_id == Opportunity.id)
+                .scalar_subquery()
+        )
+        geotags = (
+            select(func.coalesce(func.jsonb_object_agg(OpportunityGeotag.id, City.name), empty))
+                .select_from(OpportunityToGeotag)
+                .join(OpportunityGeotag, OpportunityGeotag.id == OpportunityToGeotag.geotag_id)
+                .join(City, City.id == OpportunityGeotag.city_id)
+                .where(OpportunityToGeotag.opportunity_id == Opportunity.id)
+                .scalar_subquery()
+        )
+        source = (
+            select(OpportunityCard.id, Opportunity.id, OpportunityProvider.id, OpportunityProvider.name,
+                   OpportunityCard.title, OpportunityCard.subtitle, tags, geotags)
+                .join(Opportunity, Opportunity.id == OpportunityCard.opportunity_id)
+                .join(OpportunityProvider, OpportunityProvider.id == Opportunity.provider_id)
+                .where(OpportunityCard.opportunity_id.in_(opportunity_ids),
+                       Opportunity.status == OpportunityStatus.ACTIVE)
+        )
+        connection.execute(delete(cls).where(cls.opportunity_id.in_(opportunity_ids)))
+        connection.execute(cls.__table__.insert().from_select(
+            ['card_id', 'opportunity_id', 'provider_id', 'provider_name',
+             'card_title', 'card_subtitle', 'tags', 'geotags'], source,
+        ))
+
+    @classmethod
+    def rebuild(cls, connection: Connection) -> None:
+        cls.refresh(connection, connection.execute(select(Opportunity.id)).scalars().all())
+
+    @classmethod
+    def pages(cls, session: Session) -> int:
+        count: int = session.execute(select(func.count()).select_from(cls)).scalars().first()
+        return (count + cls.PAGE_SIZE - 1) // cls.PAGE_SIZE
+
+    @classmethod
+    def page(cls, session: Session, page: int) -> list[Self]:
+        """Return given page of cards, newest first."""
+
+        statement = select(cls).order_by(cls.card_id.desc()).offset((page - 1) * cls.PAGE_SIZE).limit(cls.PAGE_SIZE)
+        return session.execute(statement).scalars().all()
+
+    @classmethod
+    def scroll(cls, session: Session, before_card_id: int | None = None) -> list[Self]:
+        """Return cards, that go after card with given id, newest first. Unlike 'page',
+           cost of this query doesn't depend on how deep into the feed it is."""
+
+        statement = select(cls).order_by(cls.card_id.desc()).limit(cls.PAGE_SIZE)
+        if before_card_id is not None:
+            statement = statement.where(cls.card_id < before_card_id)
+        return session.execute(statement).scalars().all()
+
+    def get_dict(self) -> dict[str, Any]:
+        return {
+            'opportunity_id': self.opportunity_id,
+            'provider_logo_url': OpportunityProvider.get_logo_url(self.provider_id),
+            'provider_name': self.provider_name,
+            'card_title': self.card_title,
+            'card_subtitle': self.card_subtitle,
+            'tags': self.tags,
+            'geotags': self.geotags,
+        }
+
+
+def _has_changes(instance: Base, *attributes: str) -> bool:
+    state = inspect(instance)
+    return any(state.attrs[attribute].history.has_changes() for attribute in attributes)
+
+@event.listens_for(Session, 'after_flush')
+def _refresh_public_card_feed(session: Session, _flush_context) -> None:
+    opportunity_ids: set[int] = set()
+    provider_ids: set[int] = set()
+    tag_ids: set[int] = set()
+    geotag_ids: set[int] = set()
+    city_ids: set[int] = set()
+    for instance in session.new | session.dirty | session.deleted:
+        match instance:
+            case OpportunityCard():
+                opportunity_ids.add(instance.opportunity_id)
+            case Opportunity() if _has_changes(instance, 'provider_id', 'tags', 'geotags', 'status'):
+                opportunity_ids.add(instance.id)
+            case OpportunityProvider() if instance in session.dirty and _has_changes(instance, 'name'):
+                provider_ids.add(instance.id)
+            case OpportunityTag() if instance in session.dirty and _has_changes(instance, 'name', 'opportunities'):
+                tag_ids.add(instance.id)
+            case OpportunityGeotag() if instance in session.dirty and _has_changes(instance, 'city_id', 'opportunities'):
+                geotag_ids.add(instance.id)
+            case City() if instance in session.dirty and _has_changes(instance, 'name'):
+                city_ids.add(instance.id)
+    connection = session.connection()
+    for ids, statement in (
+        (provider_ids, select(Opportunity.id).where(Opportunity.provider_id.in_(provider_ids))),
+        (tag_ids, select(OpportunityToTag.opportunity_id).where(OpportunityToTag.tag_id.in_(tag_ids))),
+        (geotag_ids, select(OpportunityToGeotag.opportunity_id).where(OpportunityToGeotag.geotag_id.in_(geotag_ids))),
+        (city_ids, select(OpportunityToGeotag.opportunity_id)
+            .join(OpportunityGeotag, OpportunityGeotag.id == OpportunityToGeotag.geotag_id)
+            .where(OpportunityGeotag.city_id.in_(city_ids))),
+    ):
+        if len(ids) > 0:
+            opportunity_ids.update(connection.execute(statement).scalars())
+    opportunity_ids.discard(None)
+    PublicCardFeed.refresh(connection, opportunity_ids)
@@ -1,8 +1,11 @@
 from typing import Any, Callable, Generator, Self
+from datetime import datetime, UTC
 from abc import abstractmethod
 import re
 
 import mongoengine as mongo
+from sqlalchemy import select
+from sqlalchemy.orm import Session
 
 from ...utils import *
 from ... import serializers as ser
@@ -11,6 +14,11 @@ from ... import serializers as ser
 class SubmitMethod(mongo.EmbeddedDocument):
     meta = {'allow_inheritance': True, 'abstract': True}
 
+    def delivery_url(self) -> str | None:
+        """URL, that responses are forwarded to by 'ResponseDelivery', or None if they stay here."""
+
+        return None
+
 class NoopSubmitMethod(SubmitMethod):
     @classmethod
     def create(cls, _data: ser.OpportunityForm.NoopSubmitMethod) -> Self:
@@ -27,6 +35,9 @@ class YandexFormsSubmitMethod(SubmitMethod):
     def create(cls, data: ser.OpportunityForm.YandexFormsSubmitMethod) -> Self:
         return YandexFormsSubmitMethod(url=str(data.url))
 
+    def delivery_url(self) -> str | None:
+        return self.url
+
 
 class FieldErrorCode(IntEnum):
     MISSING = 100
@@ -187,13 +198,22 @@ class OpportunityForm(mongo.Document):
         self.save()
         return self
 
+    # Callbacks called with form id after the form is changed
+    change_listeners: list[Callable[[int], None]] = []
+
+    def notify_change(self) -> None:
+        for listener in self.change_listeners:
+            listener(self.id)
+
     def update_submit_method(self, submit: ser.OpportunityForm.SubmitMethod) -> None:
         self.submit_method = self.create_submit_method(submit)
         self.save()
+        self.notify_change()
 
     def update_fields(self, fields: ser.OpportunityForm.Fields) -> None:
         self.fields = self.create_fields(fields)
         self.save()
+        self.notify_change()
 
     def get_dict(self) -> dict[str, Any]:
         return {field_name: field.get_dict() for field_name, field in self.fields.items()}
@@ -201,8 +221,18 @@ class OpportunityForm(mongo.Document):
 
 class ResponseData(mongo.Document):
     id = mongo.IntField(primary_key=True)
+    # copied from response, so that responses of an opportunity can be queried without Postgres
+    opportunity_id = mongo.IntField()
+    submitted_at = mongo.DateTimeField()
     data = mongo.MapField(mongo.DynamicField())
 
+    meta = {
+        'indexes': [
+            ('opportunity_id', 'submitted_at'),
+            'submitted_at',
+        ],
+    }
+
     @classmethod
     def extra_field_error(cls, field_name: str) -> FieldError:
         return GenericError(error_code=FieldErrorCode.EXTRA, error_message='Unexpected field',
@@ -235,9 +265,35 @@ class ResponseData(mongo.Document):
         validated_data: dict[str, Any] = {}
         if len(errors := list(cls.process_data(form, data, validated_data))) > 0:
             return errors
-        self = ResponseData(id=response.id, data=validated_data)
+        self = ResponseData(id=response.id, opportunity_id=response.opportunity_id,
+                            submitted_at=response.created_at or datetime.now(UTC), data=validated_data)
         self.save()
         return self
 
+    @classmethod
+    def backfill(cls, session: Session, batch_size: int = 1000) -> int:
+        """Copy opportunity ids and submit times to documents created before they were stored.
+           Returns amount of updated documents."""
+
+        from pymongo import UpdateOne
+
+        cls.ensure_indexes()
+        Response = _opportunity.OpportunityResponse
+        rows = session.execute(
+            select(Response.id, Response.opportunity_id, Response.created_at)
+                .order_by(Response.id)
+                .execution_options(yield_per=batch_size)
+        )
+        updated = 0
+        for batch in rows.partitions():
+            result = cls._get_collection().bulk_write([
+                UpdateOne({'_id': id, 'opportunity_id': None},
+                          {'$set': {'opportunity_id': opportunity_id,
+                                    'submitted_at': Response.submit_time(created_at)}})
+                for id, opportunity_id, created_at in batch
+            ], ordered=False)
+            updated += result.modified_count
+        return updated
+
 
 from . import opportunity as _opportunity
@@ -0,0 +1,107 @@
+from html import escape
+import re
+
+
+# Renders the subset of markdown used in opportunity descriptions: headings, paragraphs, lists, quotes,
+# fenced code, rules, emphasis, inline code and links. Input is escaped before any markup is produced,
+# so raw HTML of the source is shown as text, and only links with safe schemes are kept.
+
+SAFE_LINK_PREFIXES = ('http://', 'https://', 'mailto:', '/', '#')
+# '//host' and '/\host' are scheme-relative, browsers open both as external links
+UNSAFE_LINK_PREFIXES = ('//', '/\\')
+
+_CODE_SPAN = re.compile(r'(`+)(.+?)\1')
+_LINK = re.compile(r'\[([^\]]+)\]\(([^)\s]+)\)')
+_BOLD = re.compile(r'(\*\*|__)(?=\S)(.+?)(?<=\S)\1')
+_ITALIC = re.compile(r'(\*|_)(?=\S)(.+?)(?<=\S)\1')
+_HEADING = re.compile(r'(#{1,6})\s+(.*?)\s*#*\s*$')
+_RULE = re.compile(r'(?:-\s*){3,}|(?:\*\s*){3,}|(?:_\s*){3,}')
+_UNORDERED_ITEM = re.compile(r'\s*[-*+]\s+(.*)')
+_ORDERED_ITEM = re.compile(r'\s*\d+[.)]\s+(.*)')
+_QUOTE = re.compile(r'\s*>\s?(.*)')
+_FENCE = re.compile(r'\s*(```|~~~)')
+
+
+def _emphasis(text: str) -> str:
+    text = _BOLD.sub(r'<strong>\2</strong>', escape(text))
+    return _ITALIC.sub(r'<em>\2</em>', text)
+
+def _inline_text(text: str) -> str:
+    parts, position = [], 0
+    for match in _LINK.finditer(text):
+        parts.append(_emphasis(text[position:match.start()]))
+        label, url = _emphasis(match.group(1)), match.group(2)
+        if url.lower().startswith(SAFE_LINK_PREFIXES) and not url.startswith(UNSAFE_LINK_PREFIXES):
+            parts.append(f'<a href="{escape(url)}" rel="nofollow noopener">{label}</a>')
+        else:
+            parts.append(label)
+        position = match.end()
+    parts.append(_emphasis(text[position:]))
+    return ''.join(parts)
+
+def render_inline(text: str) -> str:
+    parts, position = [], 0
+    for match in _CODE_SPAN.finditer(text):
+        parts.append(_inline_text(text[position:match.start()]))
+        parts.append(f'<code>{escape(match.group(2).strip())}</code>')
+        position = match.end()
+    parts.append(_inline_text(text[position:]))
+    return ''.join(parts)
+
+def render(text: str) -> str:
+    html: list[str] = []
+    paragraph: list[str] = []
+    quote: list[str] = []
+    list_tag: str | None = None
+
+    def close_blocks() -> None:
+        nonlocal list_tag
+        if len(paragraph) > 0:
+            html.append(f'<p>{render_inline(" ".join(paragraph))}</p>')
+            paragraph.clear()
+        if len(quote) > 0:
+            html.append(f'<blockquote><p>{render_inline(" ".join(quote))}</p></blockquote>')
+            quote.clear()
+        if list_tag is not None:
+            html.append(f'</{list_tag}>')
+            list_tag = None
+
+    lines = iter(text.replace('\r\n', '\n').split('\n'))
+    for line in lines:
+        if (fence := _FENCE.match(line)) is not None:
+            close_blocks()
+            code = []
+            for code_line in lines:
+                if code_line.strip().startswith(fence.group(1)):
+                    break
+                code.append(code_line)
+            html.append(f'<pre><code>{escape(chr(10).join(code))}</code></pre>')
+        elif line.strip() == '':
+            close_blocks()
+        elif (heading := _HEADING.match(line)) is not None:
+            close_blocks()
+            level = len(heading.group(1))
+            html.append(f'<h{level}>{render_inline(heading.group(2))}</h{level}>')
+        elif _RULE.fullmatch(line.strip()) is not None:
+            close_blocks()
+            html.append('<hr>')
+        elif (item := _UNORDERED_ITEM.fullmatch(line) or _ORDERED_ITEM.fullmatch(line)) is not None:
+            tag = 'ul' if item.re is _UNORDERED_ITEM else 'ol'
+            if list_tag != tag:
+                close_blocks()
+                html.append(f'<{tag}>')
+                list_tag = tag
+            html.append(f'<li>{render_inline(item.group(1))}</li>')
+        elif (quote_line := _QUOTE.fullmatch(line)) is not None:
+            if len(quote) == 0:
+                close_blocks()
+            quote.append(quote_line.group(1))
+        elif list_tag is not None and line.startswith((' ', '\t')) and html[-1].endswith('</li>'):
+            # continuation of the last list item
+            html[-1] = f'{html[-1][:-len("</li>")]} {render_inline(line.strip())}</li>'
+        else:
+            if len(quote) > 0 or list_tag is not None:
+                close_blocks()
+            paragraph.append(line.strip())
+    close_blocks()
+    return '\n'.join(html)
@@ -1,19 +1,66 @@
-from typing import Any, Self, Iterable, Optional
+from typing import Any, ClassVar, Self, Iterable, Optional
+from datetime import datetime, UTC
+from io import BytesIO
+import gzip
 
 from minio import Minio
-from sqlalchemy import select, func
+from sqlalchemy import Index, Enum as SQLEnum, select, func, false, event
+from sqlalchemy.dialects.postgresql import TIMESTAMP
+from sqlalchemy.orm import object_session
 
 from ...utils import *
 from ..base import *
 from ... import serializers as ser
 
-from ..auxillary.address import City
+from ..auxillary.address import City, Proximity
+from ..auxillary.gazetteer import Gazetteer
 from .. import user as _user
 from . import form as _form
+from . import markdown as _markdown
+from ..images import ThumbnailFormat, thumbnail_size, thumbnail_filename, put_thumbnails, read_object
+from ..coalesce import SingleFlight
 
 
 class OpportunityDescriptionFormat(Enum):
     MARKDOWN = ('md', 'text/markdown')
+    HTML = ('html', 'text/html')
+
+# Content encoding of descriptions uploaded with 'Opportunity.update_description'
+DESCRIPTION_ENCODING: str = 'gzip'
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    """Check whether value of 'Accept-Encoding' header allows given content encoding,
+       a coding named exactly takes precedence over '*'."""
+
+    qualities: dict[str, float] = {}
+    for coding in accept_encoding.split(','):
+        name, *parameters = coding.split(';')
+        name = name.strip().lower()
+        if name not in (encoding, '*'):
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.partition('=')
+            if key.strip().lower() != 'q':
+                continue
+            try:
+                quality = float(value.strip())
+            except ValueError:
+                quality = 0.0
+        qualities[name] = quality
+    return qualities.get(encoding, qualities.get('*', 0.0)) > 0
+
+@dataclass
+class EncodedDescription:
+    data: bytes
+    format: OpportunityDescriptionFormat
+    # None if data is not encoded
+    encoding: str | None
+
+class OpportunityStatus(Enum):
+    ACTIVE = 'active'
+    # no longer listed, moved to archive by 'OpportunityArchive' after a grace period
+    CLOSED = 'closed'
 
 class Opportunity(Base):
     __tablename__ = 'opportunity'
@@ -21,17 +68,27 @@ class Opportunity(Base):
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(String(100))
     link: Mapped[str | None] = mapped_column(String(120), nullable=True)
-    provider_id: Mapped[int] = mapped_column(ForeignKey('opportunity_provider.id'))
+    provider_id: Mapped[int] = mapped_column(ForeignKey('opportunity_provider.id'), index=True)
     has_description: Mapped[bool] = mapped_column(default=False)
+    # None for descriptions stored uncompressed, before encoding was introduced
+    description_encoding: Mapped[str | None] = mapped_column(String(10), nullable=True, default=None)
     has_form: Mapped[bool] = mapped_column(default=False)
+    status: Mapped[OpportunityStatus] = mapped_column(SQLEnum(OpportunityStatus, name='opportunity_status'),
+                                                      default=OpportunityStatus.ACTIVE, server_default='ACTIVE')
+    # opportunity is closed automatically after its deadline
+    deadline: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True), nullable=True, default=None)
+    closed_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True), nullable=True, default=None)
 
     provider: Mapped['OpportunityProvider'] = relationship(back_populates='opportunities')
     tags: Mapped[set['OpportunityTag']] = relationship(secondary='opportunity_to_tag', back_populates='opportunities')
     geotags: Mapped[set['OpportunityGeotag']] = relationship(secondary='opportunity_to_geotag',
                                                               back_populates='opportunities')
     cards: Mapped[list['OpportunityCard']] = relationship(back_populates='opportunity', cascade='all, delete-orphan')
-    responses: Mapped[list['OpportunityResponse']] = relationship(back_populates='opportunity',
-                                                                  cascade='all, delete-orphan')
+    # responses outlive opportunities, that are moved to archive, so there is no foreign key
+    responses: Mapped[list['OpportunityResponse']] = relationship(
+        back_populates='opportunity', cascade='all, delete-orphan',
+        primaryjoin='Opportunity.id == foreign(OpportunityResponse.opportunity_id)',
+    )
 
     @property
     def description_url(self) -> str:
@@ -47,6 +104,10 @@ class Opportunity(Base):
         session.add(opportunity)
         return opportunity
 
+    def close(self) -> None:
+        self.status = OpportunityStatus.CLOSED
+        self.closed_at = datetime.now(UTC)
+
     def get_form(self) -> Optional['_form.OpportunityForm']:
         if not self.has_form:
             return None
@@ -60,6 +121,8 @@ class Opportunity(Base):
         geotags: Iterable['OpportunityGeotag'],
         user: Optional['_user.User'] = None,
         public: bool = True,
+        near: Optional['Proximity'] = None,
+        active: bool = True,
     ):
         if len(providers) > 0:
             statement = statement.where(Opportunity.provider_id.in_(provider.id for provider in providers))
@@ -75,14 +138,44 @@ class Opportunity(Base):
                 .group_by(OpportunityToGeotag.opportunity_id) \
                 .having(func.count(OpportunityToGeotag.geotag_id) > 0)
             statement = statement.where(Opportunity.id.in_(substatement))
+        if near is not None:
+            substatement = select(OpportunityToGeotag.opportunity_id) \
+                .join(OpportunityGeotag, OpportunityGeotag.id == OpportunityToGeotag.geotag_id) \
+                .join(City, City.id == OpportunityGeotag.city_id) \
+                .where(near.contains_city())
+            statement = statement.where(Opportunity.id.in_(substatement))
         if user is not None:
             statement = statement.where(Opportunity.id.in_(response.opportunity_id for response in user.responses))
         if public:
             statement = statement.where(Opportunity.cards.any())
+        if active:
+            statement = statement.where(Opportunity.status == OpportunityStatus.ACTIVE)
         return statement
 
     # The maximum amount of opportunities returned from database in one query
     PAGE_SIZE: int = 12 
+    # concurrent identical listings of different sessions are queried once, see 'filter_key'
+    filter_queries: ClassVar[SingleFlight] = SingleFlight('opportunity_filter')
+
+    @staticmethod
+    def filter_key(
+        session: Session,
+        *, providers: Iterable['OpportunityProvider'],
+        tags: Iterable['OpportunityTag'],
+        geotags: Iterable['OpportunityGeotag'],
+        user: Optional['_user.User'] = None,
+        public: bool = True,
+        near: Optional['Proximity'] = None,
+        active: bool = True,
+    ) -> tuple | None:
+        """Normalized filters, or None if the query must not be shared: when it depends on a user or
+           the session has uncommitted changes (flushed or not), which the query would see."""
+
+        if user is not None or has_uncommitted_changes(session):
+            return None
+        return (frozenset(provider.id for provider in providers), frozenset(tag.id for tag in tags),
+                frozenset(geotag.id for geotag in geotags), public, active,
+                (near.latitude, near.longitude, near.radius) if near is not None else None)
 
     @classmethod
     def filter_pages(
@@ -92,11 +185,18 @@ class Opportunity(Base):
         geotags: Iterable['OpportunityGeotag'],
         user: Optional['_user.User'] = None,
         public: bool = True,
+        near: Optional['Proximity'] = None,
+        active: bool = True,
     ) -> int:
         statement = cls.apply_filters_to_statement(select(func.count()).select_from(Opportunity),
                                                    providers=providers, tags=tags, geotags=geotags,
-                                                   user=user, public=public)
-        count: int = session.execute(statement).scalars().first()
+                                                   user=user, public=public, near=near, active=active)
+        key = cls.filter_key(session, providers=providers, tags=tags, geotags=geotags,
+                             user=user, public=public, near=near, active=active)
+        if key is None:
+            count: int = session.execute(statement).scalars().first()
+        else:
+            count = cls.filter_queries.do(('pages', key), lambda: session.execute(statement).scalars().first())
         return (count + cls.PAGE_SIZE - 1) // cls.PAGE_SIZE
 
     @classmethod
@@ -108,14 +208,62 @@ class Opportunity(Base):
         page: int,
         user: Optional['_user.User'] = None,
         public: bool = True,
+        near: Optional['Proximity'] = None,
+        active: bool = True,
     ) -> list['Opportunity']:
-        statement = (
-            cls.apply_filters_to_statement(select(Opportunity), providers=providers, tags=tags,
-                                           geotags=geotags, user=user, public=public)
-                .offset((page - 1) * cls.PAGE_SIZE)
-                .limit(cls.PAGE_SIZE)
-        )
-        return session.execute(statement).scalars().all()
+        """Return given page of opportunities matching given filters. If 'near' is given, opportunities
+           are sorted by distance from center of the area to their closest geotag."""
+
+        statement = cls.apply_filters_to_statement(select(Opportunity), providers=providers, tags=tags,
+                                                   geotags=geotags, user=user, public=public, near=near,
+                                                   active=active)
+        if near is not None:
+            statement = statement.order_by(cls.distance(near), Opportunity.id)
+        statement = statement.offset((page - 1) * cls.PAGE_SIZE).limit(cls.PAGE_SIZE)
+        key = cls.filter_key(session, providers=providers, tags=tags, geotags=geotags,
+                             user=user, public=public, near=near, active=active)
+        if key is None:
+            return session.execute(statement).scalars().all()
+        # instances can't be shared between sessions, so waiters receive ids and load them by primary key
+        opportunities = None
+
+        def query() -> tuple[int, ...]:
+            nonlocal opportunities
+            opportunities = session.execute(statement).scalars().all()
+            return tuple(opportunity.id for opportunity in opportunities)
+
+        ids = cls.filter_queries.do(('page', page, key), query)
+        if opportunities is not None:
+            return opportunities
+        loaded = {opportunity.id: opportunity
+                  for opportunity in session.execute(select(Opportunity).where(Opportunity.id.in_(ids))).scalars()}
+        return [loaded[id] for id in ids if id in loaded]
+
+    @classmethod
+    def facets(
+        cls, session: Session,
+        *, providers: Iterable['OpportunityProvider'],
+        tags: Iterable['OpportunityTag'],
+        geotags: Iterable['OpportunityGeotag'],
+        user: Optional['_user.User'] = None,
+        public: bool = True,
+        near: Optional['Proximity'] = None,
+        active: bool = True,
+    ) -> '_facets.Facets':
+        return _facets.count_facets(session, providers=providers, tags=tags, geotags=geotags,
+                                    user=user, public=public, near=near, active=active)
+
+    @staticmethod
+    def distance(near: 'Proximity'):
+        """Correlated subquery, that selects distance in meters from center of given area to the closest
+           geotag of an opportunity."""
+
+        return select(func.min(near.distance_to_city())) \
+            .select_from(OpportunityToGeotag) \
+            .join(OpportunityGeotag, OpportunityGeotag.id == OpportunityToGeotag.geotag_id) \
+            .join(City, City.id == OpportunityGeotag.city_id) \
+            .where(OpportunityToGeotag.opportunity_id == Opportunity.id) \
+            .scalar_subquery()
 
     def add_tags(self, tags: Iterable['OpportunityTag']) -> None:
         for tag in tags:
@@ -126,14 +274,29 @@ class Opportunity(Base):
             self.geotags.add(geo_tag)
 
     def update_description(self, minio_client: Minio, file: FileStream[OpportunityDescriptionFormat]) -> None:
+        """Store compressed markdown description along with sanitized HTML rendered from it."""
+
+        description = file.stream.read()
+        html = _markdown.render(description.decode(errors='replace')).encode()
+        for format, content in ((OpportunityDescriptionFormat.MARKDOWN, description),
+                                (OpportunityDescriptionFormat.HTML, html)):
+            compressed = gzip.compress(content, mtime=0)
+            minio_client.put_object(
+                'opportunity-description', f'{self.id}.{format.value[0]}.gz', BytesIO(compressed), len(compressed),
+                content_type=format.value[1], metadata={'Content-Encoding': DESCRIPTION_ENCODING},
+            )
+        if self.has_description and self.description_encoding is None:
+            minio_client.remove_object('opportunity-description', f'{self.id}.md')
         self.has_description = True
-        minio_client.put_object('opportunity-description', f'{self.id}.md', file.stream, file.size)
+        self.description_encoding = DESCRIPTION_ENCODING
+        if (session := object_session(self)) is not None:
+            _search.OpportunitySearchDocument.update_description(session, self, description.decode(errors='replace'))
 
     def get_tags(self) -> dict[str, str]:
         return {tag.id: tag.name for tag in self.tags}
 
     def get_geotags(self) -> dict[str, str]:
-        return {geotag.id: geotag.city.name for geotag in self.geotags}
+        return {geotag.id: Gazetteer.city_name(geotag) for geotag in self.geotags}
 
     def get_dict(self) -> dict[str, Any]:
         return {
@@ -147,34 +310,68 @@ class Opportunity(Base):
             'geotags': self.get_geotags(),
         }
 
+    def get_encoded_description(
+        self, minio_client: Minio, accept_encoding: str = '',
+        format: OpportunityDescriptionFormat = OpportunityDescriptionFormat.MARKDOWN,
+    ) -> EncodedDescription:
+        """Return description in given format. Stored compressed description is returned as is,
+           if client accepts its encoding (value of 'Accept-Encoding' header)."""
+
+        if not self.has_description or self.description_encoding is None:
+            description = read_object(
+                minio_client, 'opportunity-description', f'{self.id}.md' if self.has_description else 'default.md')
+            if format == OpportunityDescriptionFormat.HTML:
+                description = _markdown.render(description.decode(errors='replace')).encode()
+            return EncodedDescription(data=description, format=format, encoding=None)
+        description = read_object(minio_client, 'opportunity-description', f'{self.id}.{format.value[0]}.gz')
+        if accepts_encoding(accept_encoding, self.description_encoding):
+            return EncodedDescription(data=description, format=format, encoding=self.description_encoding)
+        return EncodedDescription(data=gzip.decompress(description), format=format, encoding=None)
+
     def get_description(self, minio_client: Minio) -> bytes:
-        filename = f'{self.id}.md' if self.has_description else 'default.md'
-        response = None
-        try:
-            response = minio_client.get_object('opportunity-description', filename)
-            description = response.read()
-        finally:
-            response.close()
-            response.release_conn()
-        return description
+        return self.get_encoded_description(minio_client).data
+
+    def get_description_html(self, minio_client: Minio) -> bytes:
+        return self.get_encoded_description(minio_client, format=OpportunityDescriptionFormat.HTML).data
+
+    def compress_description(self, minio_client: Minio) -> None:
+        """Re-upload description stored before compression was introduced."""
+
+        if not self.has_description or self.description_encoding is not None:
+            return
+        description = self.get_description(minio_client)
+        self.update_description(minio_client, FileStream(
+            stream=BytesIO(description), format=OpportunityDescriptionFormat.MARKDOWN, size=len(description),
+        ))
+
+
+# listings only look at active opportunities, closed ones are skipped by the index until they are archived
+Index('ix_opportunity_active_provider_id', Opportunity.provider_id, Opportunity.id,
+      postgresql_where=Opportunity.status == OpportunityStatus.ACTIVE)
 
 
 class ProviderLogoFormat(Enum):
     PNG = ('png', 'image/png')
 
-# TODO: update logo method
+
 class OpportunityProvider(Base):
     __tablename__ = 'opportunity_provider'
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(String(50))
     logo_format: Mapped[ProviderLogoFormat | None] = mapped_column(nullable=True, default=None)
+    has_logo_thumbnails: Mapped[bool] = mapped_column(default=False, server_default=false())
 
     opportunities: Mapped[list['Opportunity']] = relationship(back_populates='provider', cascade='all, delete-orphan')
 
+    @staticmethod
+    def get_logo_url(provider_id: int, size: int | None = None) -> str:
+        url = f'/api/opportunity-provider/logo/{provider_id}'
+        return url if size is None else f'{url}?size={size}'
+
     @property
     def logo_url(self) -> str:
-        return f'/api/opportunity-provider/logo/{self.id}'
+        return self.get_logo_url(self.id)
 
     @classmethod
     def create(cls, session: Session, fields: ser.OpportunityProvider.Create) -> Self:
@@ -182,18 +379,25 @@ class OpportunityProvider(Base):
         session.add(provider)
         return provider
 
-    def get_logo(self, minio_client: Minio) -> bytes:
-        filename = f'{self.id}.{self.logo_format}' if self.logo_format is not None \
-            else 'default.png'
-        response = None
-        try:
-            response = minio_client.get_object('opportunity-provider-logo', filename)
-            avatar = response.read()
-        finally:
-            if response is not None:
-                response.close()
-                response.release_conn()
-        return avatar
+    def update_logo(self, minio_client: Minio, file: FileStream[ProviderLogoFormat]) -> None:
+        logo = file.stream.read()
+        self.logo_format = file.format
+        minio_client.put_object(
+            'opportunity-provider-logo', f'{self.id}.{file.format.value[0]}', BytesIO(logo), len(logo),
+            content_type=file.format.value[1],
+        )
+        self.has_logo_thumbnails = put_thumbnails(minio_client, 'opportunity-provider-logo', str(self.id), logo)
+
+    def get_logo(self, minio_client: Minio, size: int | None = None,
+                 format: ThumbnailFormat = ThumbnailFormat.PNG) -> bytes:
+        """Return the smallest logo thumbnail fitting given size, or original logo if there is none."""
+
+        if self.logo_format is None:
+            return read_object(minio_client, 'opportunity-provider-logo', 'default.png')
+        if self.has_logo_thumbnails and (thumbnail := thumbnail_size(size)) is not None:
+            return read_object(minio_client, 'opportunity-provider-logo',
+                               thumbnail_filename(str(self.id), thumbnail, format))
+        return read_object(minio_client, 'opportunity-provider-logo', f'{self.id}.{self.logo_format.value[0]}')
 
     @classmethod
     def get_all(cls, session: Session) -> dict[str, str]:
@@ -258,6 +462,8 @@ class OpportunityGeotag(Base):
 
     @classmethod
     def get_all(cls, session: Session) -> dict[str, tuple[str, str]]:
+        if Gazetteer.loaded:
+            return Gazetteer.get_geotags()
         return {str(geotag.id): (geotag.city.country.name, geotag.city.name)
                 for geotag in session.query(OpportunityGeotag).all()}
 
@@ -266,21 +472,21 @@ class OpportunityToTag(Base):
     __tablename__ = 'opportunity_to_tag'
 
     opportunity_id: Mapped[int] = mapped_column(ForeignKey('opportunity.id'), primary_key=True)
-    tag_id: Mapped[int] = mapped_column(ForeignKey('opportunity_tag.id'), primary_key=True)
+    tag_id: Mapped[int] = mapped_column(ForeignKey('opportunity_tag.id'), primary_key=True, index=True)
 
 
 class OpportunityToGeotag(Base):
     __tablename__ = 'opportunity_to_geotag'
 
     opportunity_id: Mapped[int] = mapped_column(ForeignKey('opportunity.id'), primary_key=True)
-    geotag_id: Mapped[int] = mapped_column(ForeignKey('opportunity_geotag.id'), primary_key=True)
+    geotag_id: Mapped[int] = mapped_column(ForeignKey('opportunity_geotag.id'), primary_key=True, index=True)
 
 
 class OpportunityCard(Base):
     __tablename__ = 'opportunity_card'
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    opportunity_id: Mapped[int] = mapped_column(ForeignKey('opportunity.id'))
+    opportunity_id: Mapped[int] = mapped_column(ForeignKey('opportunity.id'), index=True)
     title: Mapped[str] = mapped_column(String(100))
     subtitle: Mapped[str | None] = mapped_column(String(50), nullable=True)
 
@@ -305,14 +511,34 @@ class OpportunityCard(Base):
 
 
 class OpportunityResponse(Base):
+    """Table is range-partitioned by month of creation, see 'ResponsePartitions'. Partition key must be
+       a part of primary key, but ids are unique on their own, so responses are identified only by id."""
+
     __tablename__ = 'opportunity_response'
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
-    opportunity_id: Mapped[int] = mapped_column(ForeignKey('opportunity.id'))
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.id'), index=True)
+    # not a foreign key, see 'Opportunity.responses'
+    opportunity_id: Mapped[int] = mapped_column(index=True)
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), primary_key=True,
+                                                 server_default=func.now(), default=lambda: datetime.now(UTC))
+
+    __table_args__ = {'postgresql_partition_by': 'RANGE (created_at)'}
+    __mapper_args__ = {'primary_key': [id]}
+
+    # creation time of responses created before it was recorded, they aren't counted in daily statistics
+    UNDATED: ClassVar[datetime] = datetime(1, 1, 1, tzinfo=UTC)
+
+    @classmethod
+    def submit_time(cls, created_at: datetime | None) -> datetime | None:
+        """Creation time, or None for undated responses."""
+
+        return created_at if created_at is not None and created_at != cls.UNDATED else None
 
     user: Mapped['_user.User'] = relationship(back_populates='responses')
-    opportunity: Mapped['Opportunity'] = relationship(back_populates='responses')
+    opportunity: Mapped['Opportunity'] = relationship(
+        back_populates='responses', primaryjoin='Opportunity.id == foreign(OpportunityResponse.opportunity_id)',
+    )
     # statuses: Mapped[list['ResponseStatus']] = relationship(back_populates='response')
 
     @classmethod
@@ -324,4 +550,32 @@ class OpportunityResponse(Base):
         saved_data = _form.ResponseData.create(response=response, form=form, data=data)
         if not isinstance(saved_data, _form.ResponseData):
             return saved_data
+        if form.submit_method is not None and (url := form.submit_method.delivery_url()) is not None:
+            _delivery.ResponseDelivery.enqueue(session, response, url, saved_data.data)
         return response
+
+
+# set while the transaction of a session has flushed, but not committed changes
+_FLUSHED_CHANGES = 'flushed_changes'
+
+def has_uncommitted_changes(session: Session) -> bool:
+    """Whether reads of the session see changes, that other sessions don't (pending or flushed ones)."""
+
+    return bool(session.new or session.dirty or session.deleted or session.info.get(_FLUSHED_CHANGES, False))
+
+@event.listens_for(Session, 'after_flush')
+def _mark_flushed_changes(session: Session, _flush_context) -> None:
+    session.info[_FLUSHED_CHANGES] = True
+
+@event.listens_for(Session, 'after_commit')
+def _clear_flushed_changes(session: Session) -> None:
+    session.info.pop(_FLUSHED_CHANGES, None)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_flushed_changes(session: Session, _previous_transaction) -> None:
+    session.info.pop(_FLUSHED_CHANGES, None)
+
+
+from . import search as _search
+from . import facets as _facets
+from . import delivery as _delivery
@@ -0,0 +1,166 @@
+from datetime import date, datetime, UTC
+from threading import Event, Thread
+import re
+
+from sqlalchemy import Engine, Connection, Column, Table, MetaData, text
+
+from ..base import *
+
+from .opportunity import OpportunityResponse
+
+
+class ResponsePartitions:
+    """Monthly range partitions of 'opportunity_response' by creation time. Partitions are created AHEAD
+       months in advance, old ones are detached and moved to ARCHIVE_SCHEMA, where they are ordinary tables,
+       that no longer slow down queries, vacuum and index maintenance of live responses. Maintenance is
+       serialized with an advisory lock, so it's safe to run it from every process."""
+
+    TABLE: str = OpportunityResponse.__tablename__
+    AHEAD: int = 3
+    ARCHIVE_SCHEMA: str = 'archive'
+    # partitions ending this many months before the current one are archived, None keeps all of them
+    RETENTION: int | None = None
+    # tablespace archived partitions are moved to, e.g. on cheaper storage
+    ARCHIVE_TABLESPACE: str | None = None
+    MAINTENANCE_INTERVAL: float = 3600
+    ADVISORY_LOCK_KEY: int = 0x726573706f6e7365
+
+    engine: Engine | None = None
+    thread: Thread | None = None
+    stopped = Event()
+
+    @staticmethod
+    def add_months(month: date, months: int) -> date:
+        index = month.year * 12 + month.month - 1 + months
+        return date(index // 12, index % 12 + 1, 1)
+
+    @classmethod
+    def name(cls, month: date) -> str:
+        # '%Y' isn't zero-padded for years before 1000 on every platform
+        return f'{cls.TABLE}_{month.year:04}_{month.month:02}'
+
+    @classmethod
+    def month(cls, name: str) -> date | None:
+        if (match := re.fullmatch(rf'{cls.TABLE}_(\d{{4}})_(\d{{2}})', name)) is None:
+            return None
+        return date(int(match.group(1)), int(match.group(2)), 1)
+
+    @classmethod
+    def is_partitioned(cls, connection: Connection) -> bool:
+        return bool(connection.execute(
+            text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)"), {'table': cls.TABLE}
+        ).scalar())
+
+    @classmethod
+    def attached(cls, connection: Connection) -> list[date]:
+        """Months of partitions attached to the table, in ascending order."""
+
+        names = connection.execute(text(
+            'SELECT child.relname FROM pg_inherits'
+            ' JOIN pg_class child ON child.oid = pg_inherits.inhrelid'
+            ' WHERE pg_inherits.inhparent = to_regclass(:table)'
+        ), {'table': cls.TABLE}).scalars()
+        return sorted(month for name in names if (month := cls.month(name)) is not None)
+
+    @classmethod
+    def archived(cls, connection: Connection) -> list[Table]:
+        """Archived partitions with columns of the table, e.g. for deletion of archived responses."""
+
+        names = connection.execute(text(
+            'SELECT tablename FROM pg_tables WHERE schemaname = :schema ORDER BY tablename'
+        ), {'schema': cls.ARCHIVE_SCHEMA}).scalars()
+        metadata = MetaData()
+        columns = OpportunityResponse.__table__.columns
+        return [
+            Table(name, metadata, *(Column(column.name, column.type) for column in columns), schema=cls.ARCHIVE_SCHEMA)
+            for name in names if cls.month(name) is not None
+        ]
+
+    @classmethod
+    def create(cls, connection: Connection, month: date) -> None:
+        until = cls.add_months(month, 1)
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {cls.name(month)} PARTITION OF {cls.TABLE}'
+            f" FOR VALUES FROM ('{month.isoformat()}') TO ('{until.isoformat()}')"
+        ))
+
+    @classmethod
+    def ensure(cls, connection: Connection, since: date | None = None) -> list[date]:
+        """Create missing partitions from given month (the current one by default) up to AHEAD months after
+           the current one. Returns months of created partitions."""
+
+        current = datetime.now(UTC).date().replace(day=1)
+        month = (since or current).replace(day=1)
+        existing = set(cls.attached(connection))
+        created = []
+        while month <= cls.add_months(current, cls.AHEAD):
+            if month not in existing:
+                cls.create(connection, month)
+                created.append(month)
+            month = cls.add_months(month, 1)
+        return created
+
+    @classmethod
+    def archive(cls, connection: Connection, before: date) -> list[date]:
+        """Detach partitions ending before given date and move them to the archive schema.
+           Returns months of archived partitions."""
+
+        archived = []
+        for month in cls.attached(connection):
+            if cls.add_months(month, 1) > before:
+                break
+            name = cls.name(month)
+            connection.execute(text(f'CREATE SCHEMA IF NOT EXISTS {cls.ARCHIVE_SCHEMA}'))
+            connection.execute(text(f'ALTER TABLE {cls.TABLE} DETACH PARTITION {name}'))
+            # archived responses must not prevent deletion of users and opportunities
+            for constraint in connection.execute(text(
+                "SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(:name) AND contype = 'f'"
+            ), {'name': name}).scalars().all():
+                connection.execute(text(f'ALTER TABLE {name} DROP CONSTRAINT {constraint}'))
+            connection.execute(text(f'ALTER TABLE {name} SET SCHEMA {cls.ARCHIVE_SCHEMA}'))
+            if cls.ARCHIVE_TABLESPACE is not None:
+                connection.execute(text(
+                    f'ALTER TABLE {cls.ARCHIVE_SCHEMA}.{name} SET TABLESPACE {cls.ARCHIVE_TABLESPACE}'
+                ))
+            archived.append(month)
+        return archived
+
+    @classmethod
+    def maintain(cls, connection: Connection) -> None:
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': cls.ADVISORY_LOCK_KEY})
+        if not cls.is_partitioned(connection):
+            # table is partitioned by a migration, that isn't applied yet
+            return
+        if created := cls.ensure(connection):
+            logger.info('Created response partitions (months=%s)', [month.isoformat() for month in created])
+        if cls.RETENTION is not None:
+            before = cls.add_months(datetime.now(UTC).date().replace(day=1), -cls.RETENTION)
+            if archived := cls.archive(connection, before):
+                logger.info('Archived response partitions (months=%s)', [month.isoformat() for month in archived])
+
+    @classmethod
+    def run(cls) -> None:
+        while not cls.stopped.is_set():
+            try:
+                with cls.engine.begin() as connection:
+                    cls.maintain(connection)
+            except Exception:
+                logger.exception('Response partition maintenance failed')
+            cls.stopped.wait(cls.MAINTENANCE_INTERVAL)
+
+    @classmethod
+    def start(cls, engine: Engine) -> None:
+        cls.engine = engine
+        if cls.thread is not None:
+            return
+        cls.stopped.clear()
+        cls.thread = Thread(target=cls.run, name='response-partitions', daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def stop(cls) -> None:
+        if cls.thread is None:
+            return
+        cls.stopped.set()
+        cls.thread.join()
+        cls.thread = None
@@ -0,0 +1,157 @@
+from typing import Any, Iterable, Optional
+
+from minio import Minio
+from sqlalchemy import Text, Computed, Index, select, func, cast, event
+from sqlalchemy.dialects.postgresql import TSVECTOR, REGCONFIG, insert
+
+from ..base import *
+
+from .. import user as _user
+from ..auxillary.address import Proximity
+from .opportunity import Opportunity, OpportunityProvider, OpportunityTag, OpportunityGeotag, OpportunityCard
+
+
+# Text search configuration used both for building documents and for parsing queries
+TEXT_SEARCH_CONFIG: str = 'simple'
+
+def _weighted(column: str, weight: str) -> str:
+    return f"setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce({column}, '')), '{weight}')"
+
+class OpportunitySearchDocument(Base):
+    """Full-text search document of an opportunity. Opportunity name has the highest weight,
+       followed by titles and subtitles of its cards and then by its markdown description."""
+
+    __tablename__ = 'opportunity_search_document'
+
+    opportunity_id: Mapped[int] = mapped_column(ForeignKey('opportunity.id', ondelete='CASCADE'), primary_key=True)
+    name: Mapped[str] = mapped_column(Text, default='')
+    cards: Mapped[str] = mapped_column(Text, default='')
+    description: Mapped[str] = mapped_column(Text, default='')
+    document: Mapped[Any] = mapped_column(TSVECTOR, Computed(
+        f"{_weighted('name', 'A')} || {_weighted('cards', 'B')} || {_weighted('description', 'C')}",
+        persisted=True,
+    ))
+
+    __table_args__ = (
+        Index('ix_opportunity_search_document_document', 'document', postgresql_using='gin'),
+    )
+
+    @classmethod
+    def refresh(cls, session: Session, opportunity_ids: Iterable[int]) -> None:
+        """Rebuild name and cards parts of documents of given opportunities. Description part
+           is left untouched, it's updated only on description upload."""
+
+        opportunity_ids = list(opportunity_ids)
+        if len(opportunity_ids) == 0:
+            return
+        cards = (
+            select(OpportunityCard.opportunity_id,
+                   func.string_agg(func.concat_ws(' ', OpportunityCard.title, OpportunityCard.subtitle),
+                                   ' ').label('text'))
+                .where(OpportunityCard.opportunity_id.in_(opportunity_ids))
+                .group_by(OpportunityCard.opportunity_id)
+                .subquery()
+        )
+        source = (
+            select(Opportunity.id, Opportunity.name, func.coalesce(cards.c.text, ''))
+                .outerjoin(cards, cards.c.opportunity_id == Opportunity.id)
+                .where(Opportunity.id.in_(opportunity_ids))
+        )
+        statement = insert(cls).from_select(['opportunity_id', 'name', 'cards'], source)
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.opportunity_id],
+            set_={'name': statement.excluded.name, 'cards': statement.excluded.cards},
+        )
+        session.connection().execute(statement)
+
+    @classmethod
+    def update_description(cls, session: Session, opportunity: Opportunity, description: str) -> None:
+        statement = insert(cls).values(opportunity_id=opportunity.id, name=opportunity.name, description=description)
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.opportunity_id],
+            set_={'description': statement.excluded.description},
+        )
+        session.connection().execute(statement)
+
+    @classmethod
+    def rebuild(cls, session: Session, minio_client: Minio) -> None:
+        """Build documents for all existing opportunities, including their descriptions.
+           Intended to be run once after the table is created."""
+
+        opportunities: list[Opportunity] = session.query(Opportunity).all()
+        cls.refresh(session, (opportunity.id for opportunity in opportunities))
+        for opportunity in opportunities:
+            if not opportunity.has_description:
+                continue
+            description = opportunity.get_description(minio_client).decode(errors='replace')
+            cls.update_description(session, opportunity, description)
+
+    @staticmethod
+    def query(query: str):
+        return func.websearch_to_tsquery(cast(TEXT_SEARCH_CONFIG, REGCONFIG), query)
+
+    @classmethod
+    def apply_query_to_statement[S](cls, statement: S, query: str) -> S:
+        return statement \
+            .join(cls, cls.opportunity_id == Opportunity.id) \
+            .where(cls.document.bool_op('@@')(cls.query(query)))
+
+    @classmethod
+    def search_pages(
+        cls, session: Session, query: str,
+        *, providers: Iterable['OpportunityProvider'],
+        tags: Iterable['OpportunityTag'],
+        geotags: Iterable['OpportunityGeotag'],
+        user: Optional['_user.User'] = None,
+        public: bool = True,
+        near: Optional['Proximity'] = None,
+        active: bool = True,
+    ) -> int:
+        statement = cls.apply_query_to_statement(select(func.count()).select_from(Opportunity), query)
+        statement = Opportunity.apply_filters_to_statement(statement, providers=providers, tags=tags,
+                                                           geotags=geotags, user=user, public=public, near=near,
+                                                           active=active)
+        count: int = session.execute(statement).scalars().first()
+        return (count + Opportunity.PAGE_SIZE - 1) // Opportunity.PAGE_SIZE
+
+    @classmethod
+    def search(
+        cls, session: Session, query: str,
+        *, providers: Iterable['OpportunityProvider'],
+        tags: Iterable['OpportunityTag'],
+        geotags: Iterable['OpportunityGeotag'],
+        page: int,
+        user: Optional['_user.User'] = None,
+        public: bool = True,
+        near: Optional['Proximity'] = None,
+        active: bool = True,
+    ) -> list['Opportunity']:
+        """Same as 'Opportunity.filter', but only opportunities matching given query are returned,
+           most relevant first."""
+
+        rank = func.ts_rank_cd(cls.document, cls.query(query))
+        statement = cls.apply_query_to_statement(select(Opportunity), query)
+        statement = (
+            Opportunity.apply_filters_to_statement(statement, providers=providers, tags=tags,
+                                                   geotags=geotags, user=user, public=public, near=near,
+                                                   active=active)
+                .order_by(rank.desc(), Opportunity.id)
+                .offset((page - 1) * Opportunity.PAGE_SIZE)
+                .limit(Opportunity.PAGE_SIZE)
+        )
+        return session.execute(statement).scalars().all()
+
+
+@event.listens_for(Session, 'after_flush')
+def _refresh_search_documents(session: Session, _flush_context) -> None:
+    opportunity_ids: set[int] = set()
+    for instance in session.new | session.dirty:
+        if isinstance(instance, Opportunity):
+            opportunity_ids.add(instance.id)
+        elif isinstance(instance, OpportunityCard):
+            opportunity_ids.add(instance.opportunity_id)
+    for instance in session.deleted:
+        if isinstance(instance, OpportunityCard):
+            opportunity_ids.add(instance.opportunity_id)
+    opportunity_ids.discard(None)
+    OpportunitySearchDocument.refresh(session, opportunity_ids)
@@ -0,0 +1,313 @@
+from typing import Iterable
+from datetime import datetime, timedelta, UTC
+from threading import Lock
+import time
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+from sqlalchemy import Connection, select, delete, func, event, inspect
+from sqlalchemy.dialects.postgresql import insert
+
+from ..base import *
+
+from .opportunity import (
+    Opportunity, OpportunityTag, OpportunityGeotag, OpportunityToTag, OpportunityToGeotag, OpportunityResponse,
+    OpportunityStatus,
+)
+from .feed import _has_changes
+
+
+class SimilarOpportunity(Base):
+    """Precomputed neighbours of an active opportunity, the most similar one has rank 0."""
+
+    __tablename__ = 'similar_opportunity'
+
+    opportunity_id: Mapped[int] = mapped_column(ForeignKey('opportunity.id', ondelete='CASCADE'), primary_key=True)
+    rank: Mapped[int] = mapped_column(primary_key=True)
+    similar_id: Mapped[int] = mapped_column(ForeignKey('opportunity.id', ondelete='CASCADE'), index=True)
+    score: Mapped[float]
+
+class SimilarityRefresh(Base):
+    """Opportunities, which tags, geotags, provider or status changed since their neighbours were computed."""
+
+    __tablename__ = 'similarity_refresh'
+
+    opportunity_id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+
+    @classmethod
+    def queue(cls, connection: Connection, opportunity_ids: Iterable[int]) -> None:
+        # without numpy and scipy the queue is never drained, so nothing is queued
+        if sparse is None:
+            return
+        if len(opportunity_ids := sorted(opportunity_ids)) > 0:
+            connection.execute(insert(cls).values([{'opportunity_id': id} for id in opportunity_ids])
+                                   .on_conflict_do_nothing())
+
+
+class OpportunityFeatures:
+    """Sparse feature matrix of active opportunities: one row per opportunity, one block of columns per kind
+       of feature (tags, geotags, provider and users, that responded). Rows of every block are L2-normalized
+       and scaled by square root of its weight, so the dot product of two rows is the weighted sum
+       of cosine similarities of their features."""
+
+    def __init__(self, ids: 'numpy.ndarray', matrix: 'sparse.csr_matrix') -> None:
+        self.ids = ids
+        self.matrix = matrix
+
+    @staticmethod
+    def block(rows: 'numpy.ndarray', columns: 'numpy.ndarray', size: int, weight: float) -> 'sparse.csr_matrix':
+        _, columns = numpy.unique(columns, return_inverse=True)
+        block = sparse.csr_matrix((numpy.ones(len(rows)), (rows, columns)), shape=(size, columns.max(initial=-1) + 1))
+        block.sum_duplicates()
+        block.data[:] = 1
+        norms = numpy.sqrt(numpy.asarray(block.sum(axis=1)).ravel())
+        scale = numpy.divide(weight ** 0.5, norms, out=numpy.zeros(size), where=norms > 0)
+        return sparse.diags(scale) @ block
+
+    def rows(self, opportunity_ids: Iterable[int]) -> 'numpy.ndarray':
+        """Rows of given opportunities, inactive ones are skipped."""
+
+        opportunity_ids = numpy.fromiter(opportunity_ids, dtype=numpy.int64)
+        rows = numpy.searchsorted(self.ids, opportunity_ids)
+        known = rows < len(self.ids)
+        known[known] = self.ids[rows[known]] == opportunity_ids[known]
+        return rows[known]
+
+    def scores(self, rows: 'numpy.ndarray') -> 'sparse.csr_matrix':
+        """Similarity of opportunities in given rows (matrix rows) to all opportunities (matrix columns)."""
+
+        scores = (self.matrix[rows] @ self.matrix.T).tocoo()
+        # opportunities aren't similar to themselves
+        other = scores.col != rows[scores.row]
+        return sparse.csr_matrix((scores.data[other], (scores.row[other], scores.col[other])), shape=scores.shape)
+
+    def top(self, rows: 'numpy.ndarray', k: int, min_score: float) -> list[dict]:
+        """Values of 'SimilarOpportunity' rows for up to k neighbours of opportunities in given rows."""
+
+        scores = self.scores(rows)
+        values = []
+        for i, row in enumerate(rows):
+            start, end = scores.indptr[i], scores.indptr[i + 1]
+            columns, data = scores.indices[start:end], scores.data[start:end]
+            if len(data) > k:
+                best = numpy.argpartition(-data, k)[:k]
+                columns, data = columns[best], data[best]
+            # ties are broken by id, so that results are stable
+            order = numpy.lexsort((self.ids[columns], -data))
+            values += [
+                {'opportunity_id': int(self.ids[row]), 'rank': rank, 'similar_id': int(self.ids[column]),
+                 'score': float(score)}
+                for rank, (column, score) in enumerate(zip(columns[order], data[order])) if score >= min_score
+            ]
+        return values
+
+
+class SimilarOpportunities:
+    """Related opportunities ranked by weighted overlap of tags, geotags and provider and by users, that
+       responded to both. Neighbours are computed with sparse matrix products in batches of BATCH_SIZE
+       and stored in 'similar_opportunity', so detail pages read them with one indexed query. Changes of tags,
+       geotags, providers and statuses queue opportunities for 'refresh', co-responses change all the time,
+       so they are taken into account by periodic 'rebuild'. Links of opportunities to their features are
+       cached in process, so 'refresh' only reads links of queued ones. Requires numpy and scipy."""
+
+    K: int = 10
+    BATCH_SIZE: int = 1000
+    TAG_WEIGHT: float = 1
+    GEOTAG_WEIGHT: float = 0.5
+    PROVIDER_WEIGHT: float = 0.25
+    RESPONSE_WEIGHT: float = 1
+    RESPONSE_WINDOW: timedelta = timedelta(days=365)
+    MIN_SCORE: float = 0.05
+    # the most changed opportunities handled by one 'refresh'
+    REFRESH_LIMIT: int = 1000
+    # seconds links of opportunities are cached for, changes refreshed by other processes are seen once they expire
+    FEATURES_TTL: float = 3600
+
+    cached_links: dict[str, 'numpy.ndarray'] | None = None
+    loaded_at: float = 0
+    lock = Lock()
+
+    @staticmethod
+    def require() -> None:
+        if sparse is None:
+            raise RuntimeError('numpy and scipy are required for similar opportunities')
+
+    @classmethod
+    def links(cls, session: Session, opportunity_ids: list[int] | None = None) -> dict[str, 'numpy.ndarray']:
+        """(opportunity id, feature id) pairs of every kind of feature, of all opportunities or given ones only.
+           Providers are only paired with active opportunities, links of other kinds aren't filtered by status."""
+
+        def pairs(statement, opportunity_id) -> 'numpy.ndarray':
+            if opportunity_ids is not None:
+                statement = statement.where(opportunity_id.in_(opportunity_ids))
+            return numpy.array(session.execute(statement).all(), dtype=numpy.int64).reshape(-1, 2)
+
+        since = datetime.now(UTC) - cls.RESPONSE_WINDOW
+        return {
+            'provider': pairs(select(Opportunity.id, Opportunity.provider_id)
+                                  .where(Opportunity.status == OpportunityStatus.ACTIVE), Opportunity.id),
+            'tag': pairs(select(OpportunityToTag.opportunity_id, OpportunityToTag.tag_id),
+                         OpportunityToTag.opportunity_id),
+            'geotag': pairs(select(OpportunityToGeotag.opportunity_id, OpportunityToGeotag.geotag_id),
+                            OpportunityToGeotag.opportunity_id),
+            # only recent responses, so that old partitions aren't scanned
+            'response': pairs(select(OpportunityResponse.opportunity_id, OpportunityResponse.user_id)
+                                  .where(OpportunityResponse.created_at >= since).distinct(),
+                              OpportunityResponse.opportunity_id),
+        }
+
+    @classmethod
+    def features(cls, session: Session, changed: list[int] | None = None) -> OpportunityFeatures:
+        """Feature matrix built from cached links. All links are read if the cache is empty or older than
+           FEATURES_TTL, or if changed opportunities aren't given, otherwise only links of changed ones are."""
+
+        with cls.lock:
+            cached, loaded_at = cls.cached_links, cls.loaded_at
+        if changed is None or cached is None or time.monotonic() - loaded_at > cls.FEATURES_TTL:
+            loaded_at, links = time.monotonic(), cls.links(session)
+        else:
+            updated = cls.links(session, changed)
+            links = {kind: numpy.concatenate([pairs[~numpy.isin(pairs[:, 0], changed)], updated[kind]])
+                     for kind, pairs in cached.items()}
+        with cls.lock:
+            cls.cached_links, cls.loaded_at = links, loaded_at
+
+        providers = links['provider'][numpy.argsort(links['provider'][:, 0])]
+        ids, provider_ids = providers[:, 0], providers[:, 1]
+        if len(ids) == 0:
+            return OpportunityFeatures(ids, sparse.csr_matrix((0, 0)))
+
+        def rows(pairs: 'numpy.ndarray') -> tuple['numpy.ndarray', 'numpy.ndarray']:
+            """Rows of opportunities and features of pairs, inactive opportunities are skipped."""
+
+            rows = numpy.searchsorted(ids, pairs[:, 0])
+            known = rows < len(ids)
+            known[known] = ids[rows[known]] == pairs[known, 0]
+            return rows[known], pairs[known, 1]
+
+        return OpportunityFeatures(ids, sparse.hstack([
+            OpportunityFeatures.block(*rows(links['tag']), len(ids), cls.TAG_WEIGHT),
+            OpportunityFeatures.block(*rows(links['geotag']), len(ids), cls.GEOTAG_WEIGHT),
+            OpportunityFeatures.block(numpy.arange(len(ids)), provider_ids, len(ids), cls.PROVIDER_WEIGHT),
+            OpportunityFeatures.block(*rows(links['response']), len(ids), cls.RESPONSE_WEIGHT),
+        ], format='csr'))
+
+    @classmethod
+    def store(cls, session: Session, features: OpportunityFeatures, rows: 'numpy.ndarray') -> int:
+        """Replace neighbours of opportunities in given rows. Returns amount of stored neighbours."""
+
+        count = 0
+        for start in range(0, len(rows), cls.BATCH_SIZE):
+            batch = rows[start:start + cls.BATCH_SIZE]
+            values = features.top(batch, cls.K, cls.MIN_SCORE)
+            session.execute(delete(SimilarOpportunity).where(
+                SimilarOpportunity.opportunity_id.in_(features.ids[batch].tolist())))
+            if len(values) > 0:
+                session.execute(insert(SimilarOpportunity), values)
+            count += len(values)
+        return count
+
+    @classmethod
+    def rebuild(cls, session: Session) -> int:
+        """Recompute neighbours of all active opportunities. Returns amount of stored neighbours."""
+
+        cls.require()
+        features = cls.features(session)
+        session.execute(delete(SimilarityRefresh))
+        # neighbours of opportunities, that are no longer active
+        session.execute(delete(SimilarOpportunity).where(
+            SimilarOpportunity.opportunity_id.in_(select(Opportunity.id)
+                                                      .where(Opportunity.status != OpportunityStatus.ACTIVE))))
+        return cls.store(session, features, numpy.arange(len(features.ids)))
+
+    @classmethod
+    def refresh(cls, session: Session) -> int:
+        """Recompute neighbours of queued opportunities and of opportunities, which neighbours they can enter
+           or leave: ones listing them and ones, that are closer to them than to their own last neighbour.
+           Returns amount of handled queued opportunities."""
+
+        cls.require()
+        changed = session.execute(
+            delete(SimilarityRefresh)
+                .where(SimilarityRefresh.opportunity_id.in_(
+                    select(SimilarityRefresh.opportunity_id)
+                        .order_by(SimilarityRefresh.opportunity_id)
+                        .limit(cls.REFRESH_LIMIT)
+                        .with_for_update(skip_locked=True)
+                ))
+                .returning(SimilarityRefresh.opportunity_id)
+        ).scalars().all()
+        if len(changed) == 0:
+            return 0
+        features = cls.features(session, changed)
+        rows = features.rows(changed)
+        # closed and removed opportunities have no neighbours, other ones can't list them
+        session.execute(delete(SimilarOpportunity).where(
+            SimilarOpportunity.opportunity_id.in_(set(changed) - set(features.ids[rows].tolist()))))
+        listing = session.execute(
+            select(SimilarOpportunity.opportunity_id).where(SimilarOpportunity.similar_id.in_(changed)).distinct()
+        ).scalars().all()
+        # the best score of every opportunity to a changed one
+        scores = features.scores(rows).max(axis=0).toarray().ravel() if len(rows) > 0 \
+            else numpy.zeros(len(features.ids))
+        # scores of the last neighbours of opportunities with full lists, others take any neighbour
+        thresholds = numpy.zeros(len(features.ids))
+        full = numpy.array(session.execute(
+            select(SimilarOpportunity.opportunity_id, func.min(SimilarOpportunity.score))
+                .group_by(SimilarOpportunity.opportunity_id)
+                .having(func.count() >= cls.K)
+        ).all(), dtype=numpy.float64).reshape(-1, 2)
+        full_rows = numpy.searchsorted(features.ids, full[:, 0].astype(numpy.int64))
+        known = full_rows < len(features.ids)
+        known[known] = features.ids[full_rows[known]] == full[known, 0]
+        thresholds[full_rows[known]] = full[known, 1]
+        closer = numpy.flatnonzero((scores >= cls.MIN_SCORE) & (scores >= thresholds))
+        affected = numpy.union1d(numpy.union1d(rows, closer), features.rows(listing))
+        cls.store(session, features, affected)
+        return len(changed)
+
+    @classmethod
+    def run(cls, session_factory) -> int:
+        """Refresh all queued opportunities. Returns amount of handled ones."""
+
+        count = 0
+        while True:
+            with session_factory.begin() as session:
+                if (handled := cls.refresh(session)) == 0:
+                    return count
+            count += handled
+
+    @classmethod
+    def similar(cls, session: Session, opportunity_id: int, k: int | None = None) -> list[Opportunity]:
+        """Up to k (K by default) active opportunities most similar to given one, the most similar first."""
+
+        return session.execute(
+            select(Opportunity)
+                .join(SimilarOpportunity, SimilarOpportunity.similar_id == Opportunity.id)
+                .where(SimilarOpportunity.opportunity_id == opportunity_id,
+                       Opportunity.status == OpportunityStatus.ACTIVE)
+                .order_by(SimilarOpportunity.rank)
+                .limit(k or cls.K)
+        ).scalars().all()
+
+
+@event.listens_for(Session, 'after_flush')
+def _queue_similarity_refresh(session: Session, _flush_context) -> None:
+    if sparse is None:
+        return
+    opportunity_ids: set[int] = set()
+    for instance in session.new | session.dirty:
+        match instance:
+            case Opportunity() if _has_changes(instance, 'provider_id', 'tags', 'geotags', 'status'):
+                opportunity_ids.add(instance.id)
+            case OpportunityTag() | OpportunityGeotag() if instance in session.dirty:
+                # opportunities removed from the tag are no longer found by its links, so history is used
+                history = inspect(instance).attrs.opportunities.history
+                opportunity_ids.update(opportunity.id for opportunity in (*history.added, *history.deleted))
+    opportunity_ids.discard(None)
+    if len(opportunity_ids) > 0:
+        SimilarityRefresh.queue(session.connection(), opportunity_ids)
@@ -0,0 +1,162 @@
+from collections import defaultdict
+from datetime import date, UTC
+
+from sqlalchemy import Connection, Date, select, func, cast, literal, event
+from sqlalchemy.dialects.postgresql import insert
+
+from ..base import *
+
+from .opportunity import Opportunity, OpportunityProvider, OpportunityResponse
+
+
+class OpportunityResponseCounter(Base):
+    __tablename__ = 'opportunity_response_counter'
+
+    opportunity_id: Mapped[int] = mapped_column(ForeignKey('opportunity.id', ondelete='CASCADE'), primary_key=True)
+    count: Mapped[int] = mapped_column(default=0)
+
+
+class ProviderResponseCounter(Base):
+    __tablename__ = 'provider_response_counter'
+
+    provider_id: Mapped[int] = mapped_column(ForeignKey('opportunity_provider.id', ondelete='CASCADE'),
+                                             primary_key=True)
+    count: Mapped[int] = mapped_column(default=0)
+
+
+class OpportunityResponseDaily(Base):
+    __tablename__ = 'opportunity_response_daily'
+
+    opportunity_id: Mapped[int] = mapped_column(ForeignKey('opportunity.id', ondelete='CASCADE'), primary_key=True)
+    day: Mapped[date] = mapped_column(primary_key=True)
+    count: Mapped[int] = mapped_column(default=0)
+
+
+class ProviderResponseDaily(Base):
+    __tablename__ = 'provider_response_daily'
+
+    provider_id: Mapped[int] = mapped_column(ForeignKey('opportunity_provider.id', ondelete='CASCADE'),
+                                             primary_key=True)
+    day: Mapped[date] = mapped_column(primary_key=True)
+    count: Mapped[int] = mapped_column(default=0)
+
+
+UNDATED_DAY: date = OpportunityResponse.UNDATED.date()
+
+class ResponseStats:
+    """Response counters and daily rollups per opportunity and per provider. They are updated in the same
+       flush, that creates or deletes responses, days are taken in UTC."""
+
+    @classmethod
+    def apply(cls, connection: Connection, deltas: dict[tuple[int, date | None], int]) -> None:
+        """Add given deltas to counters, deltas are keyed by (opportunity id, day). Undated responses
+           are only counted in totals. Counters of archived opportunities are gone with them, responses
+           to those are only counted for their providers."""
+
+        from .archive import ArchivedOpportunity
+
+        totals: defaultdict[int, int] = defaultdict(int)
+        for (opportunity_id, _), delta in deltas.items():
+            totals[opportunity_id] += delta
+        # responses keep referring to archived opportunities, they are looked up in the archive
+        archived: set[int] = set()
+        for opportunity_id, delta in totals.items():
+            if cls.upsert(connection, OpportunityResponseCounter,
+                          select(Opportunity.id, literal(delta)).where(Opportunity.id == opportunity_id)) > 0:
+                cls.upsert(connection, ProviderResponseCounter,
+                           select(Opportunity.provider_id, literal(delta)).where(Opportunity.id == opportunity_id))
+                continue
+            archived.add(opportunity_id)
+            cls.upsert(connection, ProviderResponseCounter,
+                       select(ArchivedOpportunity.provider_id, literal(delta))
+                           .join(OpportunityProvider, OpportunityProvider.id == ArchivedOpportunity.provider_id)
+                           .where(ArchivedOpportunity.id == opportunity_id))
+        for (opportunity_id, day), delta in deltas.items():
+            if day is None or day == UNDATED_DAY:
+                continue
+            if opportunity_id in archived:
+                cls.upsert(connection, ProviderResponseDaily,
+                           select(ArchivedOpportunity.provider_id, literal(day), literal(delta))
+                               .join(OpportunityProvider, OpportunityProvider.id == ArchivedOpportunity.provider_id)
+                               .where(ArchivedOpportunity.id == opportunity_id))
+                continue
+            cls.upsert(connection, OpportunityResponseDaily,
+                       select(Opportunity.id, literal(day), literal(delta)).where(Opportunity.id == opportunity_id))
+            cls.upsert(connection, ProviderResponseDaily,
+                       select(Opportunity.provider_id, literal(day), literal(delta))
+                           .where(Opportunity.id == opportunity_id))
+
+    @staticmethod
+    def upsert(connection: Connection, model: type[Base], source) -> int:
+        """Add counts selected by given statement, rows referring to missing entities must not be selected.
+           Returns amount of changed counters."""
+
+        table = model.__table__
+        keys = [column.name for column in table.primary_key.columns]
+        statement = insert(table).from_select(keys + ['count'], source)
+        statement = statement.on_conflict_do_update(
+            index_elements=keys, set_={'count': table.c.count + statement.excluded.count},
+        )
+        return connection.execute(statement).rowcount
+
+    @classmethod
+    def rebuild(cls, connection: Connection) -> None:
+        """Recompute all counters from 'opportunity_response' table."""
+
+        for model in (OpportunityResponseCounter, ProviderResponseCounter,
+                      OpportunityResponseDaily, ProviderResponseDaily):
+            connection.execute(model.__table__.delete())
+        day = cast(func.timezone('UTC', OpportunityResponse.created_at), Date)
+        rows = connection.execute(
+            select(OpportunityResponse.opportunity_id, day, func.count())
+                .group_by(OpportunityResponse.opportunity_id, day)
+        ).all()
+        cls.apply(connection, {(opportunity_id, day): count for opportunity_id, day, count in rows})
+
+    @classmethod
+    def get_opportunity_count(cls, session: Session, opportunity_id: int) -> int:
+        counter = session.get(OpportunityResponseCounter, opportunity_id)
+        return counter.count if counter is not None else 0
+
+    @classmethod
+    def get_provider_count(cls, session: Session, provider_id: int) -> int:
+        counter = session.get(ProviderResponseCounter, provider_id)
+        return counter.count if counter is not None else 0
+
+    @classmethod
+    def get_opportunity_trend(cls, session: Session, opportunity_id: int, since: date, until: date) -> dict[str, int]:
+        """Return amounts of responses per day in given inclusive range, days without responses are omitted."""
+
+        rows = session.execute(
+            select(OpportunityResponseDaily.day, OpportunityResponseDaily.count)
+                .where(OpportunityResponseDaily.opportunity_id == opportunity_id,
+                       OpportunityResponseDaily.day.between(since, until))
+                .order_by(OpportunityResponseDaily.day)
+        ).all()
+        return {day.isoformat(): count for day, count in rows}
+
+    @classmethod
+    def get_provider_trend(cls, session: Session, provider_id: int, since: date, until: date) -> dict[str, int]:
+        rows = session.execute(
+            select(ProviderResponseDaily.day, ProviderResponseDaily.count)
+                .where(ProviderResponseDaily.provider_id == provider_id,
+                       ProviderResponseDaily.day.between(since, until))
+                .order_by(ProviderResponseDaily.day)
+        ).all()
+        return {day.isoformat(): count for day, count in rows}
+
+
+def _response_day(response: OpportunityResponse) -> date | None:
+    return response.created_at.astimezone(UTC).date() if response.created_at is not None else None
+
+@event.listens_for(Session, 'after_flush')
+def _update_response_stats(session: Session, _flush_context) -> None:
+    deltas: defaultdict[tuple[int, date], int] = defaultdict(int)
+    for instance in session.new:
+        if isinstance(instance, OpportunityResponse):
+            deltas[(instance.opportunity_id, _response_day(instance))] += 1
+    for instance in session.deleted:
+        if isinstance(instance, OpportunityResponse):
+            deltas[(instance.opportunity_id, _response_day(instance))] -= 1
+    if len(deltas) > 0:
+        ResponseStats.apply(session.connection(), deltas)
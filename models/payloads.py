@@ -0,0 +1,274 @@
+from typing import Any, Callable, Hashable, Iterable
+from collections import OrderedDict, defaultdict
+from dataclasses import asdict
+from threading import Lock
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+try:
+    import orjson
+
+    def encode(payload: Any) -> bytes:
+        return orjson.dumps(payload)
+except ImportError:
+    import json
+
+    def encode(payload: Any) -> bytes:
+        return json.dumps(asdict(payload) if hasattr(payload, '__dataclass_fields__') else payload,
+                          ensure_ascii=False, separators=(',', ':')).encode()
+
+from .base import *
+from .auxillary.address import City
+from .auxillary.gazetteer import Gazetteer
+from .user import UserInfo
+from .opportunity.opportunity import (
+    Opportunity, OpportunityProvider, OpportunityTag, OpportunityGeotag, OpportunityCard, has_uncommitted_changes,
+)
+from .opportunity.form import OpportunityForm
+
+
+@dataclass(slots=True, frozen=True)
+class OpportunityPayload:
+    id: int
+    name: str
+    link: str | None
+    provider_id: int
+    provider_logo_url: str
+    provider_name: str
+    tags: dict[str, str]
+    geotags: dict[str, str]
+
+@dataclass(slots=True, frozen=True)
+class CardPayload:
+    opportunity_id: int
+    provider_logo_url: str
+    provider_name: str
+    card_title: str
+    card_subtitle: str | None
+    tags: dict[str, str]
+    geotags: dict[str, str]
+
+@dataclass(slots=True, frozen=True)
+class UserInfoPayload:
+    name: str | None
+    surname: str | None
+    birthday: str | None
+
+
+type Key = tuple[str, Hashable]
+
+class FragmentCache:
+    """LRU cache of encoded payloads. Every fragment is stored with keys of entities it was built from,
+       invalidating an entity drops all fragments depending on it. Every invalidation increments 'generation',
+       fragments built from reads made before the last invalidation of any of their keys aren't stored,
+       so a build racing with a commit can't cache stale data. Fragments expire after TTL seconds anyway."""
+
+    TTL: float = 600
+
+    def __init__(self, max_size: int = 100_000) -> None:
+        self.max_size = max_size
+        # key -> (fragment, dependencies, expiration time)
+        self.fragments: OrderedDict[Key, tuple[bytes, tuple[Key, ...], float]] = OrderedDict()
+        self.dependents: defaultdict[Key, set[Key]] = defaultdict(set)
+        self.generation = 0
+        # generations of the last invalidations of keys, the oldest ones are forgotten beyond max_size
+        self.invalidated: OrderedDict[Key, int] = OrderedDict()
+        # the latest forgotten generation, assumed for every key, which invalidation isn't remembered
+        self.forgotten = 0
+        self.lock = Lock()
+
+    def get(self, key: Key) -> bytes | None:
+        with self.lock:
+            if (entry := self.fragments.get(key)) is None:
+                return None
+            if entry[2] <= time.monotonic():
+                self._drop(key)
+                return None
+            self.fragments.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Key, fragment: bytes, depends_on: Iterable[Key], generation: int | None = None) -> bool:
+        """Store a fragment built from reads made at given generation (the current one by default).
+           Returns whether it was stored."""
+
+        dependencies = (key, *depends_on)
+        with self.lock:
+            if generation is not None and any(self.invalidated.get(dependency, self.forgotten) > generation
+                                              for dependency in dependencies):
+                return False
+            self._drop(key)
+            self.fragments[key] = (fragment, dependencies, time.monotonic() + self.TTL)
+            for dependency in dependencies:
+                self.dependents[dependency].add(key)
+            while len(self.fragments) > self.max_size:
+                self._drop(next(iter(self.fragments)))
+        return True
+
+    def get_or_build(self, key: Key, build: Callable[[], tuple[bytes, Iterable[Key]]],
+                     generation: int | None = None) -> bytes:
+        if (fragment := self.get(key)) is not None:
+            return fragment
+        if generation is None:
+            generation = self.generation
+        fragment, depends_on = build()
+        self.put(key, fragment, depends_on, generation)
+        return fragment
+
+    def invalidate(self, keys: Iterable[Key]) -> None:
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.invalidated[key] = self.generation
+                self.invalidated.move_to_end(key)
+                for dependent in self.dependents.pop(key, set()):
+                    self._drop(dependent)
+            while len(self.invalidated) > self.max_size:
+                self.forgotten = max(self.forgotten, self.invalidated.popitem(last=False)[1])
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.forgotten = self.generation
+            self.invalidated.clear()
+            self.fragments.clear()
+            self.dependents.clear()
+
+    def _drop(self, key: Key) -> None:
+        if (entry := self.fragments.pop(key, None)) is None:
+            return
+        for dependency in entry[1]:
+            if (dependents := self.dependents.get(dependency)) is not None:
+                dependents.discard(key)
+                if len(dependents) == 0:
+                    del self.dependents[dependency]
+
+
+class Payloads:
+    """Fast path of 'get_dict' methods: payloads are built as slotted structs, encoded straight to JSON bytes
+       and cached per entity, so that a listing is mostly a concatenation of cached fragments. Sessions with
+       uncommitted changes bypass the cache, as their reads aren't what other sessions see."""
+
+    cache = FragmentCache()
+
+    @classmethod
+    def cached(cls, key: Key, instance: Base, build: Callable[[], tuple[bytes, Iterable[Key]]]) -> bytes:
+        """Fragment of given key, built from an instance if it isn't cached. Fragments are stamped with
+           the cache generation at the start of the transaction, that loaded the instance."""
+
+        if (session := object_session(instance)) is None:
+            return cls.cache.get_or_build(key, build)
+        if has_uncommitted_changes(session):
+            return build()[0]
+        return cls.cache.get_or_build(key, build, session.info.get(_CACHE_GENERATION, cls.cache.forgotten))
+
+    @staticmethod
+    def opportunity_dependencies(opportunity: Opportunity) -> list[Key]:
+        return [
+            ('opportunity', opportunity.id), ('provider', opportunity.provider_id),
+            *(('tag', tag.id) for tag in opportunity.tags),
+            *(('geotag', geotag.id) for geotag in opportunity.geotags),
+            *(('city', geotag.city_id) for geotag in opportunity.geotags),
+        ]
+
+    @staticmethod
+    def tag_map(opportunity: Opportunity) -> dict[str, str]:
+        return {str(tag.id): tag.name for tag in opportunity.tags}
+
+    @staticmethod
+    def geotag_map(opportunity: Opportunity) -> dict[str, str]:
+        return {str(geotag.id): Gazetteer.city_name(geotag) for geotag in opportunity.geotags}
+
+    @classmethod
+    def opportunity(cls, opportunity: Opportunity) -> bytes:
+        def build() -> tuple[bytes, list[Key]]:
+            payload = OpportunityPayload(
+                id=opportunity.id, name=opportunity.name, link=opportunity.link,
+                provider_id=opportunity.provider_id, provider_logo_url=opportunity.provider.logo_url,
+                provider_name=opportunity.provider.name,
+                tags=cls.tag_map(opportunity), geotags=cls.geotag_map(opportunity),
+            )
+            return encode(payload), cls.opportunity_dependencies(opportunity)
+        return cls.cached(('opportunity', opportunity.id), opportunity, build)
+
+    @classmethod
+    def card(cls, card: OpportunityCard) -> bytes:
+        def build() -> tuple[bytes, list[Key]]:
+            opportunity = card.opportunity
+            payload = CardPayload(
+                opportunity_id=card.opportunity_id, provider_logo_url=opportunity.provider.logo_url,
+                provider_name=opportunity.provider.name, card_title=card.title, card_subtitle=card.subtitle,
+                tags=cls.tag_map(opportunity), geotags=cls.geotag_map(opportunity),
+            )
+            return encode(payload), cls.opportunity_dependencies(opportunity)
+        return cls.cached(('card', card.id), card, build)
+
+    @classmethod
+    def user_info(cls, user_info: UserInfo) -> bytes:
+        def build() -> tuple[bytes, list[Key]]:
+            birthday = user_info.birthday.strftime('%Y-%m-%d') if user_info.birthday is not None else None
+            return encode(UserInfoPayload(name=user_info.name, surname=user_info.surname, birthday=birthday)), []
+        return cls.cached(('user_info', user_info.user_id), user_info, build)
+
+    @classmethod
+    def form(cls, form: OpportunityForm) -> bytes:
+        return cls.cache.get_or_build(('form', form.id), lambda: (encode(form.get_dict()), []))
+
+    @staticmethod
+    def listing(fragments: Iterable[bytes]) -> bytes:
+        return b'[' + b','.join(fragments) + b']'
+
+    @classmethod
+    def opportunities(cls, opportunities: Iterable[Opportunity]) -> bytes:
+        return cls.listing(cls.opportunity(opportunity) for opportunity in opportunities)
+
+    @classmethod
+    def cards(cls, cards: Iterable[OpportunityCard]) -> bytes:
+        return cls.listing(cls.card(card) for card in cards)
+
+
+_INVALIDATED_KEYS = 'invalidated_payload_keys'
+# cache generation at the start of the transaction of a session, see 'Payloads.cached'
+_CACHE_GENERATION = 'payload_cache_generation'
+
+def entity_key(instance: Any) -> Key | None:
+    match instance:
+        case Opportunity():
+            return ('opportunity', instance.id)
+        case OpportunityCard():
+            return ('card', instance.id)
+        case OpportunityProvider():
+            return ('provider', instance.id)
+        case OpportunityTag():
+            return ('tag', instance.id)
+        case OpportunityGeotag():
+            return ('geotag', instance.id)
+        case City():
+            return ('city', instance.id)
+        case UserInfo():
+            return ('user_info', instance.user_id)
+    return None
+
+@event.listens_for(Session, 'after_begin')
+def _stamp_payload_generation(session: Session, _transaction, _connection) -> None:
+    session.info[_CACHE_GENERATION] = Payloads.cache.generation
+
+@event.listens_for(Session, 'after_flush')
+def _collect_invalidated_payloads(session: Session, _flush_context) -> None:
+    keys = session.info.setdefault(_INVALIDATED_KEYS, set())
+    for instance in session.dirty | session.deleted:
+        if (key := entity_key(instance)) is not None:
+            keys.add(key)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_payloads(session: Session) -> None:
+    session.info.pop(_CACHE_GENERATION, None)
+    Payloads.cache.invalidate(session.info.pop(_INVALIDATED_KEYS, ()))
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_invalidated_payloads(session: Session, _previous_transaction) -> None:
+    session.info.pop(_CACHE_GENERATION, None)
+    session.info.pop(_INVALIDATED_KEYS, None)
+
+OpportunityForm.change_listeners.append(lambda form_id: Payloads.cache.invalidate([('form', form_id)]))
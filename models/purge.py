@@ -0,0 +1,328 @@
+from typing import Iterator
+from datetime import datetime
+from collections import defaultdict
+
+from minio import Minio
+from minio.deleteobjects import DeleteObject
+from sqlalchemy import Text, Date, select, func, cast, delete, update
+from sqlalchemy.dialects.postgresql import TIMESTAMP
+
+from ..utils import *
+from .base import *
+from .changes import EntityChange
+from .blobs import Blob
+from .images import THUMBNAIL_SIZES, ThumbnailFormat, thumbnail_filename
+from .user import User, UserInfo, PersonalAPIKey, CV, UserAvatarFormat
+from .opportunity.opportunity import (
+    Opportunity, OpportunityProvider, OpportunityToTag, OpportunityToGeotag, OpportunityCard, OpportunityResponse,
+    OpportunityDescriptionFormat, ProviderLogoFormat,
+)
+from .opportunity.form import OpportunityForm, ResponseData
+from .opportunity.stats import ResponseStats
+from .opportunity.partitions import ResponsePartitions
+from .opportunity.delivery import ResponseDelivery
+from .opportunity.archive import ArchivedOpportunity, ArchivedOpportunityCard
+
+
+class PurgeKind(IntEnum):
+    USER = 0
+    OPPORTUNITY = 1
+    PROVIDER = 2
+
+class PurgeStage(IntEnum):
+    """Stages of a purge in order of execution. Every stage reads what it removes from rows, that are still
+       present, and is safe to repeat, so a failed purge is resumed from the stage, that failed."""
+
+    CREATED = 0
+    # responses with their documents, in batches committed one by one
+    RESPONSES = 1
+    # forms and leftover response documents
+    DOCUMENTS = 2
+    # descriptions, logos, avatars, thumbnails and CVs
+    OBJECTS = 3
+    # all remaining rows in one transaction
+    ROWS = 4
+
+class PurgeJob(Base):
+    __tablename__ = 'purge_job'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    kind: Mapped[PurgeKind]
+    target_id: Mapped[int]
+    # the last completed stage
+    stage: Mapped[PurgeStage] = mapped_column(default=PurgeStage.CREATED)
+    attempts: Mapped[int] = mapped_column(default=0)
+    error: Mapped[str | None] = mapped_column(Text, nullable=True, default=None)
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
+    finished_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True), nullable=True, default=None,
+                                                         index=True)
+
+
+class Purge:
+    """Set-based deletion of users, opportunities and providers with everything they own in Postgres,
+       MongoDB and MinIO. Progress is stored in 'purge_job' table, unfinished jobs are continued by 'resume'."""
+
+    BATCH_SIZE: int = 5000
+
+    @classmethod
+    def request(cls, session: Session, kind: PurgeKind, target_id: int) -> PurgeJob:
+        job = session.execute(
+            select(PurgeJob).where(PurgeJob.kind == kind, PurgeJob.target_id == target_id,
+                                   PurgeJob.finished_at.is_(None))
+        ).scalars().first()
+        if job is None:
+            job = PurgeJob(kind=kind, target_id=target_id)
+            session.add(job)
+            session.flush([job])
+        return job
+
+    @classmethod
+    def user(cls, session_factory, minio_client: Minio, user_id: int) -> bool:
+        return cls.purge(session_factory, minio_client, PurgeKind.USER, user_id)
+
+    @classmethod
+    def opportunity(cls, session_factory, minio_client: Minio, opportunity_id: int) -> bool:
+        return cls.purge(session_factory, minio_client, PurgeKind.OPPORTUNITY, opportunity_id)
+
+    @classmethod
+    def provider(cls, session_factory, minio_client: Minio, provider_id: int) -> bool:
+        return cls.purge(session_factory, minio_client, PurgeKind.PROVIDER, provider_id)
+
+    @classmethod
+    def purge(cls, session_factory, minio_client: Minio, kind: PurgeKind, target_id: int) -> bool:
+        with session_factory.begin() as session:
+            job_id = cls.request(session, kind, target_id).id
+        return cls.run(session_factory, minio_client, job_id)
+
+    @classmethod
+    def resume(cls, session_factory, minio_client: Minio) -> int:
+        """Run all unfinished jobs, return amount of successfully finished ones."""
+
+        with session_factory() as session:
+            job_ids = session.execute(
+                select(PurgeJob.id).where(PurgeJob.finished_at.is_(None)).order_by(PurgeJob.id)
+            ).scalars().all()
+        return sum(cls.run(session_factory, minio_client, job_id) for job_id in job_ids)
+
+    @classmethod
+    def run(cls, session_factory, minio_client: Minio, job_id: int) -> bool:
+        """Execute remaining stages of a job. Returns whether the job is finished, failure is recorded
+           in the job, so that it's visible and can be resumed."""
+
+        with session_factory.begin() as session:
+            job = session.get(PurgeJob, job_id)
+            job.attempts += 1
+            kind, target_id, completed = job.kind, job.target_id, job.stage
+        stages = {
+            PurgeStage.RESPONSES: lambda: cls.purge_responses(session_factory, kind, target_id),
+            PurgeStage.DOCUMENTS: lambda: cls.purge_documents(session_factory, kind, target_id),
+            PurgeStage.OBJECTS: lambda: cls.purge_objects(session_factory, minio_client, kind, target_id),
+            PurgeStage.ROWS: lambda: cls.purge_rows(session_factory, kind, target_id),
+        }
+        for stage, execute in stages.items():
+            if stage <= completed:
+                continue
+            try:
+                execute()
+            except Exception as error:
+                logger.exception('Purge failed (job_id=%s, stage=\'%s\')', job_id, stage.name)
+                with session_factory.begin() as session:
+                    session.execute(update(PurgeJob).where(PurgeJob.id == job_id).values(error=repr(error)))
+                return False
+            with session_factory.begin() as session:
+                values = {'stage': stage, 'error': None}
+                if stage == PurgeStage.ROWS:
+                    values['finished_at'] = func.now()
+                session.execute(update(PurgeJob).where(PurgeJob.id == job_id).values(**values))
+        return True
+
+    # scope of a job
+
+    @staticmethod
+    def opportunity_ids(kind: PurgeKind, target_id: int):
+        """Ids of live and archived opportunities in the scope of a job."""
+
+        match kind:
+            case PurgeKind.OPPORTUNITY:
+                return select(Opportunity.id).where(Opportunity.id == target_id) \
+                    .union(select(ArchivedOpportunity.id).where(ArchivedOpportunity.id == target_id))
+            case PurgeKind.PROVIDER:
+                return select(Opportunity.id).where(Opportunity.provider_id == target_id) \
+                    .union(select(ArchivedOpportunity.id).where(ArchivedOpportunity.provider_id == target_id))
+        return None
+
+    @classmethod
+    def response_condition(cls, kind: PurgeKind, target_id: int):
+        if kind == PurgeKind.USER:
+            return OpportunityResponse.user_id == target_id
+        return OpportunityResponse.opportunity_id.in_(cls.opportunity_ids(kind, target_id))
+
+    # stages
+
+    @classmethod
+    def delete_responses(cls, session: Session, condition, limit: int | None = None) -> int:
+        """Delete responses matching given condition along with their documents and counters.
+           Returns amount of deleted responses."""
+
+        day = cast(func.timezone('UTC', OpportunityResponse.created_at), Date)
+        rows = session.execute(
+            select(OpportunityResponse.id, OpportunityResponse.opportunity_id, day)
+                .where(condition)
+                .limit(limit)
+                .with_for_update()
+        ).all()
+        if len(rows) == 0:
+            return 0
+        cls.forget_responses(session, rows)
+        session.execute(delete(OpportunityResponse).where(OpportunityResponse.id.in_([id for id, _, _ in rows])))
+        return len(rows)
+
+    @staticmethod
+    def forget_responses(session: Session, rows) -> None:
+        """Delete documents, deliveries and counts of responses given as (id, opportunity id, day) rows."""
+
+        ids = [id for id, _, _ in rows]
+        ResponseData._get_collection().delete_many({'_id': {'$in': ids}})
+        session.execute(delete(ResponseDelivery).where(ResponseDelivery.response_id.in_(ids)))
+        deltas: defaultdict[tuple, int] = defaultdict(int)
+        for _, opportunity_id, response_day in rows:
+            deltas[(opportunity_id, response_day)] -= 1
+        ResponseStats.apply(session.connection(), deltas)
+
+    @classmethod
+    def delete_archived_responses(cls, session: Session, kind: PurgeKind, target_id: int) -> int:
+        """Delete responses in the scope of a job from archived partitions. Returns amount of deleted ones."""
+
+        count = 0
+        for archived in ResponsePartitions.archived(session.connection()):
+            if kind == PurgeKind.USER:
+                condition = archived.c.user_id == target_id
+            else:
+                condition = archived.c.opportunity_id.in_(cls.opportunity_ids(kind, target_id))
+            day = cast(func.timezone('UTC', archived.c.created_at), Date)
+            rows = session.execute(
+                delete(archived).where(condition).returning(archived.c.id, archived.c.opportunity_id, day)
+            ).all()
+            if len(rows) > 0:
+                cls.forget_responses(session, rows)
+            count += len(rows)
+        return count
+
+    @classmethod
+    def purge_responses(cls, session_factory, kind: PurgeKind, target_id: int) -> None:
+        while True:
+            with session_factory.begin() as session:
+                if cls.delete_responses(session, cls.response_condition(kind, target_id), cls.BATCH_SIZE) == 0:
+                    return
+
+    @classmethod
+    def purge_documents(cls, session_factory, kind: PurgeKind, target_id: int) -> None:
+        if kind == PurgeKind.USER:
+            return
+        with session_factory() as session:
+            opportunity_ids = session.execute(cls.opportunity_ids(kind, target_id)).scalars().all()
+        if len(opportunity_ids) == 0:
+            return
+        ResponseData._get_collection().delete_many({'opportunity_id': {'$in': opportunity_ids}})
+        OpportunityForm._get_collection().delete_many({'_id': {'$in': opportunity_ids}})
+
+    @classmethod
+    def object_names(cls, session: Session, kind: PurgeKind, target_id: int) -> Iterator[tuple[str, str]]:
+        """(bucket, object name) of all objects named after purged entities. Blobs are not listed,
+           their references are released along with rows."""
+
+        def image_names(stem: str, extension: str) -> Iterator[str]:
+            yield f'{stem}.{extension}'
+            for size in THUMBNAIL_SIZES:
+                for format in ThumbnailFormat:
+                    yield thumbnail_filename(stem, size, format)
+
+        if kind == PurgeKind.USER:
+            for extension in {format.value[0] for format in UserAvatarFormat}:
+                yield from (('user-avatar', name) for name in image_names(str(target_id), extension))
+            for id, format in session.execute(
+                    select(CV.id, CV.format).where(CV.user_info_id == target_id, CV.blob_digest.is_(None))):
+                yield 'user-cv', f'{id}.{format.value[0]}'
+            return
+        if kind == PurgeKind.PROVIDER:
+            for extension in {format.value[0] for format in ProviderLogoFormat}:
+                yield from (('opportunity-provider-logo', name) for name in image_names(str(target_id), extension))
+        for id in session.execute(cls.opportunity_ids(kind, target_id)).scalars():
+            yield 'opportunity-description', f'{id}.md'
+            for format in OpportunityDescriptionFormat:
+                yield 'opportunity-description', f'{id}.{format.value[0]}.gz'
+
+    @classmethod
+    def purge_objects(cls, session_factory, minio_client: Minio, kind: PurgeKind, target_id: int) -> None:
+        buckets: defaultdict[str, list[str]] = defaultdict(list)
+        with session_factory() as session:
+            for bucket, name in cls.object_names(session, kind, target_id):
+                buckets[bucket].append(name)
+        for bucket, names in buckets.items():
+            for start in range(0, len(names), 1000):
+                # removal is lazy, it happens while errors are iterated
+                errors = list(minio_client.remove_objects(
+                    bucket, [DeleteObject(name) for name in names[start:start + 1000]]))
+                if len(errors) > 0:
+                    raise RuntimeError(f'Failed to remove objects from \'{bucket}\': {errors[:10]}')
+
+    @classmethod
+    def release_blobs(cls, session: Session, bucket: str, digests) -> None:
+        """Release one reference of blob per row of given digest subquery."""
+
+        counts = (
+            select(digests.c.digest, func.count().label('count'))
+                .where(digests.c.digest.is_not(None))
+                .group_by(digests.c.digest)
+                .subquery()
+        )
+        released = session.execute(
+            update(Blob)
+                .where(Blob.bucket == bucket, Blob.digest == counts.c.digest)
+                .values(ref_count=Blob.ref_count - counts.c.count)
+                .returning(Blob.digest, Blob.ref_count)
+        ).all()
+        session.info.setdefault('released_blobs', set()).update(
+            (bucket, digest) for digest, ref_count in released if ref_count <= 0)
+
+    @classmethod
+    def purge_rows(cls, session_factory, kind: PurgeKind, target_id: int) -> None:
+        changes: set[tuple[str, str]] = set()
+        with session_factory.begin() as session:
+            if kind == PurgeKind.USER:
+                cls.release_blobs(session, 'user-cv', select(CV.blob_digest.label('digest'))
+                                  .where(CV.user_info_id == target_id).subquery())
+                cls.release_blobs(session, 'user-avatar', select(UserInfo.avatar_digest.label('digest'))
+                                  .where(UserInfo.user_id == target_id).subquery())
+                session.execute(delete(CV).where(CV.user_info_id == target_id))
+                keys = session.execute(
+                    delete(PersonalAPIKey).where(PersonalAPIKey.user_id == target_id).returning(PersonalAPIKey.key)
+                ).scalars().all()
+                changes.update(('PersonalAPIKey', key) for key in keys)
+                # responses created after the responses stage
+                cls.delete_responses(session, cls.response_condition(kind, target_id))
+                cls.delete_archived_responses(session, kind, target_id)
+                if session.execute(delete(UserInfo).where(UserInfo.user_id == target_id)).rowcount > 0:
+                    changes.add(('UserInfo', str(target_id)))
+                session.execute(delete(User).where(User.id == target_id))
+            else:
+                opportunity_ids = session.execute(cls.opportunity_ids(kind, target_id)).scalars().all()
+                cls.delete_responses(session, cls.response_condition(kind, target_id))
+                cls.delete_archived_responses(session, kind, target_id)
+                session.execute(delete(OpportunityToTag).where(OpportunityToTag.opportunity_id.in_(opportunity_ids)))
+                session.execute(delete(OpportunityToGeotag)
+                                .where(OpportunityToGeotag.opportunity_id.in_(opportunity_ids)))
+                card_ids = session.execute(
+                    delete(OpportunityCard).where(OpportunityCard.opportunity_id.in_(opportunity_ids))
+                        .returning(OpportunityCard.id)
+                ).scalars().all()
+                changes.update(('OpportunityCard', str(id)) for id in card_ids)
+                session.execute(delete(Opportunity).where(Opportunity.id.in_(opportunity_ids)))
+                session.execute(delete(ArchivedOpportunityCard)
+                                .where(ArchivedOpportunityCard.opportunity_id.in_(opportunity_ids)))
+                session.execute(delete(ArchivedOpportunity).where(ArchivedOpportunity.id.in_(opportunity_ids)))
+                changes.update(('Opportunity', str(id)) for id in opportunity_ids)
+                if kind == PurgeKind.PROVIDER:
+                    session.execute(delete(OpportunityProvider).where(OpportunityProvider.id == target_id))
+                    changes.add(('OpportunityProvider', str(target_id)))
+            EntityChange.log(session.connection(), changes)
@@ -0,0 +1,290 @@
+from typing import Iterable
+from datetime import date, datetime, UTC
+from dataclasses import dataclass
+from collections import Counter
+from threading import Event, Lock, Thread
+import math
+import time
+
+from sqlalchemy import Engine, BigInteger, Enum as SQLEnum, select, func
+from sqlalchemy.dialects.postgresql import TIMESTAMP, insert
+
+from ..utils import *
+from .base import *
+from .changes import EntityChange
+from .user import PersonalAPIKey, APIKey
+
+
+@dataclass(frozen=True, slots=True)
+class RateLimit:
+    # tokens added per second
+    rate: float
+    # bucket capacity, i.e. the longest burst of requests
+    burst: int
+
+# explicitly named, default name of the type would be 'type'
+KEY_TYPE = SQLEnum(APIKey.Type, name='api_key_type')
+
+class APIKeyLimit(Base):
+    """Rate limit of a single key, overriding default limit of its type."""
+
+    __tablename__ = 'api_key_limit'
+
+    key_type: Mapped[APIKey.Type] = mapped_column(KEY_TYPE, primary_key=True)
+    key_id: Mapped[int] = mapped_column(primary_key=True)
+    rate: Mapped[float]
+    burst: Mapped[int]
+
+class APIKeyUsage(Base):
+    __tablename__ = 'api_key_usage'
+
+    key_type: Mapped[APIKey.Type] = mapped_column(KEY_TYPE, primary_key=True)
+    key_id: Mapped[int] = mapped_column(primary_key=True)
+    day: Mapped[date] = mapped_column(primary_key=True)
+    # served requests, rejected ones are counted separately
+    requests: Mapped[int] = mapped_column(BigInteger, default=0)
+    rejected: Mapped[int] = mapped_column(BigInteger, default=0)
+
+class APIKeyBucket(Base):
+    """Token bucket shared by all processes, they take tokens from it in leases, see 'RateLimiter.SHARED'."""
+
+    __tablename__ = 'api_key_bucket'
+
+    key_type: Mapped[APIKey.Type] = mapped_column(KEY_TYPE, primary_key=True)
+    key_id: Mapped[int] = mapped_column(primary_key=True)
+    tokens: Mapped[float]
+    updated_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True))
+
+EntityChange.track(APIKeyLimit, get_id=lambda limit: f'{limit.key_type.value}-{limit.key_id}')
+
+
+class RateLimitErrorCode(IntEnum):
+    RATE_LIMITED = 0
+
+type RateLimitError = GenericError[RateLimitErrorCode, dict[str, float]]
+
+type KeyIdentity = tuple[APIKey.Type, int]
+
+def key_identity(api_key: APIKey.KeysUnion) -> KeyIdentity:
+    # personal keys are limited per user, not per address they were issued for
+    if isinstance(api_key, PersonalAPIKey):
+        return APIKey.Type.Personal, api_key.user_id
+    return APIKey.Type.Developer, api_key.id
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated_at', 'limit', 'next_lease')
+
+    def __init__(self, limit: RateLimit, tokens: float) -> None:
+        self.limit = limit
+        self.tokens = tokens
+        self.updated_at = time.monotonic()
+        # shared bucket isn't queried before this time, after it ran out of tokens
+        self.next_lease = 0.0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.limit.burst, self.tokens + (now - self.updated_at) * self.limit.rate)
+        self.updated_at = now
+
+    def take(self, cost: float) -> bool:
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def retry_after(self, cost: float) -> float:
+        return (cost - self.tokens) / self.limit.rate if self.limit.rate > 0 else math.inf
+
+
+class RateLimiter:
+    """Process-wide token bucket limiter of API keys. Requests are checked against in-process buckets,
+       limits of keys are cached and usage is counted in memory and written by a flusher thread every
+       FLUSH_INTERVAL seconds. Without SHARED every process grants the full rate, with it processes lease
+       tokens from 'api_key_bucket' rows in batches of LEASE, so the rate is shared at the cost of one
+       query per lease. Once the shared bucket of a key runs out, requests are rejected locally until
+       it's expected to have tokens again."""
+
+    DEFAULT_LIMITS: dict[APIKey.Type, RateLimit] = {
+        APIKey.Type.Personal: RateLimit(rate=5, burst=20),
+        APIKey.Type.Developer: RateLimit(rate=50, burst=200),
+    }
+    # limits of keys are re-read after this time, even if their change notification is missed
+    LIMIT_TTL: float = 60
+    FLUSH_INTERVAL: float = 10
+    SHARED: bool = False
+    LEASE: int = 10
+    # requests aren't limited nor counted until enabled, see 'configure'
+    ENABLED: bool = False
+
+    engine: Engine | None = None
+    buckets: dict[KeyIdentity, TokenBucket] = {}
+    limits: dict[KeyIdentity, tuple[float, RateLimit]] = {}
+    # (key type, key id, day, whether request was rejected) -> amount of requests
+    usage: Counter[tuple[APIKey.Type, int, date, bool]] = Counter()
+    lock = Lock()
+    thread: Thread | None = None
+    stopped = Event()
+
+    @classmethod
+    def configure(cls, engine: Engine, enabled: bool = True, shared: bool = False) -> None:
+        cls.engine = engine
+        cls.ENABLED = enabled
+        cls.SHARED = shared
+
+    @classmethod
+    def get_limit(cls, session: Session, identity: KeyIdentity) -> RateLimit:
+        now = time.monotonic()
+        with cls.lock:
+            entry = cls.limits.get(identity)
+        if entry is not None and entry[0] >= now:
+            return entry[1]
+        override = session.get(APIKeyLimit, identity)
+        limit = RateLimit(override.rate, override.burst) if override is not None else cls.DEFAULT_LIMITS[identity[0]]
+        with cls.lock:
+            cls.limits[identity] = (now + cls.LIMIT_TTL, limit)
+        return limit
+
+    @classmethod
+    def invalidate(cls, identities: Iterable[KeyIdentity] | None = None) -> None:
+        with cls.lock:
+            if identities is None:
+                cls.limits.clear()
+                return
+            for identity in identities:
+                cls.limits.pop(identity, None)
+
+    @classmethod
+    def lease(cls, identity: KeyIdentity, limit: RateLimit, amount: float) -> float:
+        """Take up to given amount of tokens from the shared bucket of a key. Returns amount of taken tokens.
+           Runs in its own short transaction, so that the bucket row isn't locked until the request ends."""
+
+        with Session(cls.engine) as session, session.begin():
+            return cls.take_shared(session, identity, limit, amount)
+
+    @staticmethod
+    def take_shared(session: Session, identity: KeyIdentity, limit: RateLimit, amount: float) -> float:
+        session.execute(
+            insert(APIKeyBucket)
+                .values(key_type=identity[0], key_id=identity[1], tokens=limit.burst, updated_at=func.now())
+                .on_conflict_do_nothing()
+        )
+        bucket, now = session.execute(
+            select(APIKeyBucket, func.now())
+                .where(APIKeyBucket.key_type == identity[0], APIKeyBucket.key_id == identity[1])
+                .with_for_update()
+        ).one()
+        tokens = min(limit.burst, bucket.tokens + (now - bucket.updated_at).total_seconds() * limit.rate)
+        taken = max(0, min(amount, math.floor(tokens)))
+        bucket.tokens, bucket.updated_at = tokens - taken, now
+        session.flush([bucket])
+        return taken
+
+    @classmethod
+    def acquire(cls, session: Session, api_key: APIKey.KeysUnion, cost: float = 1) -> None | RateLimitError:
+        """Take tokens for a request made with given key. Returns an error with number of seconds to wait
+           in 'retry_after' if the key is out of tokens."""
+
+        if not cls.ENABLED:
+            return None
+        identity = key_identity(api_key)
+        limit = cls.get_limit(session, identity)
+        now = time.monotonic()
+        with cls.lock:
+            if (bucket := cls.buckets.get(identity)) is None or bucket.limit != limit:
+                bucket = cls.buckets[identity] = TokenBucket(limit, 0 if cls.SHARED else limit.burst)
+            if not cls.SHARED:
+                bucket.refill(now)
+            allowed = bucket.take(cost)
+        if not allowed and cls.SHARED and bucket.next_lease <= now:
+            taken = cls.lease(identity, limit, max(cost, min(cls.LEASE, limit.burst)))
+            with cls.lock:
+                bucket.tokens += taken
+                if not (allowed := bucket.take(cost)):
+                    bucket.next_lease = now + (cost / limit.rate if limit.rate > 0 else cls.LIMIT_TTL)
+        with cls.lock:
+            cls.usage[(*identity, datetime.now(UTC).date(), not allowed)] += 1
+        if allowed:
+            return None
+        retry_after = max(0.0, bucket.next_lease - now) if cls.SHARED else bucket.retry_after(cost)
+        return GenericError(
+            error_code=RateLimitErrorCode.RATE_LIMITED,
+            error_message='Too many requests',
+            context={'retry_after': retry_after},
+        )
+
+    @classmethod
+    def flush(cls, session: Session) -> int:
+        """Add usage counted since the last flush to 'api_key_usage'. Returns amount of written rows."""
+
+        now = time.monotonic()
+        with cls.lock:
+            usage, cls.usage = cls.usage, Counter()
+            # buckets idle long enough to be full again are recreated on demand
+            cls.buckets = {
+                identity: bucket for identity, bucket in cls.buckets.items()
+                if cls.SHARED or (now - bucket.updated_at) * bucket.limit.rate < bucket.limit.burst
+            }
+        rows: dict[tuple[APIKey.Type, int, date], list[int]] = {}
+        for (key_type, key_id, day, rejected), count in usage.items():
+            rows.setdefault((key_type, key_id, day), [0, 0])[int(rejected)] += count
+        if len(rows) == 0:
+            return 0
+        statement = insert(APIKeyUsage).values([
+            {'key_type': key_type, 'key_id': key_id, 'day': day, 'requests': requests, 'rejected': rejected}
+            for (key_type, key_id, day), (requests, rejected) in sorted(rows.items())
+        ])
+        try:
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[APIKeyUsage.key_type, APIKeyUsage.key_id, APIKeyUsage.day],
+                set_={'requests': APIKeyUsage.requests + statement.excluded.requests,
+                      'rejected': APIKeyUsage.rejected + statement.excluded.rejected},
+            ))
+        except Exception:
+            # written by the next flush instead
+            with cls.lock:
+                cls.usage.update(usage)
+            raise
+        return len(rows)
+
+    @classmethod
+    def get_usage(cls, session: Session, api_key: APIKey.KeysUnion,
+                  since: date, until: date) -> dict[str, tuple[int, int]]:
+        """Return (requests, rejected requests) per day in given inclusive range, idle days are omitted."""
+
+        key_type, key_id = key_identity(api_key)
+        rows = session.execute(
+            select(APIKeyUsage.day, APIKeyUsage.requests, APIKeyUsage.rejected)
+                .where(APIKeyUsage.key_type == key_type, APIKeyUsage.key_id == key_id,
+                       APIKeyUsage.day.between(since, until))
+                .order_by(APIKeyUsage.day)
+        ).all()
+        return {day.isoformat(): (requests, rejected) for day, requests, rejected in rows}
+
+    @classmethod
+    def run(cls) -> None:
+        while not cls.stopped.wait(cls.FLUSH_INTERVAL):
+            try:
+                with Session(cls.engine) as session, session.begin():
+                    cls.flush(session)
+            except Exception:
+                logger.exception('Failed to flush API key usage')
+
+    @classmethod
+    def start(cls, engine: Engine | None = None) -> None:
+        if engine is not None:
+            cls.engine = engine
+        if cls.thread is not None:
+            return
+        cls.stopped.clear()
+        cls.thread = Thread(target=cls.run, name='api-key-usage', daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def stop(cls) -> None:
+        if cls.thread is None:
+            return
+        cls.stopped.set()
+        cls.thread.join()
+        cls.thread = None
+        with Session(cls.engine) as session, session.begin():
+            cls.flush(session)
@@ -0,0 +1,366 @@
+from typing import Any, Iterator
+from collections import defaultdict
+from threading import Lock
+import mmap
+import os
+import struct
+import sys
+
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from .base import *
+from .changes import EntityChange
+from .auxillary.address import Country, City
+from .opportunity.opportunity import (
+    Opportunity, OpportunityProvider, OpportunityTag, OpportunityGeotag, OpportunityToTag, OpportunityToGeotag,
+)
+
+
+@dataclass(slots=True, frozen=True)
+class ProviderRecord:
+    id: int
+    name: str
+
+@dataclass(slots=True, frozen=True)
+class TagRecord:
+    id: int
+    name: str
+
+@dataclass(slots=True, frozen=True)
+class GeotagRecord:
+    id: int
+    city_id: int
+    city_name: str
+    country_name: str
+
+@dataclass(slots=True, frozen=True)
+class OpportunityRecord:
+    id: int
+    name: str
+    link: str | None
+    provider_id: int
+    tag_ids: tuple[int, ...]
+    geotag_ids: tuple[int, ...]
+    has_description: bool
+    has_form: bool
+
+
+# File layout: header, section table, then sections. All numbers are little-endian, strings are
+# stored once in a string table and referenced by index, records are sorted by id.
+MAGIC = b'OFCS'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sIQ')
+SECTION = struct.Struct('<QQ')
+SECTIONS = ('string_offsets', 'string_data', 'providers', 'tags', 'geotags', 'opportunities', 'tag_refs', 'geotag_refs')
+U32 = struct.Struct('<I')
+PROVIDER = struct.Struct('<II')
+TAG = struct.Struct('<II')
+GEOTAG = struct.Struct('<IIII')
+OPPORTUNITY = struct.Struct('<9I')
+NO_STRING = 0xFFFFFFFF
+# logged entities, that affect snapshot records
+SNAPSHOT_ENTITIES = {'Opportunity', 'OpportunityProvider', 'OpportunityTag', 'OpportunityGeotag', 'City', 'Country'}
+HAS_DESCRIPTION, HAS_FORM = 1, 2
+
+
+def write_snapshot(session: Session, path: str) -> int:
+    """Write snapshot of the catalog to given path atomically and return its change sequence number."""
+
+    # taken before reading data, so that changes made during the build are re-applied by readers
+    last_seq = EntityChange.last_seq(session)
+    strings: dict[str, int] = {}
+
+    def string(value: str | None) -> int:
+        if value is None:
+            return NO_STRING
+        return strings.setdefault(value, len(strings))
+
+    providers = b''.join(PROVIDER.pack(id, string(name)) for id, name in session.execute(
+        select(OpportunityProvider.id, OpportunityProvider.name).order_by(OpportunityProvider.id)))
+    tags = b''.join(TAG.pack(id, string(name)) for id, name in session.execute(
+        select(OpportunityTag.id, OpportunityTag.name).order_by(OpportunityTag.id)))
+    geotags = b''.join(GEOTAG.pack(id, city_id, string(city_name), string(country_name)) for
+                       id, city_id, city_name, country_name in session.execute(
+        select(OpportunityGeotag.id, City.id, City.name, Country.name)
+            .join(City, City.id == OpportunityGeotag.city_id)
+            .join(Country, Country.id == City.country_id)
+            .order_by(OpportunityGeotag.id)))
+    tag_refs: defaultdict[int, list[int]] = defaultdict(list)
+    for opportunity_id, tag_id in session.execute(select(OpportunityToTag.opportunity_id, OpportunityToTag.tag_id)):
+        tag_refs[opportunity_id].append(tag_id)
+    geotag_refs: defaultdict[int, list[int]] = defaultdict(list)
+    for opportunity_id, geotag_id in session.execute(
+            select(OpportunityToGeotag.opportunity_id, OpportunityToGeotag.geotag_id)):
+        geotag_refs[opportunity_id].append(geotag_id)
+    opportunity_rows, tag_ref_data, geotag_ref_data = [], bytearray(), bytearray()
+    for id, name, link, provider_id, has_description, has_form in session.execute(
+            select(Opportunity.id, Opportunity.name, Opportunity.link, Opportunity.provider_id,
+                   Opportunity.has_description, Opportunity.has_form).order_by(Opportunity.id)):
+        opportunity_tags, opportunity_geotags = sorted(tag_refs[id]), sorted(geotag_refs[id])
+        opportunity_rows.append(OPPORTUNITY.pack(
+            id, string(name), string(link), provider_id,
+            len(tag_ref_data) // U32.size, len(opportunity_tags),
+            len(geotag_ref_data) // U32.size, len(opportunity_geotags),
+            (HAS_DESCRIPTION if has_description else 0) | (HAS_FORM if has_form else 0),
+        ))
+        tag_ref_data += struct.pack(f'<{len(opportunity_tags)}I', *opportunity_tags)
+        geotag_ref_data += struct.pack(f'<{len(opportunity_geotags)}I', *opportunity_geotags)
+
+    encoded = [value.encode() for value in strings]
+    string_offsets = [0]
+    for value in encoded:
+        string_offsets.append(string_offsets[-1] + len(value))
+    sections = [
+        (struct.pack(f'<{len(string_offsets)}I', *string_offsets), len(string_offsets)),
+        (b''.join(encoded), len(encoded)),
+        (providers, len(providers) // PROVIDER.size),
+        (tags, len(tags) // TAG.size),
+        (geotags, len(geotags) // GEOTAG.size),
+        (b''.join(opportunity_rows), len(opportunity_rows)),
+        (bytes(tag_ref_data), len(tag_ref_data) // U32.size),
+        (bytes(geotag_ref_data), len(geotag_ref_data) // U32.size),
+    ]
+    offset = HEADER.size + SECTION.size * len(SECTIONS)
+    table = bytearray()
+    for data, count in sections:
+        table += SECTION.pack(offset, count)
+        offset += len(data)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, last_seq))
+        file.write(table)
+        for data, _ in sections:
+            file.write(data)
+    os.replace(temporary_path, path)
+    return last_seq
+
+
+class SnapshotFile:
+    """Memory-mapped snapshot file with the overlay of changes applied on top of it. Overlay dictionaries
+       are replaced, not modified, so readers iterating them are never affected by a refresh."""
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, last_seq = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            data.close()
+            raise ValueError(f'Unsupported catalog snapshot: {path}')
+        # not closed explicitly, readers may still use it after a newer file is opened
+        self.data = data
+        self.file_id = (stat.st_ino, stat.st_mtime_ns)
+        self.file_seq = self.last_seq = last_seq
+        # sequence numbers applied within the lookback window, changes may commit out of sequence order
+        self.delivered: set[int] = set()
+        self.sections = {name: SECTION.unpack_from(data, HEADER.size + i * SECTION.size)
+                         for i, name in enumerate(SECTIONS)}
+        self.strings: dict[int, str] = {}
+        # overlay records replace ones from the file, None means the entity was deleted
+        self.overlay: dict[type, dict[int, Any]] = {}
+
+    def string(self, index: int) -> str | None:
+        if index == NO_STRING:
+            return None
+        if (value := self.strings.get(index)) is None:
+            offsets, _ = self.sections['string_offsets']
+            start, end = struct.unpack_from('<II', self.data, offsets + index * U32.size)
+            data_offset, _ = self.sections['string_data']
+            value = self.strings[index] = sys.intern(self.data[data_offset + start:data_offset + end].decode())
+        return value
+
+    def find(self, section: str, record: struct.Struct, id: int) -> tuple | None:
+        offset, count = self.sections[section]
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            middle_id = U32.unpack_from(self.data, offset + middle * record.size)[0]
+            if middle_id < id:
+                low = middle + 1
+            elif middle_id > id:
+                high = middle
+            else:
+                return record.unpack_from(self.data, offset + middle * record.size)
+        return None
+
+    def scan(self, section: str, record: struct.Struct) -> Iterator[tuple]:
+        offset, count = self.sections[section]
+        for i in range(count):
+            yield record.unpack_from(self.data, offset + i * record.size)
+
+    def refs(self, section: str, start: int, count: int) -> tuple[int, ...]:
+        offset, _ = self.sections[section]
+        return struct.unpack_from(f'<{count}I', self.data, offset + start * U32.size)
+
+    def provider_from_row(self, row: tuple) -> ProviderRecord:
+        return ProviderRecord(id=row[0], name=self.string(row[1]))
+
+    def tag_from_row(self, row: tuple) -> TagRecord:
+        return TagRecord(id=row[0], name=self.string(row[1]))
+
+    def geotag_from_row(self, row: tuple) -> GeotagRecord:
+        return GeotagRecord(id=row[0], city_id=row[1], city_name=self.string(row[2]), country_name=self.string(row[3]))
+
+    def opportunity_from_row(self, row: tuple) -> OpportunityRecord:
+        id, name, link, provider_id, tags_start, tags_count, geotags_start, geotags_count, flags = row
+        return OpportunityRecord(
+            id=id, name=self.string(name), link=self.string(link), provider_id=provider_id,
+            tag_ids=self.refs('tag_refs', tags_start, tags_count),
+            geotag_ids=self.refs('geotag_refs', geotags_start, geotags_count),
+            has_description=bool(flags & HAS_DESCRIPTION), has_form=bool(flags & HAS_FORM),
+        )
+
+    def get[R](self, record_type: type[R], id: int) -> R | None:
+        overlay = self.overlay.get(record_type, {})
+        if id in overlay:
+            return overlay[id]
+        section, record, from_row = self.layouts[record_type]
+        row = self.find(section, record, id)
+        return from_row(self, row) if row is not None else None
+
+    def all[R](self, record_type: type[R]) -> Iterator[R]:
+        overlay = self.overlay.get(record_type, {})
+        section, record, from_row = self.layouts[record_type]
+        for row in self.scan(section, record):
+            if row[0] not in overlay:
+                yield from_row(self, row)
+        yield from (value for value in overlay.values() if value is not None)
+
+    layouts = {
+        ProviderRecord: ('providers', PROVIDER, provider_from_row),
+        TagRecord: ('tags', TAG, tag_from_row),
+        GeotagRecord: ('geotags', GEOTAG, geotag_from_row),
+        OpportunityRecord: ('opportunities', OPPORTUNITY, opportunity_from_row),
+    }
+
+    def apply(self, record_type: type, ids: set[int], records: Iterator[Any]) -> None:
+        overlay = dict(self.overlay.get(record_type, {}))
+        for id in ids:
+            overlay[id] = None
+        for record in records:
+            overlay[record.id] = record
+        self.overlay[record_type] = overlay
+
+
+class CatalogSnapshot:
+    """Read-only view of a snapshot file, memory-mapped so that all worker processes share one copy
+       through the page cache. Changes made after the snapshot was written are applied to an in-process
+       overlay by 'refresh', which also switches to a newer file once it's written. Readers take the current
+       'SnapshotFile' once per call, so a concurrent refresh never mixes states of two files."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = Lock()
+        self.file = SnapshotFile(path)
+
+    def get[R](self, record_type: type[R], id: int) -> R | None:
+        return self.file.get(record_type, id)
+
+    def all[R](self, record_type: type[R]) -> Iterator[R]:
+        return self.file.all(record_type)
+
+    # equivalents of model reads
+
+    def get_opportunity_dict(self, opportunity_id: int) -> dict[str, Any] | None:
+        """Same as 'Opportunity.get_dict'."""
+
+        file = self.file
+        if (opportunity := file.get(OpportunityRecord, opportunity_id)) is None:
+            return None
+        provider = file.get(ProviderRecord, opportunity.provider_id)
+        tags = (file.get(TagRecord, id) for id in opportunity.tag_ids)
+        geotags = (file.get(GeotagRecord, id) for id in opportunity.geotag_ids)
+        return {
+            'id': opportunity.id,
+            'name': opportunity.name,
+            'link': opportunity.link,
+            'provider_id': opportunity.provider_id,
+            'provider_logo_url': OpportunityProvider.get_logo_url(opportunity.provider_id),
+            'provider_name': provider.name if provider is not None else None,
+            'tags': {tag.id: tag.name for tag in tags if tag is not None},
+            'geotags': {geotag.id: geotag.city_name for geotag in geotags if geotag is not None},
+        }
+
+    def get_providers(self) -> dict[str, str]:
+        """Same as 'OpportunityProvider.get_all'."""
+
+        return {str(provider.id): provider.name for provider in self.all(ProviderRecord)}
+
+    def get_tags(self) -> dict[str, str]:
+        """Same as 'OpportunityTag.get_all'."""
+
+        return {str(tag.id): tag.name for tag in self.all(TagRecord)}
+
+    def get_geotags(self) -> dict[str, tuple[str, str]]:
+        """Same as 'OpportunityGeotag.get_all'."""
+
+        return {str(geotag.id): (geotag.country_name, geotag.city_name) for geotag in self.all(GeotagRecord)}
+
+    # refreshing
+
+    def refresh(self, session: Session) -> int:
+        """Switch to a newer snapshot file if there is one, then apply logged changes to the overlay.
+           Returns amount of applied changes."""
+
+        with self.lock:
+            file = self.file
+            stat = os.stat(self.path)
+            if (stat.st_ino, stat.st_mtime_ns) != file.file_id:
+                # changes are applied to the new file before readers are switched to it
+                file = SnapshotFile(self.path)
+            changes = [change for change in EntityChange.since(session, max(file.file_seq,
+                                                                            file.last_seq - EntityChange.LOOKBACK))
+                       if change.seq not in file.delivered]
+            changed: defaultdict[str, set[int]] = defaultdict(set)
+            for change in changes:
+                file.delivered.add(change.seq)
+                if change.entity in SNAPSHOT_ENTITIES:
+                    changed[change.entity].add(int(change.entity_id))
+            self.load_providers(session, file, changed['OpportunityProvider'])
+            self.load_tags(session, file, changed['OpportunityTag'])
+            self.load_geotags(session, file, changed['OpportunityGeotag'], changed['City'], changed['Country'])
+            self.load_opportunities(session, file, changed['Opportunity'])
+            if len(changes) > 0:
+                file.last_seq = max(file.last_seq, changes[-1].seq)
+                file.delivered = {seq for seq in file.delivered if seq > file.last_seq - EntityChange.LOOKBACK}
+            self.file = file
+            return len(changes)
+
+    def load_providers(self, session: Session, file: SnapshotFile, ids: set[int]) -> None:
+        if len(ids) > 0:
+            rows = session.execute(select(OpportunityProvider.id, OpportunityProvider.name)
+                                   .where(OpportunityProvider.id.in_(ids)))
+            file.apply(ProviderRecord, ids, (ProviderRecord(id, sys.intern(name)) for id, name in rows))
+
+    def load_tags(self, session: Session, file: SnapshotFile, ids: set[int]) -> None:
+        if len(ids) > 0:
+            rows = session.execute(select(OpportunityTag.id, OpportunityTag.name).where(OpportunityTag.id.in_(ids)))
+            file.apply(TagRecord, ids, (TagRecord(id, sys.intern(name)) for id, name in rows))
+
+    def load_geotags(self, session: Session, file: SnapshotFile, ids: set[int], city_ids: set[int],
+                     country_ids: set[int]) -> None:
+        if len(ids) == 0 and len(city_ids) == 0 and len(country_ids) == 0:
+            return
+        statement = (
+            select(OpportunityGeotag.id, City.id, City.name, Country.name)
+                .join(City, City.id == OpportunityGeotag.city_id)
+                .join(Country, Country.id == City.country_id)
+                .where(OpportunityGeotag.id.in_(ids) | City.id.in_(city_ids) | Country.id.in_(country_ids))
+        )
+        file.apply(GeotagRecord, ids, (GeotagRecord(id, city_id, sys.intern(city), sys.intern(country))
+                                       for id, city_id, city, country in session.execute(statement)))
+
+    def load_opportunities(self, session: Session, file: SnapshotFile, ids: set[int]) -> None:
+        if len(ids) == 0:
+            return
+        opportunities = session.execute(
+            select(Opportunity).where(Opportunity.id.in_(ids))
+                .options(selectinload(Opportunity.tags), selectinload(Opportunity.geotags))
+        ).scalars().all()
+        file.apply(OpportunityRecord, ids, (OpportunityRecord(
+            id=opportunity.id, name=opportunity.name, link=opportunity.link, provider_id=opportunity.provider_id,
+            tag_ids=tuple(sorted(tag.id for tag in opportunity.tags)),
+            geotag_ids=tuple(sorted(geotag.id for geotag in opportunity.geotags)),
+            has_description=opportunity.has_description, has_form=opportunity.has_form,
+        ) for opportunity in opportunities))
@@ -1,13 +1,20 @@
 from typing import Any, Callable, Self, Optional
 from datetime import datetime, UTC
 from ipaddress import IPv4Address
+from io import BytesIO
 
+from sqlalchemy import false
+from sqlalchemy.orm import object_session
 from sqlalchemy.dialects.postgresql import INET, TIMESTAMP
 from minio import Minio
 
 from ..utils import *
 from .base import *
 from .auxillary.address import *
+from .images import (
+    ThumbnailFormat, THUMBNAIL_SIZES, thumbnail_size, thumbnail_filename, make_thumbnails, put_thumbnails, read_object,
+)
+from .blobs import Blob
 from .. import serializers as ser
 
 
@@ -192,6 +199,9 @@ class UserInfo(Base):
     surname: Mapped[str] = mapped_column(String(40), nullable=True, default=None)
     birthday: Mapped[datetime] = mapped_column(nullable=True, default=None)
     avatar_format: Mapped[UserAvatarFormat | None] = mapped_column(nullable=True, default=None)
+    has_avatar_thumbnails: Mapped[bool] = mapped_column(default=False, server_default=false())
+    # set if avatar is stored as content-addressed blob
+    avatar_digest: Mapped[str | None] = mapped_column(String(64), nullable=True, default=None)
 
     user: Mapped['User'] = relationship(back_populates='user_info')
     # phone_number: Mapped[Optional['PhoneNumber']] = \
@@ -207,6 +217,9 @@ class UserInfo(Base):
     def avatar_url(self) -> str:
         return f'/api/user/avatar?user_id={self.user_id}'
 
+    def get_avatar_url(self, size: int | None = None) -> str:
+        return self.avatar_url if size is None else f'{self.avatar_url}&size={size}'
+
     def update_name(self, new_name: ser.UserInfo.Name) -> None:
         self.name = new_name
 
@@ -231,11 +244,29 @@ class UserInfo(Base):
             handler(self, getattr(fields, field))
 
     def update_avatar(self, minio_client: Minio, file: FileStream[UserAvatarFormat]) -> None:
+        session = object_session(self)
+        previous_digest = self.avatar_digest
         self.avatar_format = file.format
-        minio_client.put_object(
-            'user-avatar', f'{self.user_id}.{file.format.value[0]}', file.stream, 
-            file.size if file.size else -1, part_size=(5 * 1024 * 1024)
-        )
+        if Blob.enabled and session is not None:
+            self.avatar_digest = Blob.store(session, minio_client, 'user-avatar', file.stream, file.format.value[1],
+                                            derive=lambda avatar: (
+                                                (thumbnail_filename('', size, format), data, format.value[1])
+                                                for size, format, data in make_thumbnails(avatar)
+                                            ))
+            self.has_avatar_thumbnails = Blob.has_suffix(
+                session, 'user-avatar', self.avatar_digest,
+                thumbnail_filename('', THUMBNAIL_SIZES[0], ThumbnailFormat.PNG),
+            )
+        else:
+            avatar = file.stream.read()
+            minio_client.put_object(
+                'user-avatar', f'{self.user_id}.{file.format.value[0]}', BytesIO(avatar), len(avatar),
+                content_type=file.format.value[1],
+            )
+            self.avatar_digest = None
+            self.has_avatar_thumbnails = put_thumbnails(minio_client, 'user-avatar', str(self.user_id), avatar)
+        if previous_digest is not None and session is not None:
+            Blob.release(session, 'user-avatar', previous_digest)
 
     def get_dict(self) -> dict[str, Any]:
         return {
@@ -245,18 +276,20 @@ class UserInfo(Base):
             # TODO: city, phone number
         }
 
-    def get_avatar(self, minio_client: Minio) -> bytes:
-        filename = f'{self.user_id}.{self.avatar_format.value[0]}' if self.avatar_format is not None \
-            else 'default.png'
-        response = None
-        try:
-            response = minio_client.get_object('user-avatar', filename)
-            avatar = response.read()
-        finally:
-            if response is not None:
-                response.close()
-                response.release_conn()
-        return avatar
+    def get_avatar(self, minio_client: Minio, size: int | None = None,
+                   format: ThumbnailFormat = ThumbnailFormat.PNG) -> bytes:
+        """Return the smallest avatar thumbnail fitting given size, or original avatar if there is none."""
+
+        if self.avatar_format is None:
+            return read_object(minio_client, 'user-avatar', 'default.png')
+        if self.avatar_digest is not None:
+            if self.has_avatar_thumbnails and (thumbnail := thumbnail_size(size)) is not None:
+                return Blob.read(minio_client, 'user-avatar', self.avatar_digest,
+                                 thumbnail_filename('', thumbnail, format))
+            return Blob.read(minio_client, 'user-avatar', self.avatar_digest)
+        if self.has_avatar_thumbnails and (thumbnail := thumbnail_size(size)) is not None:
+            return read_object(minio_client, 'user-avatar', thumbnail_filename(str(self.user_id), thumbnail, format))
+        return read_object(minio_client, 'user-avatar', f'{self.user_id}.{self.avatar_format.value[0]}')
 
     def get_cvs(self) -> dict[str, str]:
         return {str(cv.id): cv.name for cv in self.cvs}
@@ -296,10 +329,12 @@ class CV(Base):
     __tablename__ = 'cv'
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    user_info_id: Mapped[int] = mapped_column(ForeignKey('user_info.user_id'))
+    user_info_id: Mapped[int] = mapped_column(ForeignKey('user_info.user_id'), index=True)
     name: Mapped[str] = mapped_column(String(50))
     format: Mapped[CVFormat]
     public: Mapped[bool] = mapped_column(default=False)
+    # set if file is stored as content-addressed blob
+    blob_digest: Mapped[str | None] = mapped_column(String(64), nullable=True, default=None)
 
     user_info: Mapped['UserInfo'] = relationship(back_populates='cvs')
 
@@ -308,6 +343,9 @@ class CV(Base):
             file: FileStream[CVFormat], name: ser.CV.Name) -> Self:
         cv = CV(user_info=user.user_info, name=name, format=file.format)
         session.add(cv)
+        if Blob.enabled:
+            cv.blob_digest = Blob.store(session, minio_client, 'user-cv', file.stream, file.format.value[1])
+            return cv
         session.flush([cv])
         minio_client.put_object('user-cv', f'{cv.id}.{file.format.value[0]}', file.stream, file.size)
         return cv
@@ -315,8 +353,16 @@ class CV(Base):
     def rename(self, name: ser.CV.Name) -> None:
         self.name = name
 
+    def get_file(self, minio_client: Minio) -> bytes:
+        if self.blob_digest is not None:
+            return Blob.read(minio_client, 'user-cv', self.blob_digest)
+        return read_object(minio_client, 'user-cv', f'{self.id}.{self.format.value[0]}')
+
     def delete(self, session: Session, minio_client: Minio) -> None:
-        minio_client.remove_object('user-cv', f'{self.id}.{self.format.value[0]}')
+        if self.blob_digest is not None:
+            Blob.release(session, 'user-cv', self.blob_digest)
+        else:
+            minio_client.remove_object('user-cv', f'{self.id}.{self.format.value[0]}')
         session.delete(self)
 
 
@@ -0,0 +1,8 @@
+from .queries import (
+    fingerprint, QueryRecord, RepeatedQuery, QueryRecorder, Instrumentation,
+    instrument, uninstrument, record_queries, QueryBudgetExceeded, assert_max_queries,
+)
+from .tracing import (
+    Span, Sink, LoggingSink, Histogram, Tracer, tracer,
+    trace_postgres, trace_mongo, TracedMinio, serve_metrics,
+)
@@ -0,0 +1,207 @@
+from typing import ClassVar, Iterator
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import logging
+import os
+import re
+import sys
+import time
+
+from sqlalchemy import Engine, event
+from sqlalchemy.orm import Session, SessionTransaction
+
+logger = logging.getLogger('database.queries')
+
+_MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models')
+
+_FINGERPRINT_RULES: list[tuple[re.Pattern, str]] = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'__\[POSTCOMPILE_\w+\]'), '?'),
+    (re.compile(r'%\(\w+\)s|%s|\$\d+|:\w+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE), 'IN (?)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+def fingerprint(statement: str) -> str:
+    """Normalize statement, so that statements differing only in literals and parameters are equal."""
+
+    for pattern, replacement in _FINGERPRINT_RULES:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def model_caller() -> str | None:
+    """Qualified name of the innermost model method in the current call stack."""
+
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(_MODELS_DIR):
+            return frame.f_code.co_qualname
+        frame = frame.f_back
+    return None
+
+
+@dataclass
+class QueryRecord:
+    fingerprint: str
+    statement: str
+    duration: float
+    caller: str | None
+
+
+@dataclass
+class RepeatedQuery:
+    fingerprint: str
+    count: int
+    duration: float
+    callers: set[str | None]
+
+    def __str__(self) -> str:
+        callers = ', '.join(sorted(caller or '<unknown>' for caller in self.callers))
+        return f'{self.count}x ({self.duration * 1000:.1f} ms) from {callers}: {self.fingerprint}'
+
+
+@dataclass(eq=False)
+class QueryRecorder:
+    """Queries executed within one unit of work."""
+
+    name: str
+    records: list[QueryRecord] = field(default_factory=list)
+
+    # Same-shape statement repeated at least this amount of times is reported as N+1
+    N_PLUS_ONE_THRESHOLD: ClassVar[int] = 5
+
+    @property
+    def count(self) -> int:
+        return len(self.records)
+
+    @property
+    def duration(self) -> float:
+        return sum(record.duration for record in self.records)
+
+    def add(self, record: QueryRecord) -> None:
+        self.records.append(record)
+
+    def repeated(self, threshold: int | None = None) -> list[RepeatedQuery]:
+        """Return statements executed at least 'threshold' times, most frequent first."""
+
+        threshold = threshold or self.N_PLUS_ONE_THRESHOLD
+        groups: defaultdict[str, list[QueryRecord]] = defaultdict(list)
+        for record in self.records:
+            groups[record.fingerprint].append(record)
+        repeated = [
+            RepeatedQuery(fingerprint=fingerprint, count=len(records),
+                          duration=sum(record.duration for record in records),
+                          callers={record.caller for record in records})
+            for fingerprint, records in groups.items() if len(records) >= threshold
+        ]
+        return sorted(repeated, key=lambda query: query.count, reverse=True)
+
+    def report(self) -> None:
+        for query in self.repeated():
+            logger.warning('N+1 query pattern in \'%s\': %s', self.name, query)
+        logger.debug('Unit of work \'%s\' executed %i queries in %.1f ms', self.name, self.count, self.duration * 1000)
+
+
+_current_recorder: ContextVar[QueryRecorder | None] = ContextVar('current_query_recorder', default=None)
+_RECORDER_KEY = 'query_recorder'
+
+
+@dataclass
+class Instrumentation:
+    """Engine-level listeners, that feed query recorders and log slow queries."""
+
+    # Queries running longer than this (in seconds) are logged with warning level
+    slow_query_threshold: float = 0.2
+    # Whether every session transaction is recorded as a unit of work and checked for N+1 patterns
+    per_session: bool = True
+
+    def before_cursor_execute(self, connection, _cursor, _statement, _parameters, context, _executemany) -> None:
+        context._query_start = time.perf_counter()
+
+    def after_cursor_execute(self, connection, _cursor, statement, parameters, context, _executemany) -> None:
+        duration = time.perf_counter() - context._query_start
+        recorders = [recorder for recorder in (_current_recorder.get(), connection.info.get(_RECORDER_KEY))
+                     if recorder is not None]
+        caller = model_caller() if len(recorders) > 0 or duration >= self.slow_query_threshold else None
+        if duration >= self.slow_query_threshold:
+            logger.warning('Slow query (%.1f ms) from %s: %s', duration * 1000, caller or '<unknown>',
+                           fingerprint(statement))
+        if len(recorders) == 0:
+            return
+        record = QueryRecord(fingerprint=fingerprint(statement), statement=statement,
+                             duration=duration, caller=caller)
+        for recorder in dict.fromkeys(recorders):
+            recorder.add(record)
+
+    def after_begin(self, session: Session, transaction: SessionTransaction, connection) -> None:
+        recorder = session.info.setdefault(_RECORDER_KEY, QueryRecorder(session.info.get('unit_of_work', 'session')))
+        connection.info[_RECORDER_KEY] = recorder
+        # connection is already closed when transaction ends, so its info is kept instead
+        session.info.setdefault('recorded_connections', []).append(connection.info)
+
+    def after_transaction_end(self, session: Session, transaction: SessionTransaction) -> None:
+        if transaction.parent is not None or (recorder := session.info.pop(_RECORDER_KEY, None)) is None:
+            return
+        for connection_info in session.info.pop('recorded_connections', []):
+            connection_info.pop(_RECORDER_KEY, None)
+        recorder.report()
+
+
+_instrumentations: dict[Engine, Instrumentation] = {}
+
+def instrument(engine: Engine, slow_query_threshold: float = 0.2, per_session: bool = True) -> Instrumentation:
+    """Start recording queries executed by given engine. Instrumentation is opt-in, without it
+       no listeners are installed and there is no overhead."""
+
+    if engine in _instrumentations:
+        return _instrumentations[engine]
+    instrumentation = Instrumentation(slow_query_threshold=slow_query_threshold, per_session=per_session)
+    event.listen(engine, 'before_cursor_execute', instrumentation.before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', instrumentation.after_cursor_execute)
+    if per_session:
+        event.listen(Session, 'after_begin', instrumentation.after_begin)
+        event.listen(Session, 'after_transaction_end', instrumentation.after_transaction_end)
+    _instrumentations[engine] = instrumentation
+    return instrumentation
+
+def uninstrument(engine: Engine) -> None:
+    if (instrumentation := _instrumentations.pop(engine, None)) is None:
+        return
+    event.remove(engine, 'before_cursor_execute', instrumentation.before_cursor_execute)
+    event.remove(engine, 'after_cursor_execute', instrumentation.after_cursor_execute)
+    if instrumentation.per_session:
+        event.remove(Session, 'after_begin', instrumentation.after_begin)
+        event.remove(Session, 'after_transaction_end', instrumentation.after_transaction_end)
+
+
+@contextmanager
+def record_queries(name: str = 'block') -> Iterator[QueryRecorder]:
+    """Record all queries executed by instrumented engines inside of the block."""
+
+    recorder = QueryRecorder(name)
+    token = _current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current_recorder.reset(token)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+@contextmanager
+def assert_max_queries(budget: int, allow_repeated: bool = False) -> Iterator[QueryRecorder]:
+    """Fail if block executes more than 'budget' queries or, unless allowed, any N+1 pattern.
+       Intended for tests, engine must be instrumented."""
+
+    with record_queries('assert_max_queries') as recorder:
+        yield recorder
+    if recorder.count > budget:
+        statements = '\n'.join(f'  {record.caller or "<unknown>"}: {record.fingerprint}' for record in recorder.records)
+        raise QueryBudgetExceeded(f'Expected at most {budget} queries, got {recorder.count}:\n{statements}')
+    if not allow_repeated and len(repeated := recorder.repeated()) > 0:
+        raise QueryBudgetExceeded('N+1 query patterns detected:\n' + '\n'.join(f'  {query}' for query in repeated))
@@ -1,7 +1,7 @@
 from .user import *
 from .opportunity import *
 from .auxillary import (
-    Date, Country, City,
+    Date, Country, City, Proximity,
 )
 from .base import (
     Id, APIKey, APIKeyModel, assert_api_key,
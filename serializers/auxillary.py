@@ -47,5 +47,34 @@ class City(BaseModel):
     model_config = {'extra': 'ignore'}
 
     type Name = Annotated[str, Field(min_length=1, max_length=50)]
+    type Latitude = Annotated[float, Field(ge=-90, le=90)]
+    type Longitude = Annotated[float, Field(ge=-180, le=180)]
 
     name: Name
+    latitude: Latitude | None = None
+    longitude: Longitude | None = None
+
+    @model_validator(mode='after')
+    def validate_location(self) -> Self:
+        if (self.latitude is None) != (self.longitude is None):
+            raise PydanticCustomError('location_error', 'Latitude and longitude must be given together')
+        return self
+
+
+class Proximity(BaseModel):
+    """Area around either a point or a city."""
+
+    model_config = {'extra': 'ignore'}
+
+    type Radius = Annotated[float, Field(gt=0, le=2000)]
+
+    city_id: Id | None = None
+    latitude: City.Latitude | None = None
+    longitude: City.Longitude | None = None
+    radius: Radius
+
+    @model_validator(mode='after')
+    def validate_center(self) -> Self:
+        if (self.city_id is None) == (self.latitude is None or self.longitude is None):
+            raise PydanticCustomError('center_error', 'Either city id or both latitude and longitude must be given')
+        return self
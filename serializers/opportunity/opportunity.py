@@ -2,6 +2,7 @@ from pydantic import HttpUrl, field_validator
 from pydantic_core import PydanticCustomError
 
 from ..base import *
+from ..auxillary import Proximity
 from . import form
 
 
@@ -28,6 +29,13 @@ class Filter(BaseModel):
     provider_ids: Annotated[list[Id], Field(default_factory=list)]
     tag_ids: Annotated[list[Id], Field(default_factory=list)]
     geotag_ids: Annotated[list[Id], Field(default_factory=list)]
+    near: Annotated[Proximity | None, Field(default=None)]
+
+
+type Query = Annotated[str, Field(min_length=1, max_length=200)]
+
+class Search(Filter):
+    query: Query
 
 
 class AddTags(BaseModel):
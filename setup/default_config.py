@@ -4,6 +4,26 @@ PG_PASSWORD: str = ...
 PG_HOST: str = ...
 PG_PORT: int = ...
 PG_DB_NAME: str = ...
+# Query instrumentation (N+1 detection, slow query log)
+PG_INSTRUMENTATION: bool = False
+PG_SLOW_QUERY_THRESHOLD: float = 0.2
+# Delivery of changes made by other workers to process-wide caches
+CHANGE_NOTIFICATIONS: bool = False
+CHANGE_POLL_INTERVAL: float = 5
+# Forwarding of form responses to submit methods (0 disables it in this process)
+DELIVERY_WORKERS: int = 0
+DELIVERY_PER_DESTINATION: int = 2
+# Token bucket limits of API keys, shared between processes through the database if RATE_LIMITING_SHARED
+RATE_LIMITING: bool = False
+RATE_LIMITING_SHARED: bool = False
+# Monthly partitions of responses, ones older than RESPONSE_RETENTION_MONTHS are moved to 'archive' schema.
+# Inserts of responses fail once partitions created ahead run out, so it's only to be disabled in processes,
+# which don't serve responses, runs of other processes are serialized in the database
+RESPONSE_PARTITION_MAINTENANCE: bool = True
+RESPONSE_RETENTION_MONTHS: int | None = None
+RESPONSE_ARCHIVE_TABLESPACE: str | None = None
+# Seconds concurrent identical listings and object reads wait for the call they are coalesced with
+SINGLE_FLIGHT_TIMEOUT: float = 5
 
 # MongoDB
 MONGO_USERNAME: str = ...
@@ -18,3 +38,10 @@ MINIO_ACCESS_KEY: str = ...
 MINIO_SECRET_KEY: str = ...
 MINIO_HOST: str = ...
 MINIO_PORT: int = ...
+# Store CVs and avatars as deduplicated content-addressed blobs
+CONTENT_ADDRESSED_BLOBS: bool = False
+
+# Latency tracing of store calls and Prometheus metrics endpoint
+TRACING: bool = False
+TRACING_SAMPLE_RATE: float = 0.01
+METRICS_PORT: int | None = None